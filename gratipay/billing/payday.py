@@ -6,15 +6,22 @@ payday. This event has duration (it's not punctiliar).
 
 Payday is designed to be crash-resistant. Everything that can be rolled back
 happens inside a single DB transaction. Exchanges cannot be rolled back, so they
-immediately affect the participant's balance.
+immediately affect the participant's balance. Neither can card holds, so we
+record them in the card_holds table as we go, and a restarted payday reuses
+them instead of searching Braintree again.
 
 """
-from __future__ import unicode_literals
+from __future__ import division, unicode_literals
 
+from contextlib import contextmanager
 import itertools
 from multiprocessing.dummy import Pool as ThreadPool
+from threading import Lock
+from time import sleep, time
+import traceback
 
 import braintree
+from braintree.exceptions import DownForMaintenanceError, ServerError
 
 import aspen.utils
 from aspen import log
@@ -23,6 +30,8 @@ from gratipay.billing.exchanges import (
 )
 from gratipay.exceptions import NegativeBalance
 from gratipay.models import check_db
+from gratipay.models.participant import Participant
+from gratipay.utils import TokenBucket
 from psycopg2 import IntegrityError
 
 
@@ -30,26 +39,70 @@ with open('sql/payday.sql') as f:
     PAYDAY = f.read()
 
 
-class ExceptionWrapped(Exception): pass
+def threaded_map(func, iterable, threads=5, rate=0, retries=0, retry_on=(), backoff=1,
+                 label=None, log_every=100):
+    """Call func on each item in iterable, using a pool of threads.
 
+    Items are handed out one at a time, so a slow call only holds up its own
+    thread. If rate is given, calls are throttled to that many per second
+    across all threads. Exceptions that are instances of retry_on are retried
+    up to retries times, waiting backoff, 2*backoff, 4*backoff, ... seconds in
+    between. If label is given, we log progress every log_every items.
 
-def threaded_map(func, iterable, threads=5):
+    Every item is processed even if some of them fail, and then the first
+    exception is re-raised. Results are returned in the order they complete.
+
+    """
+    bucket = TokenBucket(rate) if rate else None
+    def g(item):
+        attempt = 0
+        while True:
+            if bucket:
+                bucket.take()
+            try:
+                return None, func(item)
+            except Exception as e:
+                if isinstance(e, retry_on) and attempt < retries:
+                    sleep(backoff * 2 ** attempt)
+                    attempt += 1
+                    continue
+                # Keep the traceback, otherwise we get one from inside multiprocessing.
+                return (e, traceback.format_exc()), None
+
+    total = len(iterable) if hasattr(iterable, '__len__') else '?'
+    results, error = [], None
     pool = ThreadPool(threads)
-    def g(*a, **kw):
-        # Without this wrapper we get a traceback from inside multiprocessing.
-        try:
-            return func(*a, **kw)
-        except Exception as e:
-            import traceback
-            raise ExceptionWrapped(e, traceback.format_exc())
+    _start = time()
     try:
-        r = pool.map(g, iterable)
-    except ExceptionWrapped as e:
-        print(e.args[1])
-        raise e.args[0]
-    pool.close()
-    pool.join()
-    return r
+        for i, (exc, r) in enumerate(pool.imap_unordered(g, iterable), 1):
+            if exc:
+                error = error or exc
+            else:
+                results.append(r)
+            if label and i % log_every == 0:
+                log("%s: %i/%s (%.1f/s)." % (label, i, total, i / (time() - _start)))
+    finally:
+        pool.close()
+        pool.join()
+    if error:
+        print(error[1])
+        raise error[0]
+    return results
+
+
+class Measurement(object):
+    """Timing and counts for one step of payday. See Payday.measure.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.nrows = None
+        self.ncalls = 0
+        self._lock = Lock()
+
+    def add_call(self):
+        with self._lock:
+            self.ncalls += 1
 
 
 class NoPayday(Exception):
@@ -81,6 +134,17 @@ class Payday(object):
 
     """
 
+    # Tuning for our calls to Braintree (see wireup.billing). Every thread
+    # may need a DB connection of its own, so gateway_threads should stay
+    # below DATABASE_MAXCONN. A gateway_rate of 0 means no rate limit.
+    gateway_threads = 5
+    gateway_rate = 0
+    gateway_retries = 3
+
+
+    def __init__(self):
+        self._measurements = []
+
 
     @classmethod
     def start(cls):
@@ -95,12 +159,12 @@ class Payday(object):
         try:
             d = cls.db.one("""
                 INSERT INTO paydays DEFAULT VALUES
-                RETURNING id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage
+                RETURNING id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage, checkpoints
             """, back_as=dict)
             log("Starting a new payday.")
         except IntegrityError:  # Collision, we have a Payday already.
             d = cls.db.one("""
-                SELECT id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage
+                SELECT id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage, checkpoints
                   FROM paydays
                  WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
             """, back_as=dict)
@@ -132,11 +196,13 @@ class Payday(object):
             self.payin()
             self.mark_stage_done()
         if self.stage < 2:
-            self.update_stats()
+            with self.measure('update_stats'):
+                self.update_stats()
             self.mark_stage_done()
 
         self.end()
-        self.notify_participants()
+        with self.measure('notify_participants') as m:
+            m.nrows = self.notify_participants()
 
         _end = aspen.utils.utcnow()
         _delta = _end - _start
@@ -148,18 +214,31 @@ class Payday(object):
         """The first stage of payday where we charge credit cards and transfer
         money internally between participants.
         """
+        count = lambda cursor, table: cursor.one("SELECT count(*) FROM %s" % table)
         with self.db.get_cursor() as cursor:
-            self.prepare(cursor)
-            holds = self.create_card_holds(cursor)
-            self.process_payment_instructions(cursor)
+            with self.measure('prepare') as m:
+                self.prepare(cursor)
+                m.nrows = count(cursor, 'payday_participants')
+            with self.measure('create_card_holds') as m:
+                holds = self.create_card_holds(cursor)
+                m.nrows = len(holds)
+            with self.measure('process_payment_instructions') as m:
+                self.process_payment_instructions(cursor)
+                m.nrows = count(cursor, 'payday_payment_instructions')
             self.transfer_takes(cursor, self.ts_start)
-            self.process_draws(cursor)
+            with self.measure('process_draws') as m:
+                self.process_draws(cursor)
+                m.nrows = count(cursor, 'payday_teams')
             payments = cursor.all("""
                 SELECT * FROM payments WHERE "timestamp" > %s
             """, (self.ts_start,))
             try:
-                self.settle_card_holds(cursor, holds)
-                self.update_balances(cursor)
+                with self.measure('settle_card_holds') as m:
+                    m.nrows = len(holds)
+                    self.settle_card_holds(cursor, holds)
+                with self.measure('update_balances') as m:
+                    self.update_balances(cursor)
+                    m.nrows = count(cursor, 'payday_payments')
                 check_db(cursor)
             except:
                 # Dump payments for debugging
@@ -168,7 +247,8 @@ class Payday(object):
                 with open('%s_payments.csv' % time(), 'wb') as f:
                     csv.writer(f).writerows(payments)
                 raise
-        self.take_over_balances()
+        with self.measure('take_over_balances'):
+            self.take_over_balances()
 
 
     @staticmethod
@@ -197,6 +277,128 @@ class Payday(object):
         return holds
 
 
+    def load_card_holds(self, participant_ids):
+        """Load the holds we recorded earlier in this payday.
+
+        This is used instead of fetch_card_holds when payday is restarted, so
+        that we don't have to search Braintree all over again.
+
+        """
+        log('Loading recorded card holds.')
+        holds = {}
+        recorded = self.db.all("""
+            SELECT id, participant, amount, token
+              FROM card_holds
+             WHERE payday = %s
+               AND status = 'authorized'
+        """, (self.id,))
+        for r in recorded:
+            hold = braintree.Transaction(None, {
+                'id': r.id,
+                'amount': r.amount,
+                'tax_amount': 0,
+                'status': 'authorized',
+                'custom_fields': {'participant_id': unicode(r.participant)},
+                'credit_card': {'token': r.token},
+            })
+            if r.participant in participant_ids:
+                log('Reusing a ${:.2f} hold for {}.'.format(hold.amount, r.participant))
+                holds[r.participant] = hold
+            else:
+                self.cancel_card_hold(hold)
+        return holds
+
+
+    def find_unrecorded_card_holds(self, participant_ids, holds):
+        """Search Braintree for holds that load_card_holds doesn't know about.
+
+        A crash between creating a hold and recording it, or a sale that times
+        out after Braintree has authorized it, leaves a hold that isn't in the
+        card_holds table. We adopt such a hold if its participant doesn't have
+        one yet, and cancel it otherwise, so that we never leave two holds on
+        the same card.
+
+        """
+        log('Searching for unrecorded card holds.')
+        self.count_gateway_call()
+        existing_holds = braintree.Transaction.search(
+            braintree.TransactionSearch.status == 'authorized'
+        )
+        adopted = []
+        for hold in existing_holds.items:
+            p_id = int(hold.custom_fields['participant_id'])
+            if p_id in holds:
+                if holds[p_id].id != hold.id:
+                    self.cancel_card_hold(hold)
+            elif p_id in participant_ids:
+                log('Reusing an unrecorded ${:.2f} hold for {}.'.format(hold.amount, p_id))
+                holds[p_id] = hold
+                adopted.append(hold)
+            else:
+                self.cancel_card_hold(hold)
+        with self.db.get_cursor() as c:
+            self.record_card_holds(c, adopted)
+        return holds
+
+
+    def record_card_holds(self, cursor, holds):
+        """Record holds in the card_holds table, so a restart can reuse them.
+        """
+        for hold in holds:
+            cursor.run("""
+                INSERT INTO card_holds
+                            (id, payday, participant, amount, token)
+                     VALUES (%s, %s, %s, %s, %s)
+            """, ( hold.id
+                 , self.id
+                 , int(hold.custom_fields['participant_id'])
+                 , hold.amount
+                 , hold.credit_card['token']
+                  ))
+
+
+    def record_card_hold_outcome(self, participant_id, amount, status):
+        """Record that we didn't get a hold for a participant, and why.
+
+        status is 'skipped' if the amount was under MINIMUM_CHARGE, and
+        'failed' if the sale was declined or errored out. A restart doesn't
+        search Braintree for these participants' holds.
+
+        """
+        self.db.run("""
+            INSERT INTO card_holds
+                        (payday, participant, amount, status)
+                 VALUES (%s, %s, %s, %s)
+        """, (self.id, participant_id, amount, status))
+
+
+    def load_card_hold_outcomes(self):
+        """Return a dict of participant id to 'failed' or 'skipped', for the
+        attempts recorded by record_card_hold_outcome earlier in this payday.
+        """
+        return dict(self.db.all("""
+            SELECT participant, status
+              FROM card_holds
+             WHERE payday = %s
+               AND status IN ('failed', 'skipped')
+        """, (self.id,)))
+
+
+    def set_card_hold_status(self, hold, status):
+        self.db.run("""
+            UPDATE card_holds
+               SET status = %s
+             WHERE payday = %s
+               AND id = %s
+        """, (status, self.id, hold.id))
+
+
+    def cancel_card_hold(self, hold):
+        self.count_gateway_call()
+        cancel_card_hold(hold)
+        self.set_card_hold_status(hold, 'voided')
+
+
     def create_card_holds(self, cursor):
 
         # Get the list of participants to create card holds for
@@ -210,9 +412,27 @@ class Payday(object):
         if not participants:
             return {}
 
-        # Fetch existing holds
+        # Fetch existing holds, unless we already did earlier in this payday
         participant_ids = set(p.id for p in participants)
-        holds = self.fetch_card_holds(participant_ids)
+        if 'fetch_card_holds' in self.checkpoints:
+            holds = self.load_card_holds(participant_ids)
+            outcomes = self.load_card_hold_outcomes()
+            if participant_ids - set(holds) - set(outcomes):
+                with self.measure('find_unrecorded_card_holds') as m:
+                    self.find_unrecorded_card_holds(participant_ids, holds)
+                    m.nrows = len(holds)
+            # Don't retry sales that failed: one that errored out may have left
+            # a hold anyway, and we'd end up with two. Payday carries on without
+            # a hold for them, as it did the first time round.
+            participants = [p for p in participants if outcomes.get(p.id) != 'failed']
+        else:
+            with self.measure('fetch_card_holds') as m:
+                holds = self.fetch_card_holds(participant_ids)
+                m.add_call()
+                m.nrows = len(holds)
+            with self.db.get_cursor() as c:
+                self.record_card_holds(c, holds.values())
+                self.mark_checkpoint(c, 'fetch_card_holds')
 
         # Create new holds and check amounts of existing ones
         def f(p):
@@ -226,18 +446,26 @@ class Payday(object):
                         return
                     else:
                         # The amount is too low, cancel the hold and make a new one
-                        cancel_card_hold(holds.pop(p.id))
+                        self.cancel_card_hold(holds.pop(p.id))
                 else:
                     # not up to minimum charge level. cancel the hold
-                    cancel_card_hold(holds.pop(p.id))
+                    self.cancel_card_hold(holds.pop(p.id))
+                    self.record_card_hold_outcome(p.id, amount, 'skipped')
                     return
             if amount >= MINIMUM_CHARGE:
+                self.count_gateway_call()
                 hold, error = create_card_hold(self.db, p, amount)
                 if error:
+                    self.record_card_hold_outcome(p.id, amount, 'failed')
                     return 1
                 else:
+                    with self.db.get_cursor() as c:
+                        self.record_card_holds(c, [hold])
                     holds[p.id] = hold
-        threaded_map(f, participants)
+            else:
+                self.record_card_hold_outcome(p.id, amount, 'skipped')
+        # Not retried: a retried sale could leave two holds on the same card.
+        self.gateway_map(f, participants, "Creating card holds")
 
         # Update the values of card_hold_ok in our temporary table
         if not holds:
@@ -252,12 +480,137 @@ class Payday(object):
 
 
     @staticmethod
-    def process_payment_instructions(cursor):
-        """Trigger the process_payment_instructions function for each row in
-        payday_payment_instructions.
+    def process_payment_instructions(cursor, set_based=True):
+        """Pay or park each row in payday_payment_instructions.
+
+        By default this is done with a handful of set-based statements. Pass
+        ``set_based=False`` to instead trigger the process_payment_instruction
+        function for each row, one at a time. The two give identical results;
+        the trigger path is kept around so we can compare them.
+
         """
         log("Processing payment instructions.")
-        cursor.run("UPDATE payday_payment_instructions SET is_funded=true;")
+        if not set_based:
+            cursor.run("UPDATE payday_payment_instructions SET is_funded=true;")
+            return
+        cursor.run("""
+
+            -- Decide which instructions are funded. A participant's instructions
+            -- are considered in (ctime, team) order, and each one is paid if the
+            -- participant has a card hold or enough balance left to cover it.
+            -- Participants with a card hold or enough balance for all of their
+            -- instructions are decided wholesale; only the rest need walking.
+
+            ALTER TABLE payday_payment_instructions
+                DISABLE TRIGGER process_payment_instruction;
+
+            WITH RECURSIVE ranked AS (
+                SELECT i.id
+                     , i.participant
+                     , i.amount + i.due AS amount
+                     , row_number() OVER (PARTITION BY i.participant
+                                              ORDER BY i.ctime, i.team) AS rank
+                     , sum(i.amount + i.due) OVER (PARTITION BY i.participant) AS total
+                     , p.new_balance AS balance
+                     , p.card_hold_ok
+                  FROM payday_payment_instructions i
+                  JOIN payday_participants p ON p.username = i.participant
+            ), undecided AS (
+                SELECT *
+                  FROM ranked
+                 WHERE card_hold_ok IS NOT true
+                   AND total > balance
+                   AND balance > 0
+            ), walk AS (
+                SELECT id, participant, rank
+                     , amount <= balance AS is_funded
+                     , CASE WHEN amount <= balance THEN balance - amount ELSE balance END AS balance
+                  FROM undecided
+                 WHERE rank = 1
+              UNION ALL
+                SELECT i.id, i.participant, i.rank
+                     , i.amount <= w.balance
+                     , CASE WHEN i.amount <= w.balance THEN w.balance - i.amount ELSE w.balance END
+                  FROM walk w
+                  JOIN undecided i ON i.participant = w.participant AND i.rank = w.rank + 1
+            )
+            UPDATE payday_payment_instructions i
+               SET is_funded = true
+              FROM ranked r
+         LEFT JOIN walk w ON w.id = r.id
+             WHERE i.id = r.id
+               AND ( r.card_hold_ok OR r.total <= r.balance OR w.is_funded );
+
+            ALTER TABLE payday_payment_instructions
+                ENABLE TRIGGER process_payment_instruction;
+
+
+            -- Move the money.
+
+            UPDATE payday_participants p
+               SET new_balance = (new_balance - i.amount)
+              FROM ( SELECT participant, sum(amount + due) AS amount
+                       FROM payday_payment_instructions
+                      WHERE is_funded
+                   GROUP BY participant
+                   ) i
+             WHERE p.username = i.participant;
+
+            UPDATE payday_teams t
+               SET balance = (balance + i.amount)
+              FROM ( SELECT team, sum(amount + due) AS amount
+                       FROM payday_payment_instructions
+                      WHERE is_funded
+                   GROUP BY team
+                   ) i
+             WHERE t.slug = i.team;
+
+
+            -- Clear the due on what we paid, and park what we didn't.
+
+            WITH targets AS (
+                SELECT c.id
+                     , i.is_funded
+                     , CASE WHEN i.is_funded THEN 0 ELSE i.amount + i.due END AS due
+                  FROM payday_payment_instructions i
+                  JOIN current_payment_instruction_ids c
+                    ON c.participant = i.participant AND c.team = i.team
+            )
+            UPDATE payment_instructions p
+               SET due = t.due
+              FROM targets t
+             WHERE p.id = t.id
+               AND (t.is_funded IS NOT true OR p.due > 0);
+
+
+            -- Record events and payments, in the order the trigger would have.
+
+            INSERT INTO events (type, payload)
+                SELECT 'payday'
+                     , ( CASE WHEN i.is_funded
+                              THEN '{"action":"pay","participant":"' || i.participant
+                                   || '", "team":"' || i.team
+                                   || '", "amount":' || (i.amount + i.due) || '}'
+                              ELSE '{"action":"due","participant":"' || i.participant
+                                   || '", "team":"' || i.team
+                                   || '", "due":' || (i.amount + i.due) || '}'
+                          END
+                       )::json
+                  FROM payday_payment_instructions i
+                  JOIN payday_participants p ON p.username = i.participant
+              ORDER BY p.claimed_time, i.ctime, i.team;
+
+            INSERT INTO payday_payments (participant, team, amount, direction)
+                SELECT p.username, t.slug, i.amount + i.due, 'to-team'
+                  FROM payday_payment_instructions i
+                  JOIN payday_participants p2 ON p2.username = i.participant
+                  JOIN participants p ON p.id = p2.id
+                  JOIN payday_teams t2 ON t2.slug = i.team
+                  JOIN teams t ON t.id = t2.id
+                 WHERE i.is_funded
+              ORDER BY p2.claimed_time, i.ctime, i.team;
+
+        """)
 
 
     @staticmethod
@@ -308,13 +661,22 @@ class Payday(object):
         # Capture holds to bring balances back up to (at least) zero
         def capture(p):
             amount = -p.new_balance
-            capture_card_hold(self.db, p, amount, holds.pop(p.id))
-        threaded_map(capture, participants)
+            hold = holds.pop(p.id)
+            self.count_gateway_call()
+            capture_card_hold(self.db, p, amount, hold)
+            self.set_card_hold_status(hold, 'captured')
+        # Not retried: a retried capture could charge the same card twice.
+        self.gateway_map(capture, participants, "Capturing card holds")
         log("Captured %i card holds." % len(participants))
 
         log("Canceling card holds.")
         # Cancel the remaining holds
-        threaded_map(cancel_card_hold, holds.values())
+        self.gateway_map( self.cancel_card_hold
+                        , holds.values()
+                        , "Canceling card holds"
+                        , retries=self.gateway_retries
+                        , retry_on=(DownForMaintenanceError, ServerError)
+                         )
         log("Canceled %i card holds." % len(holds))
 
 
@@ -409,7 +771,14 @@ class Payday(object):
                       FROM our_payments
                      WHERE payday=p.id AND direction='to-team'
                    )
-             WHERE id=%(payday)s
+             WHERE id=%(payday)s;
+
+            DELETE FROM payday_receipts WHERE payday=%(payday)s;
+            INSERT INTO payday_receipts (payday, team, npatrons, receipts)
+                 SELECT payday, team, count(DISTINCT participant), sum(amount)
+                   FROM payments
+                  WHERE payday=%(payday)s AND direction='to-team'
+               GROUP BY payday, team;
 
         """, {'payday': self.id})
         log("Updated payday stats.")
@@ -427,60 +796,127 @@ class Payday(object):
 
 
     def notify_participants(self):
+        """Queue emails about this payday's charges. Returns the number queued.
+
+        The number of teams each participant gives to and their top team are
+        computed for everyone at once, and the emails are queued in bulk.
+
+        """
         log("Notifying participants.")
         ts_start, ts_end = self.ts_start, self.ts_end
         exchanges = self.db.all("""
-            SELECT e.id, amount, fee, note, status, p.*::participants AS participant
-              FROM exchanges e
-              JOIN participants p ON e.participant = p.username
-             WHERE "timestamp" >= %(ts_start)s
-               AND "timestamp" < %(ts_end)s
-               AND amount > 0
-               AND p.notify_charge > 0
+            WITH charges AS (
+                     SELECT e.id, amount, fee, note, status
+                          , p.id AS participant_id, p.username, p.notify_charge
+                       FROM exchanges e
+                       JOIN participants p ON e.participant = p.username
+                      WHERE "timestamp" >= %(ts_start)s
+                        AND "timestamp" < %(ts_end)s
+                        AND amount > 0
+                        AND p.notify_charge > 0
+                 )
+               , tippees AS (
+                     SELECT s.participant, t.slug, s.amount
+                       FROM ( SELECT DISTINCT ON (participant, team) participant, team, amount
+                                FROM payment_instructions
+                               WHERE mtime < %(ts_start)s
+                                 AND participant IN (SELECT username FROM charges)
+                            ORDER BY participant, team, mtime DESC
+                            ) s
+                       JOIN teams t ON s.team = t.slug
+                       JOIN participants p ON t.owner = p.username
+                      WHERE s.amount > 0
+                        AND t.is_approved IS true
+                        AND t.is_closed IS NOT true
+                        AND (SELECT count(*)
+                               FROM current_exchange_routes er
+                              WHERE er.participant = p.id
+                                AND network = 'paypal'
+                                AND error = ''
+                            ) > 0
+                 )
+               , summaries AS (
+                     SELECT participant
+                          , count(*) AS nteams
+                          , (array_agg(slug ORDER BY amount DESC))[1] AS top_team
+                       FROM tippees
+                   GROUP BY participant
+                 )
+            SELECT c.*, COALESCE(s.nteams, 0) AS nteams, s.top_team
+              FROM charges c
+         LEFT JOIN summaries s ON s.participant = c.username
+          ORDER BY c.id
         """, locals())
+        messages = []
         for e in exchanges:
             if e.status not in ('failed', 'succeeded'):
                 log('exchange %s has an unexpected status: %s' % (e.id, e.status))
                 continue
             i = 1 if e.status == 'failed' else 2
-            p = e.participant
-            if p.notify_charge & i == 0:
+            if e.notify_charge & i == 0:
                 continue
-            username = p.username
-            nteams, top_team = self.db.one("""
-                WITH tippees AS (
-                         SELECT t.slug, amount
-                           FROM ( SELECT DISTINCT ON (team) team, amount
-                                    FROM payment_instructions
-                                   WHERE mtime < %(ts_start)s
-                                     AND participant = %(username)s
-                                ORDER BY team, mtime DESC
-                                ) s
-                           JOIN teams t ON s.team = t.slug
-                           JOIN participants p ON t.owner = p.username
-                          WHERE s.amount > 0
-                            AND t.is_approved IS true
-                            AND t.is_closed IS NOT true
-                            AND (SELECT count(*)
-                                   FROM current_exchange_routes er
-                                  WHERE er.participant = p.id
-                                    AND network = 'paypal'
-                                    AND error = ''
-                                ) > 0
-                     )
-                SELECT ( SELECT count(*) FROM tippees ) AS nteams
-                     , ( SELECT slug
-                           FROM tippees
-                       ORDER BY amount DESC
-                          LIMIT 1
-                       ) AS top_team
-            """, locals())
-            p.queue_email(
-                'charge_'+e.status,
+            messages.append((e.participant_id, 'charge_'+e.status, dict(
                 exchange=dict(id=e.id, amount=e.amount, fee=e.fee, note=e.note),
-                nteams=nteams,
-                top_team=top_team,
-            )
+                nteams=e.nteams,
+                top_team=e.top_team,
+            )))
+        return Participant.queue_emails(messages)
+
+
+    def gateway_map(self, func, iterable, label, **kw):
+        """Call func on each item in iterable, within our limits for Braintree.
+        """
+        kw.setdefault('threads', self.gateway_threads)
+        kw.setdefault('rate', self.gateway_rate)
+        return threaded_map(func, iterable, label=label, **kw)
+
+
+    @contextmanager
+    def measure(self, stage):
+        """Time a step of payday, and record it in the payday_metrics table.
+
+        The caller can set nrows on the Measurement we yield to the number of
+        rows the step dealt with, and count_gateway_call bumps its ncalls. If
+        payday is restarted, a stage that runs again replaces its earlier row.
+
+        """
+        m = Measurement(stage)
+        self._measurements.append(m)
+        _start = aspen.utils.utcnow()
+        try:
+            yield m
+        finally:
+            self._measurements.pop()
+        _end = aspen.utils.utcnow()
+        self.db.run("""
+            DELETE FROM payday_metrics WHERE payday = %(payday)s AND stage = %(stage)s;
+            INSERT INTO payday_metrics
+                        (payday, stage, ts_start, ts_end, nrows, ncalls)
+                 VALUES (%(payday)s, %(stage)s, %(ts_start)s, %(ts_end)s, %(nrows)s, %(ncalls)s);
+        """, dict( payday=self.id, stage=stage, ts_start=_start, ts_end=_end
+                 , nrows=m.nrows, ncalls=m.ncalls
+                  ))
+        seconds = (_end - _start).total_seconds()
+        log("%s took %.3f seconds; rows: %s, gateway calls: %i."
+            % (stage, seconds, m.nrows, m.ncalls))
+
+
+    def count_gateway_call(self):
+        """Count a call to Braintree against the step we're measuring, if any.
+        """
+        if self._measurements:
+            self._measurements[-1].add_call()
+
+
+    def mark_checkpoint(self, cursor, name):
+        """Note that part of payin is done, so that a restart can skip it.
+        """
+        self.checkpoints = cursor.one("""
+            UPDATE paydays
+               SET checkpoints = array_append(checkpoints, %s)
+             WHERE id = %s
+         RETURNING checkpoints
+        """, (name, self.id))
 
 
     def mark_stage_done(self):
@@ -53,6 +53,7 @@ class TooGreedy(Exception): pass
 class NoSelfTipping(Exception): pass
 class NoTippee(Exception): pass
 class NoTeam(Exception): pass
+class UnapprovedTeam(Exception): pass
 class BadAmount(Exception): pass
 
 class FailedToReserveUsername(Exception): pass
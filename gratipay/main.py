@@ -6,11 +6,13 @@ import gratipay
 import gratipay.wireup
 from gratipay import utils
 from gratipay.cron import Cron
+from gratipay.models import identity_map
 from gratipay.models.participant import Participant
 from gratipay.security import authentication, csrf, security_headers
 from gratipay.utils import erase_cookie, http_caching, i18n, set_cookie, timer
+from gratipay.utils.history import snapshot_balances
 from gratipay.version import get_version
-from gratipay.renderers import csv_dump, jinja2_htmlescaped, eval_
+from gratipay.renderers import csv_dump, jinja2_htmlescaped, eval_, ndjson_dump
 
 import aspen
 from aspen.website import Website
@@ -26,6 +28,7 @@ website.renderer_default = 'unspecified'  # require explicit renderer, to avoid
 
 website.renderer_factories['csv_dump'] = csv_dump.Factory(website)
 website.renderer_factories['eval'] = eval_.Factory(website)
+website.renderer_factories['ndjson_dump'] = ndjson_dump.Factory(website)
 website.renderer_factories['jinja2_htmlescaped'] = jinja2_htmlescaped.Factory(website)
 website.default_renderers_by_media_type['text/html'] = 'jinja2_htmlescaped'
 website.default_renderers_by_media_type['text/plain'] = 'jinja2'  # unescaped is fine here
@@ -66,6 +69,10 @@ website.mailer = gratipay.wireup.mail(env, website.project_root)
 gratipay.wireup.base_url(website, env)
 gratipay.wireup.secure_cookies(env)
 gratipay.wireup.billing(env)
+gratipay.wireup.shared_cache(website, env)
+gratipay.wireup.cache_invalidation(website, env)
+gratipay.wireup.query_cache(website, env)
+gratipay.wireup.session_cache(env)
 gratipay.wireup.team_review(env)
 gratipay.wireup.username_restrictions(website)
 gratipay.wireup.load_i18n(website.project_root, tell_sentry)
@@ -83,7 +90,16 @@ if exc:
 cron = Cron(website)
 cron(env.update_cta_every, lambda: utils.update_cta(website))
 cron(env.check_db_every, website.db.self_check, True)
+cron(env.audit_db_every, lambda: website.db.self_check(full=True), True)
+cron(env.reconcile_counters_every, website.db.reconcile_counters, True)
+cron(env.snapshot_balances_every,
+     lambda: snapshot_balances(website.db, env.snapshot_monthly_balances), True)
 cron(env.dequeue_emails_every, Participant.dequeue_emails, True)
+# Not exclusive: each host has its own cache, and refresh_all only runs once
+# per period on each host.
+cron(env.refresh_shared_cache_every,
+     lambda: website.shared_cache.refresh_all(env.refresh_shared_cache_every))
+cron(env.flush_slow_queries_every, website.db.slow_queries.flush)
 
 
 # Website Algorithm
@@ -94,6 +110,7 @@ algorithm = website.algorithm
 algorithm.functions = [
     timer.start,
     algorithm['parse_environ_into_request'],
+    identity_map.begin,
     algorithm['parse_body_into_request'],
     algorithm['raise_200_for_OPTIONS'],
 
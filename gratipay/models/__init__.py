@@ -8,9 +8,13 @@ everything on Gratipay.
 """
 from contextlib import contextmanager
 
+from aspen import log_dammit
 from postgres import Postgres
 import psycopg2.extras
 
+from gratipay.utils import sql_profiling
+from gratipay.utils.slow_queries import SlowQueryLog
+
 
 @contextmanager
 def just_yield(obj):
@@ -19,22 +23,40 @@ def just_yield(obj):
 
 class GratipayDB(Postgres):
 
+    def __init__(self, *a, **kw):
+        kw.setdefault('cursor_factory', sql_profiling.ProfilingNamedTupleCursor)
+        super(GratipayDB, self).__init__(*a, **kw)
+        self.slow_queries = SlowQueryLog(self)
+
     def get_cursor(self, cursor=None, **kw):
         if cursor:
             if kw:
                 raise ValueError('cannot change options when reusing a cursor')
             return just_yield(cursor)
+        if kw.get('back_as') in sql_profiling.CURSORS and 'cursor_factory' not in kw:
+            kw['cursor_factory'] = sql_profiling.CURSORS[kw.pop('back_as')]
         return super(GratipayDB, self).get_cursor(**kw)
 
-    def self_check(self):
+    def self_check(self, full=False):
         with self.get_cursor() as cursor:
-            check_db(cursor)
+            check_db(cursor, full)
 
+    def reconcile_counters(self):
+        with self.get_cursor() as cursor:
+            return reconcile_counters(cursor)
 
-def check_db(cursor):
+
+def check_db(cursor, full=False):
     """Runs all available self checks on the given cursor.
+
+    Balances are checked against the whole ledger if full is True, and only
+    against what was added to it since the last check otherwise.
     """
-    _check_balances(cursor)
+    if full:
+        _check_balances(cursor)
+        _check_current_ids(cursor)
+    else:
+        _check_balances_incrementally(cursor)
     _check_no_team_balances(cursor)
     _check_tips(cursor)
     _check_orphans(cursor)
@@ -119,6 +141,172 @@ def _check_balances(cursor):
     """)
     assert len(b) == 0, "conflicting balances: {}".format(b)
 
+# Rows of (username, timestamp, amount) for each change to a participant's
+# balance. The placeholders are for conditions on the id of each table.
+LEDGER = """
+
+        SELECT participant AS username, timestamp, amount AS a
+          FROM exchanges
+         WHERE amount > 0
+           AND (status is null or status = 'succeeded')
+           AND {exchanges}
+
+     UNION ALL
+
+        SELECT participant AS username, timestamp, amount-fee AS a
+          FROM exchanges
+         WHERE amount < 0
+           AND (status is null or status <> 'failed')
+           AND {exchanges}
+
+     UNION ALL
+
+        SELECT tipper AS username, timestamp, -amount AS a
+          FROM transfers
+         WHERE {transfers}
+
+     UNION ALL
+
+        SELECT tippee AS username, timestamp, amount AS a
+          FROM transfers
+         WHERE {transfers}
+
+     UNION ALL
+
+        SELECT participant AS username, timestamp, amount AS a
+          FROM payments
+         WHERE direction='to-participant'
+           AND {payments}
+
+     UNION ALL
+
+        SELECT participant AS username, timestamp, -amount AS a
+          FROM payments
+         WHERE direction='to-team'
+           AND {payments}
+
+"""
+
+LEDGER_CHECKPOINT_LOCK = 0x6c6564676572  # for pg_advisory_xact_lock
+
+
+def _check_balances_incrementally(cursor):
+    """
+    Checks balances against the ledger rows added since the last check.
+
+    balance_checkpoints holds each participant's balance as of the ledger ids
+    in the latest row of ledger_checkpoints, so we only need to sum the rows
+    after those. A balance that doesn't add up is checked again against the
+    participant's whole history before we complain, because a ledger row can
+    commit after a later one was checkpointed, and exchanges change status.
+    Use _check_balances for a full audit.
+    """
+    cursor.run("SELECT pg_advisory_xact_lock(%s)", (LEDGER_CHECKPOINT_LOCK,))
+    last = cursor.one("""
+        SELECT exchanges, transfers, payments
+          FROM ledger_checkpoints
+      ORDER BY id DESC
+         LIMIT 1
+    """, default=(0, 0, 0))
+    hwm = cursor.one("""
+        SELECT (SELECT coalesce(max(id), 0) FROM exchanges) AS exchanges
+             , (SELECT coalesce(max(id), 0) FROM transfers) AS transfers
+             , (SELECT coalesce(max(id), 0) FROM payments) AS payments
+    """)
+    ranges = dict( exchanges='id > %s AND id <= %s' % (last[0], hwm.exchanges)
+                 , transfers='id > %s AND id <= %s' % (last[1], hwm.transfers)
+                 , payments='id > %s AND id <= %s' % (last[2], hwm.payments)
+                  )
+
+    # Participants with new ledger rows, or whose balance moved without any.
+    b = cursor.all("""
+        WITH deltas AS (
+                SELECT username, sum(a) AS delta
+                  FROM ( {} ) AS foo
+              GROUP BY username
+             )
+        SELECT p.id
+             , p.username
+             , coalesce(c.balance, 0) + coalesce(d.delta, 0) AS expected
+             , p.balance AS actual
+          FROM participants p
+     LEFT JOIN balance_checkpoints c ON c.participant = p.id
+     LEFT JOIN deltas d ON d.username = p.username
+         WHERE d.username IS NOT NULL
+            OR p.balance <> coalesce(c.balance, 0)
+    """.format(LEDGER.format(**ranges)))
+    checkpoints = dict((r.id, r.expected) for r in b)
+
+    mismatched = [r.username for r in b if r.expected != r.actual]
+    if mismatched:
+        sum_ledger = "SELECT sum(a) FROM ( {} ) AS foo WHERE username = p.username"
+        upto = dict( exchanges='id <= %s' % hwm.exchanges
+                   , transfers='id <= %s' % hwm.transfers
+                   , payments='id <= %s' % hwm.payments
+                    )
+        rechecked = cursor.all("""
+            SELECT p.id
+                 , p.username
+                 , coalesce(({}), 0) AS checkpoint
+                 , ({}) AS expected
+                 , p.balance AS actual
+              FROM participants p
+             WHERE p.username = ANY(%s)
+        """.format( sum_ledger.format(LEDGER.format(**upto))
+                  , sum_ledger.format(LEDGER.format(exchanges='true', transfers='true', payments='true'))
+                   ), (mismatched,))
+        # Like _check_balances, we don't check participants with no ledger at
+        # all, we take their balance as it is.
+        b = [r for r in rechecked if r.expected is not None and r.expected != r.actual]
+        assert len(b) == 0, "conflicting balances: {}".format(b)
+        checkpoints.update( (r.id, r.checkpoint if r.expected is not None else r.actual)
+                            for r in rechecked
+                           )
+
+    if checkpoints:
+        ids, balances = zip(*checkpoints.items())
+        cursor.run("""
+            DELETE FROM balance_checkpoints WHERE participant = ANY(%(ids)s);
+            INSERT INTO balance_checkpoints (participant, balance)
+                 SELECT unnest(%(ids)s::bigint[]), unnest(%(balances)s::numeric[]);
+        """, dict(ids=list(ids), balances=list(balances)))
+    if tuple(last) != (hwm.exchanges, hwm.transfers, hwm.payments):
+        cursor.run("""
+            INSERT INTO ledger_checkpoints (exchanges, transfers, payments)
+                 VALUES (%s, %s, %s)
+        """, tuple(hwm))
+
+
+# The tables that triggers keep pointed at the latest row of each pair in a
+# history table, and how history is ordered, latest first.
+CURRENT_IDS = [ ('current_tip_ids', 'tips', 'tipper', 'tippee', 'mtime DESC, id DESC')
+              , ('current_take_ids', 'takes', 'member', 'team', 'mtime DESC, id DESC')
+              , ( 'current_payment_instruction_ids', 'payment_instructions'
+                , 'participant', 'team', 'mtime DESC, id DESC'
+                 )
+              , ('current_exchange_route_ids', 'exchange_routes', 'participant', 'network', 'id DESC')
+               ]
+
+
+def _check_current_ids(cursor):
+    """
+    Checks that the current_*_ids tables agree with the history they index.
+    This sorts all of history, so it only runs in a full audit.
+    """
+    for table, history, a, b, ordering in CURRENT_IDS:
+        bad = cursor.all("""
+            WITH expected AS (
+                    SELECT DISTINCT ON ({a}, {b}) {a}, {b}, id
+                      FROM {history}
+                  ORDER BY {a}, {b}, {ordering}
+                 )
+            (SELECT * FROM expected EXCEPT SELECT {a}, {b}, id FROM {table})
+             UNION ALL
+            (SELECT {a}, {b}, id FROM {table} EXCEPT SELECT * FROM expected)
+        """.format(table=table, history=history, a=a, b=b, ordering=ordering))
+        assert len(bad) == 0, "{} is out of sync: {}".format(table, bad)
+
+
 def _check_no_team_balances(cursor):
     if cursor.one("select exists (select * from paydays where ts_end < ts_start) as running"):
         # payday is running
@@ -192,6 +380,94 @@ def _check_orphans_no_tips(cursor):
     assert len(orphans_with_tips) == 0, orphans_with_tips
 
 
+# Triggers keep teams.receiving and participants.taking up to date by applying
+# deltas (see sql/branch.sql). These find where they've drifted from what they
+# would be if we aggregated everything.
+DRIFTED_RECEIVING = """
+    SELECT t.slug
+         , t.receiving
+         , t.nreceiving_from
+         , COALESCE(sum(cpi.amount), 0) AS expected_receiving
+         , count(cpi.amount) AS expected_nreceiving_from
+      FROM teams t
+ LEFT JOIN ( current_payment_instructions cpi
+             JOIN participants p ON p.username = cpi.participant
+                                AND p.is_suspicious IS NOT true
+            ) ON cpi.team = t.slug
+             AND cpi.amount > 0
+             AND cpi.is_funded
+     WHERE {}
+  GROUP BY t.slug, t.receiving, t.nreceiving_from, t.distributing
+    HAVING (t.receiving, t.nreceiving_from, t.distributing)
+           <> (COALESCE(sum(cpi.amount), 0), count(cpi.amount), COALESCE(sum(cpi.amount), 0))
+"""
+
+DRIFTED_TAKING = """
+    SELECT p.username
+         , p.taking
+         , p.ntaking_from
+         , COALESCE(sum(t.receiving), 0) AS expected_taking
+         , count(t.id) AS expected_ntaking_from
+      FROM participants p
+ LEFT JOIN teams t ON t.owner = p.username
+     WHERE {}
+  GROUP BY p.username, p.taking, p.ntaking_from
+    HAVING (p.taking, p.ntaking_from) <> (COALESCE(sum(t.receiving), 0), count(t.id))
+"""
+
+
+def reconcile_counters(cursor):
+    """
+    Fixes teams' receiving and participants' taking wherever they've drifted,
+    logs what was fixed, and returns it as two lists, for teams and for
+    participants.
+
+    Rows are locked before they're recomputed, so that we don't clobber a
+    delta applied by a transaction that commits in the meantime.
+    """
+    teams = [r.slug for r in cursor.all(DRIFTED_RECEIVING.format('true'))]
+    if teams:
+        cursor.run("SELECT 1 FROM teams WHERE slug = ANY(%s) ORDER BY slug FOR UPDATE", (teams,))
+        teams = cursor.all("""
+            UPDATE teams t
+               SET receiving = d.expected_receiving
+                 , nreceiving_from = d.expected_nreceiving_from
+                 , distributing = d.expected_receiving
+                 , ndistributing_to = 1
+              FROM ({}) d
+             WHERE t.slug = d.slug
+         RETURNING d.*
+        """.format(DRIFTED_RECEIVING.format('t.slug = ANY(%(teams)s)')), dict(teams=teams))
+
+    # Fixing receiving fixes its owner's taking along with it, so we look for
+    # drift in taking second.
+    participants = [r.username for r in cursor.all(DRIFTED_TAKING.format('true'))]
+    if participants:
+        cursor.run( "SELECT 1 FROM participants WHERE username = ANY(%s) ORDER BY username "
+                    "FOR UPDATE"
+                  , (participants,)
+                   )
+        participants = cursor.all("""
+            UPDATE participants p
+               SET taking = d.expected_taking
+                 , ntaking_from = d.expected_ntaking_from
+              FROM ({}) d
+             WHERE p.username = d.username
+         RETURNING d.*
+        """.format(DRIFTED_TAKING.format('p.username = ANY(%(participants)s)')),
+                  dict(participants=participants))
+
+    for r in teams:
+        log_dammit("Fixed drift in receiving for team {}: {} from {} -> {} from {}".format(
+            r.slug, r.receiving, r.nreceiving_from, r.expected_receiving, r.expected_nreceiving_from
+        ))
+    for r in participants:
+        log_dammit("Fixed drift in taking for ~{}: {} from {} -> {} from {}".format(
+            r.username, r.taking, r.ntaking_from, r.expected_taking, r.expected_ntaking_from
+        ))
+    return teams, participants
+
+
 def add_event(c, type, payload):
     SQL = """
         INSERT INTO events (type, payload)
@@ -3,10 +3,13 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import braintree
 from postgres.orm import Model
 
+from gratipay.models import identity_map
+
 
 class ExchangeRoute(Model):
 
     typname = "exchange_routes"
+    identity_keys = ('id',)  # see identity_map
 
     def __bool__(self):
         return self.error != 'invalidated'
@@ -27,16 +30,18 @@ class ExchangeRoute(Model):
 
     @classmethod
     def from_network(cls, participant, network):
-        participant_id = participant.id
-        r = cls.db.one("""
-            SELECT r.*::exchange_routes
-              FROM current_exchange_routes r
-             WHERE participant = %(participant_id)s
-               AND network = %(network)s
-        """, locals())
-        if r:
-            r.set_attributes(participant=participant)
-        return r
+        def load():
+            r = cls.db.one("""
+                SELECT r.*::exchange_routes
+                  FROM current_exchange_routes r
+                 WHERE participant = %s
+                   AND network = %s
+            """, (participant.id, network))
+            if r:
+                r.set_attributes(participant=participant)
+            return r
+        return identity_map.load(cls, 'network', (participant.id, network), load,
+                                 cache_misses=True)
 
     @classmethod
     def from_address(cls, participant, network, address):
@@ -61,6 +66,7 @@ class ExchangeRoute(Model):
                  VALUES (%(participant_id)s, %(network)s, %(address)s, %(error)s, %(fee_cap)s)
               RETURNING exchange_routes.*::exchange_routes
         """, locals())
+        identity_map.forget(cls, 'network', (participant_id, network))
         if network == 'braintree-cc':
             participant.update_giving_and_teams()
         r.set_attributes(participant=participant)
@@ -75,6 +81,7 @@ class ExchangeRoute(Model):
         if self.network == 'paypal':
             # XXX This doesn't sound right. Doesn't this corrupt history pages?
             self.db.run("DELETE FROM exchange_routes WHERE id=%s", (self.id,))
+            identity_map.forget(ExchangeRoute, 'network', (self.participant.id, self.network))
         else:
             self.update_error('invalidated')
 
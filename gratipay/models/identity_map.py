@@ -0,0 +1,112 @@
+"""Load each participant, team and exchange route at most once per request.
+
+A page asks for the same few objects over and over: Participant.from_username
+for the page and for the user, ExchangeRoute.from_network from each of
+get_paypal_error, get_credit_card_error, has_payout_route and friends. While an
+IdentityMap is active on the current thread, those loaders go through it, so
+each object is loaded once and then handed back as is. An object loaded one
+way (from_session_token, say) is also what's handed back when it's asked for
+another way (from_username), so there's only ever one copy of it to update.
+
+We only map GET and HEAD requests (see begin), since a request that writes
+may well expect to read back what it wrote. The map is thrown away at
+timer.end, which logs how many queries it saved.
+
+To use one outside of a request::
+
+    with mapping() as identity:
+        do_something()
+    print(identity.hits)
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+from contextlib import contextmanager
+
+
+_local = threading.local()
+MISSING = object()
+
+
+class IdentityMap(object):
+
+    def __init__(self):
+        self.objects = {}   # (class name, key, value) -> object, or None for a miss
+        self.hits = 0       # how many loads we answered without a query
+
+    def load(self, cls, key, value, loader, cache_misses=False):
+        k = (cls.__name__, key, value)
+        obj = self.objects.get(k, MISSING)
+        if obj is not MISSING:
+            self.hits += 1
+            return obj
+        obj = loader()
+        if obj is None:
+            if cache_misses:
+                self.objects[k] = None
+            return None
+        identity_keys = getattr(cls, 'identity_keys', ())
+        for ident in identity_keys:
+            existing = self.objects.get((cls.__name__, ident, getattr(obj, ident)))
+            if existing is not None:
+                obj = existing  # We already had it, loaded some other way.
+                break
+        self.objects[k] = obj
+        for ident in identity_keys:
+            self.objects[(cls.__name__, ident, getattr(obj, ident))] = obj
+        return obj
+
+    def forget(self, cls, key, value):
+        self.objects.pop((cls.__name__, key, value), None)
+
+
+def start():
+    """Start an identity map for this thread, and return it.
+    """
+    _local.map = IdentityMap()
+    return _local.map
+
+
+def stop():
+    """Stop mapping for this thread, and return the map (or None).
+    """
+    identity = getattr(_local, 'map', None)
+    _local.map = None
+    return identity
+
+
+@contextmanager
+def mapping():
+    identity = start()
+    try:
+        yield identity
+    finally:
+        stop()
+
+
+def begin(request):
+    """Map this request if it only reads.
+    """
+    if request.method in ('GET', 'HEAD'):
+        start()
+    else:
+        stop()
+
+
+def load(cls, key, value, loader, cache_misses=False):
+    """Return what loader returns, or what it returned the last time we were
+    asked for cls by key and value while mapping.
+    """
+    identity = getattr(_local, 'map', None)
+    if identity is None:
+        return loader()
+    return identity.load(cls, key, value, loader, cache_misses)
+
+
+def forget(cls, key, value):
+    """Forget what we loaded for cls by key and value, after it changed.
+    """
+    identity = getattr(_local, 'map', None)
+    if identity is not None:
+        identity.forget(cls, key, value)
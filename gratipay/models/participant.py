@@ -4,8 +4,8 @@ from __future__ import print_function, unicode_literals
 
 from datetime import timedelta
 from decimal import Decimal
+from multiprocessing.dummy import Pool as ThreadPool
 import pickle
-from time import sleep
 from urllib import quote
 import uuid
 
@@ -15,7 +15,7 @@ import braintree
 from dependency_injection import resolve_dependencies
 from markupsafe import escape as htmlescape
 from postgres.orm import Model
-from psycopg2 import IntegrityError
+from psycopg2 import Binary, IntegrityError
 
 import gratipay
 from gratipay import NotSane
@@ -26,6 +26,7 @@ from gratipay.exceptions import (
     UsernameIsRestricted,
     UsernameAlreadyTaken,
     NoTeam,
+    UnapprovedTeam,
     BadAmount,
     EmailAlreadyTaken,
     CannotRemovePrimaryEmail,
@@ -33,11 +34,12 @@ from gratipay.exceptions import (
     TooManyEmailAddresses,
 )
 
-from gratipay.models import add_event
+from gratipay.models import add_event, identity_map
 from gratipay.models.account_elsewhere import AccountElsewhere
 from gratipay.models.exchange_route import ExchangeRoute
 from gratipay.models.team import Team
 from gratipay.security.crypto import constant_time_compare
+from gratipay.security.session_cache import SessionCache
 from gratipay.utils import i18n, is_card_expiring, emails, notifications, pricing
 from gratipay.utils.username import safely_reserve_a_username
 
@@ -52,11 +54,26 @@ EMAIL_HASH_TIMEOUT = timedelta(hours=24)
 
 USERNAME_MAX_SIZE = 32
 
+# The columns that the set_payment_instruction function returns for the new
+# instruction, and for the team it's to.
+PAYMENT_INSTRUCTION = ('id', 'ctime', 'mtime', 'participant', 'team', 'amount', 'is_funded', 'due')
+TEAM_RECEIVING = ('receiving', 'nreceiving_from', 'distributing', 'ndistributing_to')
+
 class Participant(Model):
     """Represent a Gratipay participant.
     """
 
     typname = 'participants'
+    identity_keys = ('id', 'username_lower')  # see identity_map
+
+    # These are set in wireup.mail.
+    _email_transport = None
+    email_batch_size = 100
+    email_render_threads = 4
+    _skip_locked = None  # set by claim_emails, once per process
+
+    # This is set in wireup.session_cache.
+    session_cache = SessionCache()
 
     def __eq__(self, other):
         if not isinstance(other, Participant):
@@ -98,8 +115,16 @@ class Participant(Model):
     @classmethod
     def from_session_token(cls, token):
         """Return an existing participant based on session token.
+
+        Recent sessions are kept in session_cache for a few seconds.
+
         """
-        participant = cls._from_thing("session_token", token)
+        cached = cls.session_cache.get(token)
+        if cached is not None:
+            participant = identity_map.load(cls, "session_token", token, lambda: cached)
+        else:
+            participant = cls._from_thing("session_token", token)
+            cls.session_cache.add(token, participant)
         if participant and participant.session_expires < utcnow():
             participant = None
 
@@ -108,13 +133,13 @@ class Participant(Model):
     @classmethod
     def _from_thing(cls, thing, value):
         assert thing in ("id", "username_lower", "session_token", "api_key")
-        return cls.db.one("""
+        return identity_map.load(cls, thing, value, lambda: cls.db.one("""
 
             SELECT participants.*::participants
               FROM participants
              WHERE {}=%s
 
-        """.format(thing), (value,))
+        """.format(thing), (value,)))
 
 
     # Session Management
@@ -126,6 +151,7 @@ class Participant(Model):
         :database: One UPDATE, one row
 
         """
+        self.session_cache.forget(self.session_token)
         self.db.run("""
             UPDATE participants
                SET session_token=%s
@@ -146,6 +172,7 @@ class Participant(Model):
                    , (expires, self.id,)
                     )
         self.set_attributes(session_expires=expires)
+        self.session_cache.extend(self.session_token, expires)
 
 
     # Suspiciousness
@@ -523,6 +550,16 @@ class Participant(Model):
                   (self.username, address))
 
     def send_email(self, spt_name, **context):
+        message = self.render_email(spt_name, **context)
+        if message is None:
+            return 0 # Not Sent
+        self._mailer.messages.send(message=message)
+        return 1 # Sent
+
+    def render_email(self, spt_name, **context):
+        """Render an email to this participant. Returns a message dict ready to
+        be sent, or ``None`` if we don't have an address to send it to.
+        """
         context['participant'] = self
         context['username'] = self.username
         context['button_style'] = (
@@ -533,7 +570,7 @@ class Participant(Model):
         context.setdefault('include_unsubscribe', True)
         email = context.setdefault('email', self.email_address)
         if not email:
-            return 0 # Not Sent
+            return None
         langs = i18n.parse_accept_lang(self.email_lang or 'en')
         locale = i18n.match_lang(langs)
         i18n.add_helpers_to_context(self._tell_sentry, context, locale)
@@ -553,9 +590,7 @@ class Participant(Model):
         message['subject'] = spt['subject'].render(context)
         message['html'] = render('text/html', context_html)
         message['text'] = render('text/plain', context)
-
-        self._mailer.messages.send(message=message)
-        return 1 # Sent
+        return message
 
     def queue_email(self, spt_name, **context):
         self.db.run("""
@@ -564,24 +599,114 @@ class Participant(Model):
                  VALUES (%s, %s, %s)
         """, (self.id, spt_name, pickle.dumps(context)))
 
+    @classmethod
+    def queue_emails(cls, messages):
+        """Queue many emails with a single INSERT. Returns the number queued.
+
+        :param messages: an iterable of ``(participant_id, spt_name, context)``
+            tuples, where ``context`` is a dict like the keyword arguments to
+            :py:meth:`queue_email`
+
+        """
+        participants, spt_names, contexts = [], [], []
+        for participant_id, spt_name, context in messages:
+            participants.append(participant_id)
+            spt_names.append(spt_name)
+            contexts.append(Binary(pickle.dumps(context)))
+        if not participants:
+            return 0
+        cls.db.run("""
+            INSERT INTO email_queue
+                        (participant, spt_name, context)
+                 SELECT unnest(%s::bigint[]), unnest(%s::text[]), unnest(%s::bytea[])
+        """, (participants, spt_names, contexts))
+        return len(participants)
+
+    @classmethod
+    def claim_emails(cls, n, lease=600):
+        """Claim up to n queued emails for ``lease`` seconds.
+
+        Claimed rows are skipped by other workers until the lease runs out, so
+        several processes can work through the queue at once. A worker that
+        dies mid-batch leaves its rows to be picked up again once their lease
+        expires.
+
+        """
+        # SKIP LOCKED is new in Postgres 9.5. Without it a worker waits for
+        # rows being claimed by another, then passes over them. The server
+        # won't change under us, so we only ask for its version once.
+        if Participant._skip_locked is None:
+            server_version = int(cls.db.one("SHOW server_version_num"))
+            Participant._skip_locked = ' SKIP LOCKED' if server_version >= 90500 else ''
+        return cls.db.all("""
+            UPDATE email_queue q
+               SET claimed_until = now() + %s * interval '1 second'
+              FROM ( SELECT id
+                       FROM email_queue
+                      WHERE claimed_until IS NULL
+                         OR claimed_until < now()
+                   ORDER BY id
+                      LIMIT %s
+                        FOR UPDATE{}
+                   ) c
+             WHERE q.id = c.id
+         RETURNING q.*
+        """.format(cls._skip_locked), (lease, n))
+
     @classmethod
     def dequeue_emails(cls):
-        fetch_messages = lambda: cls.db.all("""
-            SELECT *
-              FROM email_queue
-          ORDER BY id ASC
-             LIMIT 60
-        """)
+        """Send queued emails, a batch at a time, until the queue is empty.
+
+        For each batch we load the participants in one query, render the
+        messages on a thread pool, hand them to ``_email_transport`` together,
+        and delete the rows that are done in one statement. Messages that fail
+        to render or send stay in the queue to be retried after their lease.
+        Messages for participants who no longer exist are dropped.
+
+        """
         while True:
-            messages = fetch_messages()
+            messages = cls.claim_emails(cls.email_batch_size)
             if not messages:
                 break
-            for msg in messages:
-                p = cls.from_id(msg.participant)
-                r = p.send_email(msg.spt_name, **pickle.loads(msg.context))
-                cls.db.run("DELETE FROM email_queue WHERE id = %s", (msg.id,))
-                if r == 1:
-                    sleep(1)
+            participants = dict((p.id, p) for p in cls.db.all("""
+                SELECT p.*::participants
+                  FROM participants p
+                 WHERE p.id = ANY(%s)
+            """, (list(set(msg.participant for msg in messages)),)))
+
+            def render(msg):
+                p = participants.get(msg.participant)
+                if p is None:
+                    return None, None  # The participant is gone, drop it
+                try:
+                    return p.render_email(msg.spt_name, **pickle.loads(msg.context)), None
+                except Exception as e:
+                    return None, e
+            pool = ThreadPool(cls.email_render_threads)
+            try:
+                rendered = pool.map(render, messages)
+            finally:
+                pool.close()
+
+            done, failed, to_send = [], [], []
+            for msg, (message, error) in zip(messages, rendered):
+                if error is not None:
+                    failed.append(error)
+                elif message is None:
+                    done.append(msg.id)  # No participant or address, nothing to send
+                else:
+                    to_send.append((msg, message))
+            errors = cls._email_transport.send([message for msg, message in to_send])
+            for (msg, message), error in zip(to_send, errors):
+                if error is None:
+                    done.append(msg.id)
+                else:
+                    failed.append(error)
+
+            if done:
+                cls.db.run("DELETE FROM email_queue WHERE id = ANY(%s)", (done,))
+            for error in failed:
+                cls._tell_sentry(error, {})
 
     def set_email_lang(self, accept_lang):
         if not accept_lang:
@@ -812,8 +937,7 @@ class Participant(Model):
     # Giving and Taking
     # =================
 
-    def set_payment_instruction(self, team, amount, update_self=True, update_team=True,
-                                                                                      cursor=None):
+    def set_payment_instruction(self, team, amount, update_self=True, cursor=None):
         """Given a Team or slug, and amount as str, returns a dict.
 
         We INSERT instead of UPDATE, so that we have history to explore. The
@@ -825,50 +949,89 @@ class Participant(Model):
         The dict returned represents the row inserted in the payment_instructions
         table.
 
+        Everything that depends on the new instruction is updated along with it
+        by the set_payment_instruction function in the database, in one round
+        trip: our giving (and the due carried over from earlier instructions)
+        if update_self, and whether we're a free rider if the team is Gratipay.
+        The team's receiving and its owner's taking are kept up to date by
+        triggers.
+
         """
         assert self.is_claimed  # sanity check
 
-        if not isinstance(team, Team):
-            team, slug = Team.from_slug(team), team
-            if not team:
-                raise NoTeam(slug)
+        slug = team.slug if isinstance(team, Team) else team
 
         amount = Decimal(amount)  # May raise InvalidOperation
         if (amount < gratipay.MIN_PAYMENT) or (amount > gratipay.MAX_PAYMENT):
             raise BadAmount
 
-        # Insert payment instruction
-        NEW_PAYMENT_INSTRUCTION = """\
+        r = (cursor or self.db).one("""
+            SELECT * FROM set_payment_instruction(%s, %s, %s, %s)
+        """, (self.username, slug, amount, update_self))
+        if r is None:
+            raise NoTeam(slug)
+        r = r._asdict()
 
-            INSERT INTO payment_instructions
-                        (ctime, participant, team, amount)
-                 VALUES ( COALESCE (( SELECT ctime
-                                        FROM payment_instructions
-                                       WHERE (participant=%(participant)s AND team=%(team)s)
-                                       LIMIT 1
-                                      ), CURRENT_TIMESTAMP)
-                        , %(participant)s, %(team)s, %(amount)s
-                         )
-              RETURNING *
+        if update_self:
+            self.set_attributes(giving=r['giving'], ngiving_to=r['ngiving_to'])
+        if slug == 'Gratipay':
+            self.set_attributes(is_free_rider=r['is_free_rider'])
+        if r['owner'] == self.username:
+            self.set_attributes(taking=r['taking'], ntaking_from=r['ntaking_from'])
+        if isinstance(team, Team):
+            team.set_attributes(**dict((k, r[k]) for k in TEAM_RECEIVING))
 
-        """
-        args = dict(participant=self.username, team=team.slug, amount=amount)
-        t = (cursor or self.db).one(NEW_PAYMENT_INSTRUCTION, args)
-        t_dict = t._asdict()
+        return dict((k, r[k]) for k in PAYMENT_INSTRUCTION)
 
-        if update_self:
-            # Update giving amount of participant
-            self.update_giving(cursor)
-            # Carry over any existing due
-            self.update_due(t_dict['team'], t_dict['id'], cursor)
-        if update_team:
-            # Update receiving amount of team
-            team.update_receiving(cursor)
-        if team.slug == 'Gratipay':
-            # Update whether the participant is using Gratipay for free
-            self.update_is_free_rider(None if amount == 0 else False, cursor)
 
-        return t._asdict()
+    @classmethod
+    def set_payment_instructions(cls, instructions, update_givers=True, cursor=None):
+        """Given an iterable of (username, slug, amount) tuples, returns a list of dicts.
+
+        This is set_payment_instruction for many instructions at once, for
+        migrations, admin corrections and API clients. Everything is inserted
+        in one transaction, and giving is recomputed once per participant
+        affected rather than once per instruction (receiving and taking are
+        kept up to date by triggers). When the same participant and team come
+        up more than once the last instruction wins.
+
+        The dicts returned represent the rows inserted in the
+        payment_instructions table, in the order given.
+
+        """
+        participants, teams, amounts = [], [], []
+        for username, team, amount in instructions:
+            amount = Decimal(amount)  # May raise InvalidOperation
+            if (amount < gratipay.MIN_PAYMENT) or (amount > gratipay.MAX_PAYMENT):
+                raise BadAmount
+            participants.append(username)
+            teams.append(team.slug if isinstance(team, Team) else team)
+            amounts.append(amount)
+        if not participants:
+            return []
+
+        db = cursor or cls.db
+        unknown = db.all("SELECT unnest(%s) EXCEPT SELECT slug FROM teams", (teams,))
+        if unknown:
+            raise NoTeam(unknown[0])
+        unapproved = db.all("""
+            SELECT unnest(%s)
+            EXCEPT
+            SELECT slug FROM teams WHERE is_approved AND NOT is_closed
+        """, (teams,))
+        if unapproved:
+            raise UnapprovedTeam(unapproved[0])
+        unclaimed = db.all("""
+            SELECT unnest(%s)
+            EXCEPT
+            SELECT username FROM participants WHERE claimed_time IS NOT NULL
+        """, (participants,))
+        assert not unclaimed, unclaimed  # sanity check
+
+        rows = db.all("""
+            SELECT * FROM set_payment_instructions(%s, %s, %s::numeric[], %s)
+        """, (participants, teams, amounts, update_givers))
+        return [dict((k, getattr(r, k)) for k in PAYMENT_INSTRUCTION) for r in rows]
 
 
     def get_payment_instruction(self, team):
@@ -967,10 +1130,9 @@ class Participant(Model):
 
 
     def update_giving_and_teams(self):
+        # Teams' receiving follows along by trigger, as instructions are funded.
         with self.db.get_cursor() as cursor:
-            updated_giving = self.update_giving(cursor)
-            for payment_instruction in updated_giving:
-                Team.from_slug(payment_instruction.team).update_receiving(cursor)
+            self.update_giving(cursor)
 
 
     def update_giving(self, cursor=None):
@@ -1005,43 +1167,6 @@ class Participant(Model):
 
         return updated
 
-    def update_due(self, team, id, cursor=None):
-        """Transfer existing due value to newly inserted record
-        """
-        # Copy due to new record
-        (cursor or self.db).run("""
-            UPDATE payment_instructions p
-               SET due = COALESCE((
-                      SELECT due
-                        FROM payment_instructions s
-                       WHERE participant=%(username)s
-                         AND team = %(team)s
-                         AND due > 0
-                   ), 0)
-             WHERE p.id = %(id)s
-        """, dict(username=self.username,team=team,id=id))
-
-        # Reset older due values to 0
-        (cursor or self.db).run("""
-            UPDATE payment_instructions p
-               SET due = 0
-             WHERE participant = %(username)s
-               AND team = %(team)s
-               AND due > 0
-               AND p.id != %(id)s
-        """, dict(username=self.username,team=team,id=id))
-
-    def update_taking(self, cursor=None):
-        (cursor or self.db).run("""
-
-            UPDATE participants
-               SET taking=COALESCE((SELECT sum(receiving) FROM teams WHERE owner=%(username)s), 0)
-                 , ntaking_from=COALESCE((SELECT count(*) FROM teams WHERE owner=%(username)s), 0)
-             WHERE username=%(username)s
-
-        """, dict(username=self.username))
-
-
     def update_is_free_rider(self, is_free_rider, cursor=None):
         with self.db.get_cursor(cursor) as cursor:
             cursor.run( "UPDATE participants SET is_free_rider=%(is_free_rider)s "
@@ -1279,11 +1404,24 @@ class Participant(Model):
 
         CREATE TEMP TABLE __temp_unique_tips ON COMMIT drop AS
 
-            -- Get all the latest tips from everyone to everyone.
+            -- Get the latest tips from and to the dead and live accounts.
+            -- We go through current_tip_ids so that both halves are index
+            -- lookups, however many tips there are on the site.
+
+            SELECT t.ctime, t.tipper, t.tippee, t.amount, t.is_funded
+              FROM current_tip_ids c
+              JOIN tips t ON t.id = c.id
+             WHERE c.tipper IN (%(dead)s, %(live)s)
+               AND t.amount > 0
+
+         UNION ALL
 
-            SELECT ctime, tipper, tippee, amount, is_funded
-              FROM current_tips
-             WHERE amount > 0;
+            SELECT t.ctime, t.tipper, t.tippee, t.amount, t.is_funded
+              FROM current_tip_ids c
+              JOIN tips t ON t.id = c.id
+             WHERE c.tippee IN (%(dead)s, %(live)s)
+               AND c.tipper NOT IN (%(dead)s, %(live)s)
+               AND t.amount > 0;
 
         """
 
@@ -1506,7 +1644,7 @@ class Participant(Model):
                 # ===============
 
                 x, y = self.username, other.username
-                cursor.run(CREATE_TEMP_TABLE_FOR_UNIQUE_TIPS)
+                cursor.run(CREATE_TEMP_TABLE_FOR_UNIQUE_TIPS, dict(live=x, dead=y))
                 cursor.run(CONSOLIDATE_TIPS_RECEIVING, dict(live=x, dead=y))
                 cursor.run(CONSOLIDATE_TIPS_GIVING, dict(live=x, dead=y))
                 cursor.run(ZERO_OUT_OLD_TIPS_RECEIVING, (other.username,))
@@ -1557,8 +1695,6 @@ class Participant(Model):
 
         self.update_avatar()
 
-        # Note: the order ... doesn't actually matter here.
-        self.update_taking()
         self.update_giving()
 
     def to_dict(self, details=False, inquirer=None):
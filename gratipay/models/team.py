@@ -2,7 +2,7 @@
 """
 import requests
 from aspen import json, log
-from gratipay.models import add_event
+from gratipay.models import add_event, identity_map
 from postgres.orm import Model
 
 
@@ -11,6 +11,7 @@ class Team(Model):
     """
 
     typname = 'teams'
+    identity_keys = ('id', 'slug_lower')  # see identity_map
 
     def __eq__(self, other):
         if not isinstance(other, Team):
@@ -41,13 +42,13 @@ class Team(Model):
     @classmethod
     def _from_thing(cls, thing, value):
         assert thing in ("id", "slug_lower")
-        return cls.db.one("""
+        return identity_map.load(cls, thing, value, lambda: cls.db.one("""
 
             SELECT teams.*::teams
               FROM teams
              WHERE {}=%s
 
-        """.format(thing), (value,))
+        """.format(thing), (value,)))
 
     @classmethod
     def insert(cls, owner, **fields):
@@ -106,37 +107,6 @@ class Team(Model):
         return out + " on Gratipay"
 
 
-    def update_receiving(self, cursor=None):
-        r = (cursor or self.db).one("""
-            WITH our_receiving AS (
-                     SELECT amount
-                       FROM current_payment_instructions
-                       JOIN participants p ON p.username = participant
-                      WHERE team = %(slug)s
-                        AND p.is_suspicious IS NOT true
-                        AND amount > 0
-                        AND is_funded
-                 )
-            UPDATE teams t
-               SET receiving = COALESCE((SELECT sum(amount) FROM our_receiving), 0)
-                 , nreceiving_from = COALESCE((SELECT count(*) FROM our_receiving), 0)
-                 , distributing = COALESCE((SELECT sum(amount) FROM our_receiving), 0)
-                 , ndistributing_to = 1
-             WHERE t.slug = %(slug)s
-         RETURNING receiving, nreceiving_from, distributing, ndistributing_to
-        """, dict(slug=self.slug))
-
-
-        # This next step is easy for now since we don't have payroll.
-        from gratipay.models.participant import Participant
-        Participant.from_username(self.owner).update_taking()
-
-        self.set_attributes( receiving=r.receiving
-                           , nreceiving_from=r.nreceiving_from
-                           , distributing=r.distributing
-                           , ndistributing_to=r.ndistributing_to
-                            )
-
     @property
     def status(self):
         return { None: 'unreviewed'
@@ -8,8 +8,13 @@ from aspen import renderers
 
 class Renderer(renderers.Renderer):
 
+    chunk_size = 8192
+
     def render_content(self, context):
         rows = eval(self.compiled, globals(), context)
+        if not isinstance(rows, (list, tuple)):
+            # Anything else we take to be an iterator, and stream it.
+            return self.stream_rows(rows)
         if not rows:
             return ''
         f = BytesIO()
@@ -20,6 +25,20 @@ class Renderer(renderers.Renderer):
         f.seek(0)
         return f.read()
 
+    def stream_rows(self, rows):
+        f = BytesIO()
+        w = csv.writer(f)
+        for i, row in enumerate(rows):
+            if i == 0 and hasattr(row, '_fields'):
+                w.writerow(row._fields)
+            w.writerow(row)
+            if f.tell() >= self.chunk_size:
+                yield f.getvalue()
+                f.seek(0)
+                f.truncate()
+        if f.tell():
+            yield f.getvalue()
+
 
 class Factory(renderers.Factory):
     Renderer = Renderer
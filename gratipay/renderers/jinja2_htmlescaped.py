@@ -4,6 +4,9 @@ from markupsafe import escape as htmlescape
 
 
 class HTMLRenderer(base.Renderer):
+
+    chunk_size = 8192
+
     def render_content(self, context):
 
         # Extend to inject an HTML-escaping function. Since autoescape is on,
@@ -12,8 +15,28 @@ class HTMLRenderer(base.Renderer):
 
         context['state']['escape'] = context['escape'] = htmlescape
 
+        # A simplate can set `stream_body = True` to have its template
+        # rendered while the response is being sent, rather than all at once
+        # beforehand. That's for pages that iterate over a lot of rows.
+
+        if context.get('stream_body'):
+            return self.stream_content(context)
+
         return base.Renderer.render_content(self, context)
 
+    def stream_content(self, context):
+        charset = context['response'].charset
+        context.update(self.global_context)
+        chunk, size = [], 0
+        for s in self.compiled.generate(context):
+            chunk.append(s)
+            size += len(s)
+            if size >= self.chunk_size:
+                yield ''.join(chunk).encode(charset)
+                chunk, size = [], 0
+        if chunk:
+            yield ''.join(chunk).encode(charset)
+
 
 class Factory(base.Factory):
 
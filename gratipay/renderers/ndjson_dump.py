@@ -0,0 +1,31 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from aspen import json, renderers
+
+
+class Renderer(renderers.Renderer):
+    """Render an iterable as newline-delimited JSON, one object per line.
+
+    The body is streamed, so the iterable can be a server-side cursor.
+    """
+
+    chunk_size = 8192
+
+    def render_content(self, context):
+        return self.stream_lines(eval(self.compiled, globals(), context))
+
+    def stream_lines(self, objects):
+        chunk, size = [], 0
+        for obj in objects:
+            line = json.dumps(obj, indent=None) + '\n'
+            chunk.append(line)
+            size += len(line)
+            if size >= self.chunk_size:
+                yield ''.join(chunk)
+                chunk, size = [], 0
+        if chunk:
+            yield ''.join(chunk)
+
+
+class Factory(renderers.Factory):
+    Renderer = Renderer
@@ -84,5 +84,8 @@ def add_auth_to_response(response, request=None, user=ANON):
         return  # assets never get auth headers
 
     if SESSION in request.headers.cookie:
+        if request.method not in ('GET', 'HEAD'):
+            # The participant may have changed, don't keep a stale copy.
+            Participant.session_cache.forget(request.headers.cookie[SESSION].value)
         if not user.ANON:
             user.keep_signed_in(response.headers.cookie)
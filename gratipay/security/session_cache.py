@@ -0,0 +1,86 @@
+"""Remember who's signed in for a few seconds, so we don't ask the db every time.
+
+Every request with a session cookie used to load the participant row for it,
+and a page that makes a burst of AJAX calls does that once per call. A
+SessionCache keeps the participant for each recent session in this process,
+for ttl seconds and for at most size sessions, least recently used first out.
+
+Entries are keyed by a hash of the token, so we don't keep tokens around in
+memory. Each lookup gets its own copy of the participant, so that changes made
+while handling one request don't leak into another. Participant.update_session
+forgets the entry for the old token, and set_session_expires updates it, so
+that later requests in this process see the new expiry and don't extend it
+again. We also forget the entry after any request that might have written
+(see authentication.add_auth_to_response), since the participant may have
+changed.
+
+A ttl of 0 turns the cache off.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionCache(object):
+
+    def __init__(self, ttl=0, size=10000):
+        self.ttl = ttl      # seconds
+        self.size = size
+        self._entries = OrderedDict()   # token hash -> (time stored, participant)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        if isinstance(token, unicode):
+            token = token.encode('utf8')
+        return hashlib.sha256(token).hexdigest()
+
+    def get(self, token):
+        """Return a copy of the participant for token, or None.
+        """
+        if not self.ttl or not token:
+            return None
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] + self.ttl < time.time():
+                return None
+            self._entries[key] = entry  # most recently used
+        return copy.copy(entry[1])
+
+    def add(self, token, participant):
+        if not self.ttl or not token or participant is None:
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), copy.copy(participant))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def extend(self, token, expires):
+        """Update the session expiry we have for token, if any.
+        """
+        if not token:
+            return
+        with self._lock:
+            entry = self._entries.get(self._key(token))
+            if entry is not None:
+                entry[1].set_attributes(session_expires=expires)
+
+    def forget(self, token):
+        if not token:
+            return
+        with self._lock:
+            self._entries.pop(self._key(token), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -9,13 +9,14 @@ from os.path import dirname, join, realpath
 from decimal import Decimal
 
 import gratipay
-from aspen import resources
+from aspen import Response, resources
 from aspen.utils import utcnow
 from aspen.testing.client import Client
 from gratipay.billing.exchanges import record_exchange, record_exchange_result
 from gratipay.elsewhere import UserInfo
 from gratipay.exceptions import NoSelfTipping, NoTippee, BadAmount
 from gratipay.main import website
+from gratipay.models import identity_map
 from gratipay.models.account_elsewhere import AccountElsewhere
 from gratipay.models.exchange_route import ExchangeRoute
 from gratipay.models.participant import Participant
@@ -58,6 +59,14 @@ class ClientWithAuth(Client):
 
         return Client.build_wsgi_environ(self, *a, **kw)
 
+    def hit(self, *a, **kw):
+        """Extend base class to read streamed response bodies, like a WSGI server would.
+        """
+        out = Client.hit(self, *a, **kw)
+        if isinstance(out, Response) and not isinstance(out.body, basestring):
+            out.body = b''.join(out.body)
+        return out
+
 
 class Harness(unittest.TestCase):
 
@@ -103,6 +112,8 @@ class Harness(unittest.TestCase):
     def tearDown(self):
         resources.__cache__ = {}  # Clear the simplate cache.
         self.clear_tables()
+        self.client.website.shared_cache.clear()
+        identity_map.stop()  # in case a request raised before timer.end
 
 
     def clear_tables(self):
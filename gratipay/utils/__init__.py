@@ -3,11 +3,12 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from datetime import datetime, timedelta
+from threading import Lock
+from time import sleep, time
 
 from aspen import Response, json
 from aspen.utils import to_rfc822, utcnow
 from dependency_injection import resolve_dependencies
-from postgres.cursors import SimpleCursorBase
 
 import gratipay
 
@@ -19,6 +20,34 @@ BEGINNING_OF_EPOCH = to_rfc822(datetime(1970, 1, 1)).encode('ascii')
 EXPIRING_DELTA = timedelta(days = 30)
 
 
+class TokenBucket(object):
+    """A thread-safe token bucket, for rate-limiting calls to a remote service.
+
+    Tokens accrue at ``rate`` per second, up to ``burst``. Each call to
+    ``take`` consumes one, sleeping until one is available.
+
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.last = time()
+        self.lock = Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
 def dict_to_querystring(mapping):
     if not mapping:
         return u''
@@ -133,41 +162,9 @@ def get_team(state):
 
 
 def update_cta(website):
-    nusers = website.db.one("""
-        SELECT nusers FROM paydays
-        ORDER BY ts_end DESC LIMIT 1
-    """, default=0)
-    nreceiving_from = website.db.one("""
-        SELECT nreceiving_from
-          FROM teams
-         WHERE slug = 'Gratipay'
-    """, default=0)
-    website.support_current = cur = int(round(nreceiving_from / nusers * 100)) if nusers else 0
-    if cur < 10:    goal = 20
-    elif cur < 15:  goal = 30
-    elif cur < 25:  goal = 40
-    elif cur < 35:  goal = 50
-    elif cur < 45:  goal = 60
-    elif cur < 55:  goal = 70
-    elif cur < 65:  goal = 80
-    elif cur > 70:  goal = None
-    website.support_goal = goal
-
-
-def _execute(this, sql, params=[]):
-    print(sql.strip(), params)
-    super(SimpleCursorBase, this).execute(sql, params)
-
-def log_cursor(f):
-    "Prints sql and params to stdout. Works globaly so watch for threaded use."
-    def wrapper(*a, **kw):
-        try:
-            SimpleCursorBase.execute = _execute
-            ret = f(*a, **kw)
-        finally:
-            del SimpleCursorBase.execute
-        return ret
-    return wrapper
+    cta = website.shared_cache.get('cta')
+    website.support_current = cta['support_current']
+    website.support_goal = cta['support_goal']
 
 
 def format_money(money):
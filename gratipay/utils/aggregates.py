@@ -0,0 +1,157 @@
+"""Site-wide aggregates, computed by one process and shared with the rest.
+
+Each function here takes a db and returns something picklable. register puts
+them all into a SharedCache, under their own names, tagged with what they
+depend on so that they're recomputed when it changes.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from decimal import Decimal as D
+
+
+def paydays(db):
+    return db.all("""
+
+        SELECT ts_start
+             , ts_end
+             , volume
+             , nusers
+             , nteams
+          FROM paydays
+      ORDER BY ts_start DESC
+
+    """, back_as=dict)
+
+
+def charts(db):
+    charts = db.all("""
+
+        SELECT ts_start::date  AS date
+             , ts_start::date  AS xTitle
+             , volume::text
+             , nusers::text
+             , nteams::text
+          FROM paydays
+      ORDER BY ts_start DESC
+
+    """, back_as=dict)
+    for c in charts:
+        c['xTitle'] = c.pop('xtitle')  # postgres doesn't respect case here
+    return charts
+
+
+PAYMENT_DISTRIBUTION_BINS = [ (D('0.00'), D('0.10'))
+                            , (D('0.11'), D('0.20'))
+                            , (D('0.21'), D('0.50'))
+
+                            , (D('0.51'), D('1.00'))
+                            , (D('1.01'), D('2.00'))
+                            , (D('2.01'), D('5.00'))
+
+                            , ( D('5.01'),  D('10.00'))
+                            , (D('10.01'),  D('20.00'))
+                            , (D('20.01'),  D('50.00'))
+
+                            , ( D('50.01'), D('100.00'))
+                            , (D('100.01'), D('200.00'))
+                            , (D('200.01'), D('500.00'))
+
+                            , (D('500.01'), D('1000.00'))
+                             ]
+
+
+def payment_distribution(db):
+    los, his = zip(*PAYMENT_DISTRIBUTION_BINS)
+    bins = db.all("""
+
+        WITH bins AS (
+                 SELECT unnest(%(los)s::numeric[]) AS lo
+                      , unnest(%(his)s::numeric[]) AS hi
+             )
+           , amounts AS (
+                 SELECT amount
+                   FROM current_payment_instructions cpi
+                   JOIN participants p ON p.username = cpi.participant
+                   JOIN teams t ON t.slug = cpi.team
+                  WHERE cpi.is_funded
+                    AND t.is_approved
+                    AND NOT (p.is_suspicious IS true)
+                    AND amount > 0
+             )
+        SELECT b.lo, b.hi, count(a.amount) AS n, COALESCE(sum(a.amount), 0) AS sum
+          FROM bins b
+     LEFT JOIN amounts a ON a.amount >= b.lo AND a.amount <= b.hi
+      GROUP BY b.lo, b.hi
+      ORDER BY b.hi DESC
+
+    """, dict(los=list(los), his=list(his)))
+
+    return [{ 'n': str(b.n)
+            , 'sum': str(b.sum)
+            , 'lo': str(b.lo)
+            , 'hi': str(b.hi)
+            , 'xText': str(b.hi)
+             } for b in bins]
+
+
+def stats(db):
+    volume, nusers, nteams = db.one("""
+            SELECT volume, nusers, nteams
+              FROM paydays
+          ORDER BY ts_end DESC
+             LIMIT 1
+        """, default=(0.0, 0, 0))
+    average_payment_amount, average_number_of_payments = db.one("""
+
+        SELECT avg(giving/ngiving_to) AS foo
+             , round(avg(ngiving_to)) AS bar
+          FROM participants
+         WHERE ngiving_to > 0
+
+    """, back_as=tuple)
+    return dict( volume=volume
+               , nusers=nusers
+               , nteams=nteams
+               , total=db.one("SELECT sum(amount) FROM exchanges WHERE amount > 0", default=0)
+               , escrow=db.one("SELECT sum(balance) FROM participants", default=0)
+               , average_payment_amount=average_payment_amount or 0
+               , average_number_of_payments=average_number_of_payments or 0
+                )
+
+
+def cta(db):
+    """Compute how many active users support Gratipay, and what to aim for.
+    """
+    nusers = db.one("""
+        SELECT nusers FROM paydays
+        ORDER BY ts_end DESC LIMIT 1
+    """, default=0)
+    nreceiving_from = db.one("""
+        SELECT nreceiving_from
+          FROM teams
+         WHERE slug = 'Gratipay'
+    """, default=0)
+    cur = int(round(nreceiving_from / nusers * 100)) if nusers else 0
+    if cur < 10:    goal = 20
+    elif cur < 15:  goal = 30
+    elif cur < 25:  goal = 40
+    elif cur < 35:  goal = 50
+    elif cur < 45:  goal = 60
+    elif cur < 55:  goal = 70
+    elif cur < 65:  goal = 80
+    elif cur > 70:  goal = None
+    return dict(support_current=cur, support_goal=goal)
+
+
+TAGS = { 'paydays': ('paydays',)
+       , 'charts': ('paydays',)
+       , 'payment_distribution': ('payment_instructions',)
+       , 'stats': ('paydays', 'payment_instructions')
+       , 'cta': ('paydays', 'team:Gratipay')
+        }
+
+
+def register(cache, db):
+    for f in (paydays, charts, payment_distribution, stats, cta):
+        cache.register(f.__name__, lambda f=f: f(db), TAGS[f.__name__])
@@ -0,0 +1,46 @@
+"""Helpers shared by our benchmarks, payday_benchmark and take_over_benchmark.
+
+Both load fake data in bulk, so they insist on an empty database, and both
+append their report to a file as a JSON line, so that runs from different
+commits can be compared.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+
+
+def require_empty_db(db, what):
+    """Raise if db already has participants. what names the benchmark.
+    """
+    if db.one("SELECT count(*) FROM participants"):
+        raise Exception("Refusing to benchmark %s in a database that isn't empty." % what)
+
+
+def append_report(path, report):
+    """Append report to the file at path, as one JSON line.
+    """
+    with open(path, 'a') as f:
+        f.write(json.dumps(report) + '\n')
+
+
+def load_last_report(path):
+    """Return the last report appended to the file at path.
+    """
+    with open(path) as f:
+        return json.loads(f.read().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def is_slower(seconds, baseline, tolerance):
+    """Return whether seconds is more than tolerance (a fraction) slower than
+    baseline.
+    """
+    return seconds > baseline * (1 + tolerance)
@@ -0,0 +1,104 @@
+"""Drop cached results when the data behind them changes.
+
+Cache entries declare tags, and triggers in the database publish the tags of
+whatever a transaction changed over NOTIFY on the cache_invalidation channel
+when it commits. The tags we publish are:
+
+    participant:<id>        a participant event, or a new payment instruction
+    team:<slug>             a team event, or a new payment instruction
+    payment_instructions    any change to payment_instructions
+    paydays                 any change to paydays
+
+Every process runs an Invalidator, which LISTENs on its own connection and
+passes each tag on to its subscribers. If the connection drops we may have
+missed notifications, so once we're listening again subscribers are told to
+drop everything, with the tag ``*``.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import select
+import threading
+import traceback
+
+from aspen import log_dammit
+
+
+CHANNEL = 'cache_invalidation'
+EVERYTHING = '*'
+
+
+class Invalidator(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.subscribers = []
+        self.thread = None
+        self.listening = threading.Event()
+        self.stopping = threading.Event()
+
+    def subscribe(self, func):
+        """Call func with each tag we're notified of.
+        """
+        self.subscribers.append(func)
+
+    def publish(self, tag):
+        for func in self.subscribers:
+            try:
+                func(tag)
+            except Exception:
+                log_dammit(traceback.format_exc().strip())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.listen_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop listening, and wait for the thread to exit.
+
+        We NOTIFY with an empty payload to wake the listener up, rather than
+        waiting for its select to time out.
+
+        """
+        self.stopping.set()
+        if self.thread is None:
+            return
+        self.db.run("SELECT pg_notify(%s, '')", (CHANNEL,))
+        self.thread.join()
+        self.thread = None
+
+    def listen_forever(self):
+        reconnecting = False
+        while not self.stopping.is_set():
+            try:
+                self.listen(reconnecting)
+            except Exception:
+                log_dammit(traceback.format_exc().strip())
+            reconnecting = True
+            self.stopping.wait(5)
+
+    def listen(self, reconnecting=False, timeout=60):
+        with self.db.get_connection() as conn:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute("LISTEN " + CHANNEL)
+            if reconnecting:
+                self.publish(EVERYTHING)
+            self.listening.set()
+            try:
+                while not self.stopping.is_set():
+                    if select.select([conn], [], [], timeout) == ([], [], []):
+                        continue
+                    conn.poll()
+                    tags = set()
+                    while conn.notifies:
+                        tags.add(conn.notifies.pop(0).payload)
+                    tags.discard('')
+                    if self.stopping.is_set():
+                        break
+                    for tag in sorted(tags):
+                        self.publish(tag)
+            finally:
+                self.listening.clear()
+                cursor.execute("UNLISTEN *")
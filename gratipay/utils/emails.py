@@ -4,6 +4,8 @@ from aspen.simplates.pagination import parse_specline, split_and_escape
 from aspen_jinja2_renderer import SimplateLoader
 from jinja2 import Environment
 
+from gratipay.utils import TokenBucket
+
 
 ( VERIFICATION_MISSING
 , VERIFICATION_FAILED
@@ -28,3 +30,34 @@ def compile_email_spt(fpath):
         env = jinja_env_html if content_type == 'text/html' else jinja_env
         r[key] = SimplateLoader(fpath, tmpl).load(env, fpath)
     return r
+
+
+class MandrillTransport(object):
+    """Send rendered email messages through Mandrill.
+
+    Transports take a batch of messages at a time, so that one backed by an
+    API with batch sending can use it. Mandrill's doesn't fit our per-recipient
+    messages, so we send them one by one, at most ``rate`` per second (no
+    limit if ``rate`` is 0).
+
+    """
+
+    def __init__(self, mandrill, rate=0):
+        self.mandrill = mandrill
+        self.bucket = TokenBucket(rate) if rate else None
+
+    def send(self, messages):
+        """Send a list of messages. Returns a list with, for each message,
+        ``None`` if it was sent or the exception that kept it from being sent.
+        """
+        errors = []
+        for message in messages:
+            if self.bucket:
+                self.bucket.take()
+            try:
+                self.mandrill.messages.send(message=message)
+            except Exception as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
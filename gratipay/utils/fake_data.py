@@ -344,6 +344,87 @@ def populate_db(db, num_participants=100, ntips=200, num_teams=5, num_transfers=
     print("")
 
 
+def bulk_populate_db(db, num_participants=10000, num_teams=100, num_payment_instructions=20000,
+                     seed=0.5):
+    """Populate DB with enough fake data to run payday at scale.
+
+    Unlike populate_db, this generates rows inside Postgres with
+    generate_series, so a million participants loads in minutes rather than
+    days. Only what payday looks at is populated: claimed participants (most
+    with a credit card, some with a balance), approved teams whose owners have
+    a PayPal route, and payment instructions spread across the teams. Values
+    are drawn from random() after setseed(seed), so the same arguments give
+    the same data.
+
+    """
+    with db.get_cursor() as cursor:
+        cursor.run("SELECT setseed(%s)", (seed,))
+
+        print("Making Participants")
+        cursor.run("""
+            INSERT INTO participants
+                        (username, username_lower, claimed_time, balance, is_suspicious,
+                         braintree_customer_id)
+                 SELECT 'bench' || i
+                      , 'bench' || i
+                      , now() - interval '1 week'
+                      , CASE WHEN random() < 0.3
+                             THEN round((random() * 20)::numeric, 2)
+                             ELSE 0
+                         END
+                      , false
+                      , 'bench-customer-' || i
+                   FROM generate_series(1, %s) i
+        """, (num_participants,))
+
+        print("Making Exchange Routes")
+        cursor.run("""
+            INSERT INTO exchange_routes (participant, network, address, error)
+                 SELECT id, 'braintree-cc', 'bench-card-' || id, ''
+                   FROM participants
+                  WHERE random() < 0.9
+        """)
+
+        print("Making Teams")
+        cursor.run("""
+            INSERT INTO teams
+                        (slug, slug_lower, name, homepage, product_or_service, owner, is_approved)
+                 SELECT 'BenchTeam' || i
+                      , 'benchteam' || i
+                      , 'Bench Team ' || i
+                      , 'http://www.example.org/'
+                      , 'Product'
+                      , 'bench' || i
+                      , true
+                   FROM generate_series(1, %s) i;
+
+            INSERT INTO exchange_routes (participant, network, address, error)
+                 SELECT p.id, 'paypal', p.username || '@example.org', ''
+                   FROM teams t
+                   JOIN participants p ON p.username = t.owner;
+        """, (num_teams,))
+
+        print("Making Payment Instructions")
+        # One NOTIFY per row would make this quadratic, see sql/branch.sql.
+        cursor.run("""
+            ALTER TABLE payment_instructions DISABLE TRIGGER invalidate_payment_instruction;
+            INSERT INTO payment_instructions (ctime, mtime, participant, team, amount)
+                 SELECT now() - interval '1 week'
+                      , now() - interval '1 week'
+                      , 'bench' || (1 + (i - 1) %% %(nparticipants)s)
+                      , 'BenchTeam' || (1 + floor(random() * %(nteams)s))
+                      , round((1 + random() * 24)::numeric, 2)
+                   FROM generate_series(1, %(ninstructions)s) i;
+            ALTER TABLE payment_instructions ENABLE TRIGGER invalidate_payment_instruction;
+        """, dict( nparticipants=num_participants
+                 , nteams=num_teams
+                 , ninstructions=num_payment_instructions
+                  ))
+
+    # Give the planner accurate statistics for the tables we just filled.
+    db.run("ANALYZE")
+
+
 def main(db=None, *a, **kw):
     db = db or wireup.db(wireup.env())
     clean_db(db)
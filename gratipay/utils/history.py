@@ -2,7 +2,66 @@ from datetime import datetime
 from decimal import Decimal
 
 from aspen import Response
-from psycopg2 import IntegrityError
+
+from gratipay.models import LEDGER
+
+
+WHOLE_LEDGER = LEDGER.format(exchanges='true', transfers='true', payments='true')
+
+
+def snapshot_balances(db, monthly=False):
+    """Store everyone's balance at the end of each closed year (and month, if
+    monthly is true) in balances_at, in one pass over the ledger per period.
+
+    We only store a snapshot for the periods in which a participant's balance
+    changed; get_end_of_year_balance takes the latest snapshot it can find.
+    Snapshots that no longer match the ledger are fixed. Returns the number of
+    rows inserted and updated for each period.
+    """
+    periods = ['year', 'month'] if monthly else ['year']
+    return {period: _snapshot_balances(db, period) for period in periods}
+
+
+def _snapshot_balances(db, period):
+    return db.one("""
+        WITH deltas AS (
+                SELECT username
+                     , date_trunc(%(period)s, timestamp) + %(step)s::interval AS at
+                     , sum(a) AS delta
+                  FROM ({}) ledger
+                 WHERE timestamp < date_trunc(%(period)s, now())
+              GROUP BY username, date_trunc(%(period)s, timestamp)
+             )
+           , snapshots AS (
+                SELECT p.id AS participant, d.at
+                     , sum(d.delta) OVER (PARTITION BY d.username ORDER BY d.at) AS balance
+                  FROM deltas d
+                  JOIN participants p ON p.username = d.username
+             )
+           , updated AS (
+                UPDATE balances_at b
+                   SET balance = s.balance
+                  FROM snapshots s
+                 WHERE b.participant = s.participant
+                   AND b.at = s.at
+                   AND b.balance <> s.balance
+             RETURNING 1
+             )
+           , inserted AS (
+                INSERT INTO balances_at (participant, at, balance)
+                     SELECT s.participant, s.at, s.balance
+                       FROM snapshots s
+                      WHERE NOT EXISTS (
+                                SELECT 1
+                                  FROM balances_at b
+                                 WHERE b.participant = s.participant
+                                   AND b.at = s.at
+                            )
+                  RETURNING 1
+             )
+        SELECT (SELECT count(*) FROM inserted) AS inserted
+             , (SELECT count(*) FROM updated) AS updated
+    """.format(WHOLE_LEDGER), dict(period=period, step='1 ' + period))
 
 
 def get_end_of_year_balance(db, participant, year, current_year):
@@ -12,212 +71,280 @@ def get_end_of_year_balance(db, participant, year, current_year):
     if year < start.year:
         return Decimal('0.00')
 
-    balance = db.one("""
-        SELECT balance
-          FROM balances_at
-         WHERE participant = %s
-           AND "at" = %s
-    """, (participant.id, datetime(year+1, 1, 1)))
-    if balance is not None:
-        return balance
+    # Start from the latest snapshot (see snapshot_balances), and add whatever
+    # happened between it and the end of the year, if anything.
+    end = year_range(year)[1]
+    return db.one("""
+        WITH snapshot AS (
+                SELECT at, balance
+                  FROM balances_at
+                 WHERE participant = %(id)s
+                   AND at <= %(end)s
+              ORDER BY at DESC
+                 LIMIT 1
+             )
+        SELECT COALESCE((SELECT balance FROM snapshot), 0) + (
+                  SELECT COALESCE(sum(a), 0)
+                    FROM ({}) ledger
+                   WHERE username = %(username)s
+                     AND timestamp >= COALESCE((SELECT at FROM snapshot), '-infinity')
+                     AND timestamp < %(end)s
+               )
+    """.format(WHOLE_LEDGER), dict(id=participant.id, username=participant.username, end=end))
+
+
+def year_range(year):
+    """Return the bounds of a year, for sargable `timestamp` predicates.
+
+    We compare against naive datetimes, which Postgres reads in the session
+    time zone, same as `extract(year from timestamp)` would.
+    """
+    return datetime(year, 1, 1), datetime(year+1, 1, 1)
+
+
+EVENT_COLUMNS = {
+    'exchange': ('id', 'timestamp', 'amount', 'fee', 'participant', 'recorder', 'note', 'status',
+                 'route'),
+    'payment': ('id', 'timestamp', 'participant', 'team', 'amount', 'direction', 'payday'),
+    'transfer': ('id', 'timestamp', 'tipper', 'tippee', 'amount', 'context', 'payday'),
+}
+
+
+def iter_payday_events(db, participant, year=None):
+    """Yields payday events for the given participant.
+
+    Events are read newest first through a server-side cursor, so we only hold
+    one batch of them in memory at a time, however long the history is.
+    """
+    current_year = datetime.utcnow().year
+    year = year or current_year
 
     username = participant.username
-    start_balance = get_end_of_year_balance(db, participant, year-1, current_year)
-    delta = db.one("""
-        SELECT (
-                  SELECT COALESCE(sum(amount), 0) AS a
-                    FROM exchanges
+    start, end = year_range(year)
+    params = dict(username=username, start=start, end=end)
+
+    totals = db.one("""
+        SELECT EXISTS (
+                  SELECT 1
+                    FROM payments
                    WHERE participant = %(username)s
-                     AND extract(year from timestamp) = %(year)s
-                     AND amount > 0
-                     AND (status is null OR status = 'succeeded')
-               ) + (
-                  SELECT COALESCE(sum(amount-fee), 0) AS a
-                    FROM exchanges
+                     AND timestamp >= %(start)s AND timestamp < %(end)s
+               ) OR EXISTS (
+                  SELECT 1
+                    FROM transfers
+                   WHERE (tipper = %(username)s OR tippee = %(username)s)
+                     AND timestamp >= %(start)s AND timestamp < %(end)s
+               ) AS any
+             , (
+                  SELECT COALESCE(sum(amount), 0)
+                    FROM payments
                    WHERE participant = %(username)s
-                     AND extract(year from timestamp) = %(year)s
-                     AND amount < 0
-                     AND (status is null OR status <> 'failed')
+                     AND direction = 'to-team'
+                     AND timestamp >= %(start)s AND timestamp < %(end)s
                ) + (
-                  SELECT COALESCE(sum(-amount), 0) AS a
+                  SELECT COALESCE(sum(amount), 0)
                     FROM transfers
                    WHERE tipper = %(username)s
-                     AND extract(year from timestamp) = %(year)s
+                     AND context <> 'take'
+                     AND timestamp >= %(start)s AND timestamp < %(end)s
+               ) AS given
+             , (
+                  SELECT COALESCE(sum(amount), 0)
+                    FROM payments
+                   WHERE participant = %(username)s
+                     AND direction = 'to-participant'
+                     AND timestamp >= %(start)s AND timestamp < %(end)s
                ) + (
-                  SELECT COALESCE(sum(amount), 0) AS a
+                  SELECT COALESCE(sum(amount), 0)
                     FROM transfers
                    WHERE tippee = %(username)s
-                     AND extract(year from timestamp) = %(year)s
-               ) AS delta
-    """, locals())
-    balance = start_balance + delta
-    try:
-        db.run("""
-            INSERT INTO balances_at
-                        (participant, at, balance)
-                 VALUES (%s, %s, %s)
-        """, (participant.id, datetime(year+1, 1, 1), balance))
-    except IntegrityError:
-        pass
-    return balance
-
-
-def iter_payday_events(db, participant, year=None):
-    """Yields payday events for the given participant.
-    """
-    current_year = datetime.utcnow().year
-    year = year or current_year
+                     AND timestamp >= %(start)s AND timestamp < %(end)s
+               ) AS received
+    """, params)
+    if totals.any:
+        yield dict(kind='totals', given=totals.given, received=totals.received)
 
-    username = participant.username
-    exchanges = db.all("""
-        SELECT *
-          FROM exchanges
-         WHERE participant=%(username)s
-           AND extract(year from timestamp) = %(year)s
-    """, locals(), back_as=dict)
-    payments = db.all("""
-        SELECT *
-          FROM payments
-         WHERE participant=%(username)s
-           AND extract(year from timestamp) = %(year)s
-    """, locals(), back_as=dict)
-    transfers = db.all("""
-        SELECT *
-          FROM transfers
-         WHERE (tipper=%(username)s OR tippee=%(username)s)
-           AND extract(year from timestamp) = %(year)s
-    """, locals(), back_as=dict)
-
-    if not (exchanges or payments or transfers):
-        return
-
-    if payments or transfers:
-        payments_given = sum([p['amount'] for p in payments if p['direction'] == 'to-team'])
-        payments_received = sum([p['amount'] for p in payments \
-                                                            if p['direction'] == 'to-participant'])
-        transfers_given = sum(t['amount'] for t in transfers \
-                                             if t['tipper'] == username and t['context'] != 'take')
-        transfers_received = sum(t['amount'] for t in transfers if t['tippee'] == username)
-        yield dict( kind='totals'
-                  , given=payments_given + transfers_given
-                  , received=payments_received + transfers_received
-                   )
-
-    payday_dates = db.all("""
+    # Paydays are numbered from the first one ever, but we only need the
+    # numbers of the ones in this year. For a date with more than one payday
+    # we keep the number of the last one.
+    payday_numbers = dict(db.all("""
         SELECT ts_start::date
-          FROM paydays
+             , (SELECT count(*) FROM paydays p2 WHERE p2.ts_start < p.ts_start)
+          FROM paydays p
+         WHERE ts_start >= %(start)s AND ts_start < %(end)s
       ORDER BY ts_start ASC
-    """)
-
-    balance = get_end_of_year_balance(db, participant, year, current_year)
-    prev_date = None
-    get_timestamp = lambda e: e['timestamp']
-    events = sorted(exchanges+payments+transfers, key=get_timestamp, reverse=True)
-    for event in events:
-
-        event['balance'] = balance
-
-        event_date = event['timestamp'].date()
-        if event_date != prev_date:
-            if prev_date:
-                yield dict(kind='day-close', balance=balance)
-            day_open = dict(kind='day-open', date=event_date, balance=balance)
-            if payday_dates:
-                while payday_dates and payday_dates[-1] > event_date:
-                    payday_dates.pop()
-                payday_date = payday_dates[-1] if payday_dates else None
-                if event_date == payday_date:
-                    day_open['payday_number'] = len(payday_dates) - 1
-            yield day_open
-            prev_date = event_date
-
-        if 'fee' in event:
-            if event['amount'] > 0:
-                kind = 'charge'
-                if event['status'] in (None, 'succeeded'):
+    """, params))
+
+    with db.get_cursor(name='payday_events', back_as=dict) as cursor:
+        cursor.execute("""
+            SELECT 'exchange' AS source, id, timestamp, amount, fee, participant, recorder
+                 , note, status, route, NULL::text AS team, NULL::payment_direction AS direction
+                 , NULL::int AS payday, NULL::text AS tipper, NULL::text AS tippee
+                 , NULL::context_type AS context
+              FROM exchanges
+             WHERE participant = %(username)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
+         UNION ALL
+            SELECT 'payment', id, timestamp, amount, NULL, participant, NULL
+                 , NULL, NULL, NULL, team, direction
+                 , payday, NULL, NULL
+                 , NULL
+              FROM payments
+             WHERE participant = %(username)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
+         UNION ALL
+            SELECT 'transfer', id, timestamp, amount, NULL, NULL, NULL
+                 , NULL, NULL, NULL, NULL, NULL
+                 , payday, tipper, tippee
+                 , context
+              FROM transfers
+             WHERE (tipper = %(username)s OR tippee = %(username)s)
+               AND timestamp >= %(start)s AND timestamp < %(end)s
+          ORDER BY timestamp DESC, source, id DESC
+        """, params)
+
+        balance = None
+        prev_date = None
+        for row in cursor:
+            source = row['source']
+            event = {k: row[k] for k in EVENT_COLUMNS[source]}
+
+            if balance is None:
+                balance = get_end_of_year_balance(db, participant, year, current_year)
+            event['balance'] = balance
+
+            event_date = event['timestamp'].date()
+            if event_date != prev_date:
+                if prev_date:
+                    yield dict(kind='day-close', balance=balance)
+                day_open = dict(kind='day-open', date=event_date, balance=balance)
+                if event_date in payday_numbers:
+                    day_open['payday_number'] = payday_numbers[event_date]
+                yield day_open
+                prev_date = event_date
+
+            if source == 'exchange':
+                if event['amount'] > 0:
+                    kind = 'charge'
+                    if event['status'] in (None, 'succeeded'):
+                        balance -= event['amount']
+                else:
+                    kind = 'credit'
+                    if event['status'] != 'failed':
+                        balance -= event['amount'] - event['fee']
+            elif source == 'payment':
+                kind = 'payment'
+                if event['direction'] == 'to-participant':
                     balance -= event['amount']
+                else:
+                    assert event['direction'] == 'to-team'
+                    balance += event['amount']
             else:
-                kind = 'credit'
-                if event['status'] != 'failed':
-                    balance -= event['amount'] - event['fee']
-        elif 'direction' in event:
-            kind = 'payment'
-            if event['direction'] == 'to-participant':
-                balance -= event['amount']
-            else:
-                assert event['direction'] == 'to-team'
-                balance += event['amount']
-        else:
-            kind = 'transfer'
-            if event['tippee'] == username:
-                balance -= event['amount']
-            else:
-                balance += event['amount']
-        event['kind'] = kind
+                kind = 'transfer'
+                if event['tippee'] == username:
+                    balance -= event['amount']
+                else:
+                    balance += event['amount']
+            event['kind'] = kind
 
-        yield event
+            yield event
 
-    yield dict(kind='day-close', balance=balance)
+    if prev_date:
+        yield dict(kind='day-close', balance=balance)
 
 
-def export_history(participant, year, mode, key, back_as='namedtuple', require_key=False):
-    db = participant.db
-    params = dict(username=participant.username, year=year)
-    out = {}
-    if mode == 'aggregate':
-        out['given'] = lambda: db.all("""
+EXPORT_QUERIES = {
+    'aggregate': {
+        'given': """
             SELECT tippee, sum(amount) AS amount
               FROM transfers
              WHERE tipper = %(username)s
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           GROUP BY tippee
-        """, params, back_as=back_as)
-        out['taken'] = lambda: db.all("""
+        """,
+        'taken': """
             SELECT tipper AS team, sum(amount) AS amount
               FROM transfers
              WHERE tippee = %(username)s
                AND context = 'take'
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           GROUP BY tipper
-        """, params, back_as=back_as)
-    else:
-        out['exchanges'] = lambda: db.all("""
+        """,
+    },
+    'detailed': {
+        'exchanges': """
             SELECT timestamp, amount, fee, status, note
               FROM exchanges
              WHERE participant = %(username)s
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           ORDER BY timestamp ASC
-        """, params, back_as=back_as)
-        out['given'] = lambda: db.all("""
+        """,
+        'given': """
             SELECT timestamp, tippee, amount, context
               FROM transfers
              WHERE tipper = %(username)s
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           ORDER BY timestamp ASC
-        """, params, back_as=back_as)
-        out['taken'] = lambda: db.all("""
+        """,
+        'taken': """
             SELECT timestamp, tipper AS team, amount
               FROM transfers
              WHERE tippee = %(username)s
                AND context = 'take'
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           ORDER BY timestamp ASC
-        """, params, back_as=back_as)
-        out['received'] = lambda: db.all("""
+        """,
+        'received': """
             SELECT timestamp, amount, context
               FROM transfers
              WHERE tippee = %(username)s
                AND context NOT IN ('take', 'take-over')
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
           ORDER BY timestamp ASC
-        """, params, back_as=back_as)
+        """,
+    },
+}
+
 
+def get_export_queries(mode, key, require_key=False):
+    """Return a dict of the export queries asked for, by key.
+    """
+    queries = EXPORT_QUERIES['aggregate' if mode == 'aggregate' else 'detailed']
     if key:
-        try:
-            return out[key]()
-        except KeyError:
+        if key not in queries:
             raise Response(400, "bad key `%s`" % key)
+        return {key: queries[key]}
     elif require_key:
         raise Response(400, "missing `key` parameter")
-    else:
-        return {k: v() for k, v in out.items()}
+    return queries
+
+
+def export_params(participant, years):
+    """Return query parameters for the years from years[0] to years[1] included.
+    """
+    return dict( username=participant.username
+               , start=year_range(years[0])[0]
+               , end=year_range(years[1])[1]
+                )
+
+
+def export_history(participant, years, mode, key, back_as='namedtuple', require_key=False):
+    db = participant.db
+    queries = get_export_queries(mode, key, require_key)
+    params = export_params(participant, years)
+    out = {k: db.all(sql, params, back_as=back_as) for k, sql in queries.items()}
+    return out[key] if key else out
+
+
+def iter_export(participant, years, queries, back_as='namedtuple'):
+    """Yield (key, row) for each row of each of the given export queries.
+
+    Each query is read through a server-side cursor, so this takes the same
+    memory however many rows there are.
+    """
+    params = export_params(participant, years)
+    for key in sorted(queries):
+        with participant.db.get_cursor(name='export_history', back_as=back_as) as cursor:
+            cursor.execute(queries[key], params)
+            for row in cursor:
+                yield key, row
@@ -0,0 +1,229 @@
+"""Benchmark payday against a large synthetic dataset.
+
+This is installed as `payday_benchmark`. Point it at an empty database and it
+will bulk load participants, teams and payment instructions with
+fake_data.bulk_populate_db, run a full payday against a stubbed Braintree, and
+report how long each stage took along with the database activity that payday
+caused::
+
+    payday_benchmark --scale 100k --json benchmarks.jsonl
+
+Reports are tagged with the current version. Pass --baseline with a file of
+earlier reports to fail if any stage got slower than in the last of them.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import itertools
+import sys
+import threading
+from contextlib import contextmanager
+from time import sleep
+
+import braintree
+
+from gratipay import wireup
+from gratipay.utils import fake_data
+from gratipay.utils.benchmarking import append_report, is_slower, load_last_report, require_empty_db
+from gratipay.version import get_version
+
+
+SCALES = {'10k': 10000, '100k': 100000, '1M': 1000000}
+
+DB_STATS = ( 'xact_commit', 'blks_read', 'blks_hit', 'tup_returned', 'tup_fetched'
+           , 'tup_inserted', 'tup_updated', 'tup_deleted', 'temp_files', 'temp_bytes'
+            )
+
+
+class FakeBraintree(object):
+    """Stand in for the parts of braintree.Transaction that payday uses.
+
+    Every sale is authorized, and every capture and void succeeds. Pass
+    latency (in seconds) to simulate the round trip to Braintree.
+
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.ncalls = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            self.ncalls += 1
+            n = next(self._ids)
+        sleep(self.latency)
+        return 'bench%i' % n
+
+    def sale(self, params):
+        transaction = braintree.Transaction(None, {
+            'id': self._call(),
+            'amount': params['amount'],
+            'tax_amount': 0,
+            'status': 'authorized',
+            'custom_fields': params['custom_fields'],
+            'credit_card': {'token': params['payment_method_token']},
+        })
+        return braintree.SuccessfulResult({'transaction': transaction})
+
+    def submit_for_settlement(self, transaction_id, amount=None):
+        self._call()
+        transaction = braintree.Transaction(None, {
+            'id': transaction_id,
+            'amount': amount,
+            'tax_amount': 0,
+            'status': 'submitted_for_settlement',
+        })
+        return braintree.SuccessfulResult({'transaction': transaction})
+
+    def void(self, transaction_id):
+        self._call()
+        return braintree.SuccessfulResult({})
+
+    def search(self, *query):
+        self._call()
+        return braintree.SuccessfulResult({'items': []})
+
+
+@contextmanager
+def stub_braintree(fake):
+    """Route braintree.Transaction calls to fake for the duration of the block.
+    """
+    names = ('sale', 'submit_for_settlement', 'void', 'search')
+    originals = dict((name, braintree.Transaction.__dict__[name]) for name in names)
+    for name in names:
+        setattr(braintree.Transaction, name, staticmethod(getattr(fake, name)))
+    try:
+        yield fake
+    finally:
+        for name, original in originals.items():
+            setattr(braintree.Transaction, name, original)
+
+
+def get_db_stats(db):
+    """Return the activity counters and size of the current database.
+    """
+    stats = db.one("""
+        SELECT {}, pg_database_size(datname) AS size
+          FROM pg_stat_database
+         WHERE datname = current_database()
+    """.format(', '.join(DB_STATS)), back_as=dict)
+    return dict((k, int(v)) for k, v in stats.items())
+
+
+def run(db, num_participants, num_teams, num_payment_instructions, latency=0):
+    """Load the data, run payday, and return a report as a dict.
+    """
+    from gratipay.billing.payday import Payday
+
+    require_empty_db(db, 'payday')
+
+    fake_data.bulk_populate_db(db, num_participants, num_teams, num_payment_instructions)
+
+    # The statistics collector lags behind a little, give it time to catch up.
+    sleep(1)
+    before = get_db_stats(db)
+    fake = FakeBraintree(latency)
+    with stub_braintree(fake):
+        payday = Payday.start()
+        payday.run()
+    sleep(1)
+    after = get_db_stats(db)
+
+    stages = db.all("""
+        SELECT stage
+             , extract(epoch from ts_end - ts_start) AS seconds
+             , nrows
+             , ncalls
+          FROM payday_metrics
+         WHERE payday = %s
+      ORDER BY ts_start, id
+    """, (payday.id,), back_as=dict)
+    for stage in stages:
+        stage['seconds'] = float(stage['seconds'])
+
+    return { 'version': get_version()
+           , 'participants': num_participants
+           , 'teams': num_teams
+           , 'payment_instructions': num_payment_instructions
+           , 'latency': latency
+           , 'gateway_calls': fake.ncalls
+           , 'stages': stages
+           , 'db': dict((k, after[k] - before[k]) for k in DB_STATS)
+           , 'db_size': after['size']
+            }
+
+
+def print_report(report, baseline=None):
+    print("Payday benchmark for %(version)s: %(participants)i participants, %(teams)i teams, "
+          "%(payment_instructions)i payment instructions." % report)
+    print()
+    old = dict((s['stage'], s['seconds']) for s in baseline['stages']) if baseline else {}
+    for stage in report['stages']:
+        line = "%-30s %10.3fs %10s rows %8i calls" % ( stage['stage']
+                                                      , stage['seconds']
+                                                      , stage['nrows']
+                                                      , stage['ncalls']
+                                                       )
+        if old.get(stage['stage']):
+            line += "  (%+.0f%%)" % ((stage['seconds'] / old[stage['stage']] - 1) * 100)
+        print(line)
+    print()
+    for k in DB_STATS:
+        print("%-30s %12i" % (k, report['db'][k]))
+    print("%-30s %12i" % ('db_size', report['db_size']))
+
+
+def find_regressions(report, baseline, tolerance):
+    """Return the stages that are more than tolerance slower than in baseline.
+    """
+    old = dict((s['stage'], s['seconds']) for s in baseline['stages'])
+    return [ s['stage'] for s in report['stages']
+             if s['stage'] in old and is_slower(s['seconds'], old[s['stage']], tolerance)
+            ]
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Benchmark payday on fake data.")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='10k',
+                        help="number of participants to generate")
+    parser.add_argument('--teams', type=int,
+                        help="number of teams (default: 1 per 100 participants)")
+    parser.add_argument('--instructions', type=int,
+                        help="number of payment instructions (default: 2 per participant)")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds to wait on each simulated Braintree call")
+    parser.add_argument('--json', help="append the report to this file as a JSON line")
+    parser.add_argument('--baseline', help="a file whose last line is an earlier report")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="how much slower a stage may get before we fail (default: 0.25)")
+    args = parser.parse_args(argv)
+
+    nparticipants = SCALES[args.scale]
+    nteams = args.teams or max(nparticipants // 100, 1)
+    ninstructions = args.instructions or nparticipants * 2
+
+    env = wireup.env()
+    db = wireup.db(env)
+    wireup.billing(env)
+
+    report = run(db, nparticipants, nteams, ninstructions, args.latency)
+
+    baseline = load_last_report(args.baseline) if args.baseline else None
+    print_report(report, baseline)
+
+    if args.json:
+        append_report(args.json, report)
+
+    if baseline:
+        slower = find_regressions(report, baseline, args.tolerance)
+        if slower:
+            print()
+            print("Slower than the baseline: %s" % ', '.join(slower))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import sys
 import threading
 import time
@@ -12,6 +13,24 @@ class FormattingError(StandardError):
     """
 
 
+def sizeof(obj, _seen=None):
+    """Estimate how many bytes obj and everything it references take up.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(k, _seen) + sizeof(v, _seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(x, _seen) for x in obj)
+    elif hasattr(obj, '__dict__'):
+        size += sizeof(obj.__dict__, _seen)
+    return size
+
+
 class Entry(object):
     """An entry in a QueryCache.
     """
@@ -19,6 +38,8 @@ class Entry(object):
     timestamp = None    # The timestamp of the last query run [datetime.datetime]
     lock = None         # Access control for this record [threading.Lock]
     exc = None          # Any exception in query or formatting [Exception]
+    size = 0            # Estimated memory used by result, if we're counting [bytes]
+    refreshing = False  # Whether a background refresh is under way [bool]
 
     def __init__(self, timestamp=0, lock=None, result=None):
         """Populate with dummy data or an actual db entry.
@@ -56,6 +77,19 @@ class QueryCache(object):
     entries on a more relaxed schedule (default: 60 seconds). It keeps the
     cache clean without interfering too much with actual usage.
 
+    To bound the cache, pass max_entries and/or max_bytes. Entries are then
+    kept in least-recently-used order, and the least recently used ones are
+    evicted whenever a check-in takes us over either limit. Memory use is an
+    estimate (see sizeof), computed once per query run.
+
+    Pass stale_while_revalidate (in seconds) to keep serving an expired entry
+    for that much longer past threshold while a single background thread
+    re-runs its query. Callers then never wait on an entry that has a result,
+    except the first time it's computed and once it's too stale to serve.
+
+    The hits, stale_hits, misses, refreshes and evictions attributes count
+    what the cache has been doing; stats returns them all as a dict.
+
     If the actual database call or the formatting callback raise an Exception,
     then that is cached as well, and will be raised on further calls until the
     cache expires as usual.
@@ -70,15 +104,25 @@ class QueryCache(object):
     locks = None            # access controls for self.cache [Locks]
     threshold = 5           # maximum life of a cache entry [seconds as int]
     threshold_prune = 60    # time between pruning runs [seconds as int]
+    max_entries = None      # maximum number of cache entries [int]
+    max_bytes = None        # maximum estimated size of cached results [bytes]
+    stale_while_revalidate = 0  # how long to serve expired entries [seconds]
+    nbytes = 0              # current estimated size of cached results [bytes]
 
+    hits = stale_hits = misses = refreshes = evictions = 0
 
-    def __init__(self, db, threshold=5, threshold_prune=60):
+
+    def __init__(self, db, threshold=5, threshold_prune=60, max_entries=None, max_bytes=None,
+                 stale_while_revalidate=0):
         """
         """
         self.db = db
         self.threshold = threshold
         self.threshold_prune = threshold_prune
-        self.cache = {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_while_revalidate = stale_while_revalidate
+        self.cache = OrderedDict()
 
         class Locks:
             checkin = threading.Lock()
@@ -130,7 +174,16 @@ class QueryCache(object):
 
                 entry = self.cache[key]
                 entry.lock.acquire()
-                entry = self.cache[key]
+                self.locks.checkin.acquire()
+                try:  # critical section
+                    current = self.cache.pop(key, None)
+                    if current is None:
+                        self.nbytes += entry.size  # It was evicted meanwhile.
+                    else:
+                        entry = current
+                    self.cache[key] = entry  # Mark as most recently used.
+                finally:
+                    self.locks.checkin.release()
 
             else:
 
@@ -164,12 +217,23 @@ class QueryCache(object):
             # Decide whether it's a hit or miss.
             # ==================================
 
-            if time.time() - entry.timestamp < self.threshold:  # cache hit
+            age = time.time() - entry.timestamp
+            if age < self.threshold:                            # cache hit
+                self._count('hits')
                 if entry.exc is not None:
                     raise entry.exc
                 return entry.result
 
+            elif entry.timestamp and entry.exc is None and \
+                 age < self.threshold + self.stale_while_revalidate:  # stale hit
+                self._count('stale_hits')
+                if not entry.refreshing:
+                    entry.refreshing = True
+                    self._refresh_in_background(key, entry, fetchfunc, query, params, process)
+                return entry.result
+
             else:                                               # cache miss
+                self._count('misses')
                 try:                    # XXX uses postgres.py api, not dbapi2!
                     entry.result = fetchfunc(query, params)
                     if process is not None:
@@ -185,19 +249,88 @@ class QueryCache(object):
             # Check the queryset back in.
             # ===========================
 
-            self.locks.checkin.acquire()
+            self._check_in(key, entry)
+            if entry.exc is not None:
+                raise entry.exc[0]
+            else:
+                return entry.result
+
+        finally:
+            entry.lock.release()
+
+
+    def _check_in(self, key, entry):
+        """Store a freshly computed entry, and evict others if we're over budget.
+        """
+        size = sizeof(entry.result) if self.max_bytes else 0
+        self.locks.checkin.acquire()
+        try:  # critical section
+            entry.timestamp = time.time()
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.size
+            entry.size = size
+            self.cache[key] = entry
+            self.nbytes += size
+            while len(self.cache) > 1 and (
+                (self.max_entries and len(self.cache) > self.max_entries) or
+                (self.max_bytes and self.nbytes > self.max_bytes)
+            ):
+                _, evicted = self.cache.popitem(last=False)
+                self.nbytes -= evicted.size
+                self.evictions += 1
+        finally:
+            self.locks.checkin.release()
+
+
+    def _refresh_in_background(self, key, entry, fetchfunc, query, params, process):
+        """Re-run an entry's query on another thread, without holding its lock.
+
+        If the query or the formatting callback fails we leave the old result
+        in place, and it's served until it's too stale, as if we hadn't tried.
+
+        """
+        def refresh():
+            try:
+                result = fetchfunc(query, params)
+                if process is not None:
+                    result = process(result)
+            except:
+                entry.refreshing = False
+                return
+            entry.lock.acquire()
             try:  # critical section
-                entry.timestamp = time.time()
-                self.cache[key] = entry
-                if entry.exc is not None:
-                    raise entry.exc[0]
-                else:
-                    return entry.result
+                entry.result = result
+                entry.exc = None
+                entry.refreshing = False
+                self._check_in(key, entry)
             finally:
-                self.locks.checkin.release()
+                entry.lock.release()
+            self._count('refreshes')
+        t = threading.Thread(target=refresh)
+        t.setDaemon(True)
+        t.start()
+
 
+    def _count(self, counter):
+        self.locks.checkin.acquire()
+        try:  # critical section
+            setattr(self, counter, getattr(self, counter) + 1)
         finally:
-            entry.lock.release()
+            self.locks.checkin.release()
+
+
+    def stats(self):
+        """Return our counters, along with the number and size of entries.
+        """
+        return dict( hits=self.hits
+                   , stale_hits=self.stale_hits
+                   , misses=self.misses
+                   , refreshes=self.refreshes
+                   , evictions=self.evictions
+                   , entries=len(self.cache)
+                   , nbytes=self.nbytes
+                    )
 
 
     def prune(self):
@@ -216,7 +349,13 @@ class QueryCache(object):
             self.locks.checkout.acquire()
             try:  # critical section
 
-                for key, entry in tuple(self.cache.items()):
+                self.locks.checkin.acquire()
+                try:  # critical section
+                    entries = tuple(self.cache.items())
+                finally:
+                    self.locks.checkin.release()
+
+                for key, entry in entries:
 
                     # Check out the entry.
                     # ====================
@@ -231,8 +370,17 @@ class QueryCache(object):
                     # ==================================
 
                     try:  # critical section
-                        if time.time() - entry.timestamp > self.threshold_prune:
-                            del self.cache[key]
+                        max_age = max( self.threshold_prune
+                                     , self.threshold + self.stale_while_revalidate
+                                      )
+                        if time.time() - entry.timestamp > max_age:
+                            self.locks.checkin.acquire()
+                            try:  # critical section
+                                if self.cache.get(key) is entry:
+                                    del self.cache[key]
+                                    self.nbytes -= entry.size
+                            finally:
+                                self.locks.checkin.release()
                     finally:
                         entry.lock.release()
 
@@ -0,0 +1,237 @@
+"""A cache for aggregate results, shared by every process on a host.
+
+Every gunicorn worker used to run its own copies of the same aggregate queries
+and keep its own copies of their results. With a SharedCache, each key lives in
+a memory-mapped file under one directory, as a pickled value behind a small
+header::
+
+    seq     unsigned 64-bit int, odd while a write is in progress
+    length  unsigned 64-bit int, how many bytes of pickle follow (0 for none)
+
+The version of a key is seq // 2. Writers hold an exclusive flock on the file,
+so there's only ever one at a time across processes. Readers don't lock at
+all: they retry if seq changed while they were copying (a seqlock). Each
+process also keeps the last value it unpickled for each key, with its version,
+so a read that finds the version unchanged doesn't copy or unpickle anything.
+
+Values are computed by the callables given to register. The first process to
+ask for a key that has never been written computes it; after that it's up to
+refresh or refresh_all. Every process runs refresh_all periodically (see
+main.py), but it skips the work if another process on the same host has just
+done it, so each host's cache is refreshed about once per period.
+
+Keys can also be registered with tags, in which case invalidate drops them
+when their data changes (see cache_invalidation). Every process is notified,
+and the first one to get to a key clears it; the next get recomputes it.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import cPickle as pickle
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from time import sleep, time
+
+
+HEADER = struct.Struct(b'<QQ')
+
+
+class SharedCache(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.computers = {}
+        self.tags = {}      # key -> frozenset of tags
+        self._fds = {}      # key -> file descriptor
+        self._maps = {}     # key -> mmap of the file
+        self._values = {}   # key -> (version, value) as last seen by this process
+        self._lock = threading.Lock()
+
+
+    def register(self, key, compute, tags=()):
+        """Use compute, a callable taking no arguments, to get values for key.
+        """
+        self.computers[key] = compute
+        self.tags[key] = frozenset(tags)
+
+
+    def get(self, key):
+        """Return the current value for key, computing it if nobody has yet.
+        """
+        version, value = self._read(key)
+        if version is None:
+            version, value = self.refresh(key, only_if_missing=True)
+        return value
+
+
+    def version(self, key):
+        """Return the version of key, or None if it has never been computed.
+        """
+        return self._read(key)[0]
+
+
+    def refresh(self, key, only_if_missing=False):
+        """Recompute key and publish the result to every process.
+
+        Returns a (version, value) tuple.
+
+        """
+        fd = self._open(key)
+        with self._lock:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if only_if_missing:
+                    version, value = self._read(key)
+                    if version is not None:
+                        # Someone else computed it while we waited for the lock.
+                        return version, value
+                value = self.computers[key]()
+                version = self._write(key, fd, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        self._values[key] = (version, value)
+        return version, value
+
+
+    def refresh_all(self, every=0):
+        """Recompute every key, unless another process on this host is doing
+        so, or did so less than every/2 seconds ago.
+        """
+        path = os.path.join(self.directory, 'refresh_all.lock')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+            st = os.fstat(fd)
+            if every and st.st_size and time() - st.st_mtime < every / 2:
+                return False
+            for key in sorted(self.computers):
+                self.refresh(key)
+            os.ftruncate(fd, 1)  # Non-empty means we've refreshed before.
+            os.utime(path, None)
+            return True
+        finally:
+            os.close(fd)  # This releases the lock too.
+
+
+    def clear(self):
+        """Forget every value, in all processes. Used by the test suite.
+        """
+        for key in self.computers:
+            self._clear(key)
+        self._values.clear()
+
+
+    def invalidate(self, tag):
+        """Forget the value of each key tagged with tag, or of every key if tag
+        is ``*``, in all processes.
+        """
+        for key, tags in self.tags.items():
+            if tag == '*' or tag in tags:
+                self._clear(key)
+
+
+    # Internals
+    # =========
+
+    def _clear(self, key):
+        # We never shrink the files, since another process reading past the
+        # new end of one of its maps would crash. An empty payload means no
+        # value.
+        fd = self._open(key)
+        with self._lock:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                m = self._map(key, remap=True)
+                if m is not None and HEADER.unpack_from(m, 0)[1] > 0:
+                    self._write(key, fd, b'')
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+    def _open(self, key):
+        fd = self._fds.get(key)
+        if fd is None:
+            with self._lock:
+                fd = self._fds.get(key)
+                if fd is None:
+                    path = os.path.join(self.directory, key + '.cache')
+                    fd = self._fds[key] = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        return fd
+
+
+    def _map(self, key, remap=False):
+        """Return an mmap of the whole file for key, or None if it's too short.
+        """
+        m = self._maps.get(key)
+        if m is None or remap:
+            size = os.fstat(self._open(key)).st_size
+            if size < HEADER.size:
+                self._maps.pop(key, None)
+                return None
+            m = self._maps[key] = mmap.mmap(self._open(key), size)
+        return m
+
+
+    def _read(self, key):
+        """Return (version, value) for key, or (None, None) if there's no value.
+        """
+        remap = False
+        for i in range(1000):
+            m = self._map(key, remap)
+            if m is None:
+                if remap:
+                    return None, None
+                remap = True
+                continue
+            remap = False
+            seq, length = HEADER.unpack_from(m, 0)
+            if seq == 0 or (length == 0 and seq % 2 == 0):
+                return None, None
+            if seq % 2:
+                sleep(0.001)  # A write is in progress.
+                continue
+            version = seq // 2
+            cached = self._values.get(key)
+            if cached and cached[0] == version:
+                return cached
+            if HEADER.size + length > len(m):
+                remap = True  # The file grew since we mapped it.
+                continue
+            data = m[HEADER.size:HEADER.size+length]
+            if HEADER.unpack_from(m, 0)[0] != seq:
+                continue
+            value = pickle.loads(data)
+            self._values[key] = (version, value)
+            return version, value
+        # The writer must have died mid-write. Pretend there's no value, so
+        # that the caller recomputes it.
+        return None, None
+
+
+    def _write(self, key, fd, data):
+        size = HEADER.size + len(data)
+        if os.fstat(fd).st_size < size:
+            # Leave room to grow, so we don't have to resize on every write.
+            npages = -(-size * 2 // mmap.PAGESIZE)
+            os.ftruncate(fd, npages * mmap.PAGESIZE)
+        m = self._map(key, remap=True)
+        seq = HEADER.unpack_from(m, 0)[0]
+        seq -= seq % 2  # In case a previous writer died mid-write.
+        HEADER.pack_into(m, 0, seq + 1, 0)
+        m[HEADER.size:size] = data
+        HEADER.pack_into(m, 0, seq + 2, len(data))
+        return (seq + 2) // 2
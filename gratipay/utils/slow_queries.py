@@ -0,0 +1,166 @@
+"""Keep a ranking of the heaviest queries across every process.
+
+Each GratipayDB has a SlowQueryLog. Our cursors (see sql_profiling) hand it
+every statement that takes longer than its threshold, and it aggregates them
+in memory by fingerprint, which is the statement with its literals and
+placeholders replaced by ``?``. Every so often flush adds those aggregates to
+the slow_queries table, which is what /dashboard/slow-queries shows, and
+samples a plan for the worst of them with ``EXPLAIN (ANALYZE, BUFFERS)``.
+
+We only EXPLAIN statements that look read-only, and even then we do it in a
+read-only transaction with a statement timeout, since ANALYZE means running
+the statement again. psycopg2 inlines parameters, so plans quote them in their
+conditions. We replace the strings in a plan with ``?`` before saving it,
+since they can be session tokens or API keys.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import re
+import threading
+import traceback
+
+from aspen import log_dammit
+from psycopg2 import IntegrityError
+
+
+_comments = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_literals = re.compile(r"""
+      '(?:[^']|'')*'                # strings
+    | %\([^)]+\)s | %s              # placeholders
+    | \b\d+(?:\.\d+)?\b             # numbers
+""", re.VERBOSE)
+_strings = re.compile(r"'(?:[^']|'')*'")  # as in _literals
+_lists = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_writes = re.compile(r"\b(?:INSERT|UPDATE|DELETE|TRUNCATE|CREATE|ALTER|DROP|LOCK)\b", re.IGNORECASE)
+
+
+def normalize(sql):
+    """Strip comments and literals out of sql, and collapse whitespace.
+    """
+    sql = _comments.sub(' ', sql)
+    sql = _literals.sub('?', sql)
+    sql = _lists.sub('(?)', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def redact(plan):
+    """Replace the string literals in an EXPLAIN plan with ``?``.
+
+    Numbers are left alone, the plan's costs and timings are numbers too.
+
+    """
+    return _strings.sub('?', plan)
+
+
+def fingerprint(normalized):
+    return hashlib.md5(normalized.encode('utf8')).hexdigest()
+
+
+def is_read_only(sql):
+    return sql.lstrip('( ').upper().startswith(('SELECT', 'WITH')) and not _writes.search(sql)
+
+
+class SlowQueryLog(object):
+
+    def __init__(self, db, threshold=0, explain_every=3600, explain_timeout=10, nexplain=3):
+        self.db = db
+        self.threshold = threshold              # seconds, 0 to turn this off
+        self.explain_every = explain_every      # seconds between plans for a fingerprint
+        self.explain_timeout = explain_timeout  # seconds
+        self.nexplain = nexplain                # the most plans to sample per flush
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def capture(self, sql, params, duration):
+        """Remember that sql took duration seconds to run with params.
+        """
+        if getattr(self._local, 'flushing', False):
+            return
+        normalized = normalize(sql)
+        key = fingerprint(normalized)
+        with self._lock:
+            slow = self._pending.get(key)
+            if slow is None:
+                slow = self._pending[key] = dict( fingerprint=key
+                                                , query=normalized
+                                                , calls=0
+                                                , total_time=0
+                                                , max_time=0
+                                                 )
+            slow['calls'] += 1
+            slow['total_time'] += duration * 1000
+            if duration * 1000 > slow['max_time']:
+                slow['max_time'] = duration * 1000
+                slow['sample'] = (sql, params)
+
+    def flush(self):
+        """Add what we've captured to the slow_queries table, and sample plans.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        self._local.flushing = True
+        try:
+            stale = []
+            for slow in pending.values():
+                if self._save(slow):
+                    stale.append(slow)
+            stale.sort(key=lambda slow: slow['max_time'], reverse=True)
+            for slow in stale[:self.nexplain]:
+                self._explain(slow)
+        finally:
+            self._local.flushing = False
+
+    def _save(self, slow):
+        """Upsert slow, and return whether its plan needs sampling.
+        """
+        for i in range(2):
+            try:
+                return self.db.one("""
+
+                    WITH updated AS (
+                        UPDATE slow_queries
+                           SET calls = calls + %(calls)s
+                             , total_time = total_time + %(total_time)s
+                             , max_time = greatest(max_time, %(max_time)s)
+                             , last_seen = now()
+                         WHERE fingerprint = %(fingerprint)s
+                     RETURNING plan_ts
+                    ), inserted AS (
+                        INSERT INTO slow_queries
+                                    (fingerprint, query, calls, total_time, max_time)
+                             SELECT %(fingerprint)s, %(query)s, %(calls)s, %(total_time)s
+                                  , %(max_time)s
+                              WHERE NOT EXISTS (SELECT * FROM updated)
+                          RETURNING plan_ts
+                    )
+                    SELECT coalesce(plan_ts < now() - %(explain_every)s * interval '1 second', true)
+                      FROM (SELECT * FROM updated UNION ALL SELECT * FROM inserted) AS foo
+
+                """, dict(slow, explain_every=self.explain_every))
+            except IntegrityError:
+                continue  # Another process inserted it first, update it instead.
+        return False
+
+    def _explain(self, slow):
+        sql, params = slow['sample']
+        if not is_read_only(sql):
+            return
+        try:
+            with self.db.get_cursor() as cursor:
+                cursor.run("SET TRANSACTION READ ONLY")
+                cursor.run("SET LOCAL statement_timeout = %s", (self.explain_timeout * 1000,))
+                plan = cursor.all("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+        except Exception:
+            log_dammit("Couldn't explain a slow query:", traceback.format_exc().strip())
+            return
+        self.db.run("""
+            UPDATE slow_queries
+               SET plan = %s
+                 , plan_ts = now()
+             WHERE fingerprint = %s
+        """, (redact('\n'.join(plan)), slow['fingerprint']))
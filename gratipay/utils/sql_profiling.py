@@ -0,0 +1,138 @@
+"""Record the SQL run by the current thread, for profiling requests.
+
+GratipayDB hands out the cursors defined here. They time every statement they
+execute, but only keep track of it if the current thread is recording, which
+timer.start arranges for each request, or if it was slow (see slow_queries).
+timer.end then logs what was recorded alongside the response time, and can add
+it to the response as a Server-Timing header.
+
+To profile something outside of a request::
+
+    with recording() as recorder:
+        do_something()
+    print(recorder.report())
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import heapq
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+from postgres.cursors import SimpleDictCursor, SimpleNamedTupleCursor, SimpleTupleCursor
+
+
+_local = threading.local()
+
+
+def normalize(sql):
+    """Collapse whitespace in sql, so that the same statement is counted once.
+    """
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+class QueryRecorder(object):
+    """Count the statements run on one thread, and keep the slowest ones.
+    """
+
+    def __init__(self, nslowest=5):
+        self.nslowest = nslowest
+        self.nqueries = 0
+        self.total_time = 0.0   # seconds
+        self.slowest = []       # a heap of (seconds, sql)
+        self.counts = Counter() # sql -> number of times it was run
+
+    def record(self, sql, duration):
+        sql = normalize(sql)
+        self.nqueries += 1
+        self.total_time += duration
+        self.counts[sql] += 1
+        if len(self.slowest) < self.nslowest:
+            heapq.heappush(self.slowest, (duration, sql))
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, sql))
+
+    def slowest_queries(self):
+        """Return (seconds, sql) tuples, slowest first.
+        """
+        return sorted(self.slowest, reverse=True)
+
+    def repeated_queries(self, threshold=2):
+        """Return (count, sql) tuples for the statements run at least threshold
+        times, most repeated first. These are usually N+1 patterns.
+        """
+        return sorted( ((n, sql) for sql, n in self.counts.items() if n >= threshold)
+                     , reverse=True
+                      )
+
+    def report(self):
+        lines = ["{} queries in {:.1f}ms".format(self.nqueries, self.total_time * 1000)]
+        for duration, sql in self.slowest_queries():
+            lines.append("  {:8.1f}ms  {}".format(duration * 1000, sql))
+        for n, sql in self.repeated_queries():
+            lines.append("  {:8}x   {}".format(n, sql))
+        return '\n'.join(lines)
+
+
+def start_recording(nslowest=5):
+    """Start recording the statements run by this thread, and return the recorder.
+    """
+    _local.recorder = QueryRecorder(nslowest)
+    return _local.recorder
+
+
+def stop_recording():
+    """Stop recording for this thread, and return the recorder (or None).
+    """
+    recorder = getattr(_local, 'recorder', None)
+    _local.recorder = None
+    return recorder
+
+
+@contextmanager
+def recording(nslowest=5):
+    recorder = start_recording(nslowest)
+    try:
+        yield recorder
+    finally:
+        stop_recording()
+
+
+class ProfilingCursorMixin(object):
+
+    def execute(self, sql, params=None):
+        recorder = getattr(_local, 'recorder', None)
+        slow_queries = getattr(self.connection.postgres, 'slow_queries', None)
+        if recorder is None and not (slow_queries and slow_queries.threshold):
+            return super(ProfilingCursorMixin, self).execute(sql, params)
+        start = time.time()
+        try:
+            return super(ProfilingCursorMixin, self).execute(sql, params)
+        finally:
+            duration = time.time() - start
+            if recorder is not None:
+                recorder.record(sql, duration)
+            if slow_queries and duration >= slow_queries.threshold > 0:
+                slow_queries.capture(sql, params, duration)
+
+
+class ProfilingTupleCursor(ProfilingCursorMixin, SimpleTupleCursor):
+    pass
+
+class ProfilingNamedTupleCursor(ProfilingCursorMixin, SimpleNamedTupleCursor):
+    pass
+
+class ProfilingDictCursor(ProfilingCursorMixin, SimpleDictCursor):
+    pass
+
+
+CURSORS = { tuple: ProfilingTupleCursor
+          , 'tuple': ProfilingTupleCursor
+          , namedtuple: ProfilingNamedTupleCursor
+          , 'namedtuple': ProfilingNamedTupleCursor
+          , dict: ProfilingDictCursor
+          , 'dict': ProfilingDictCursor
+           }
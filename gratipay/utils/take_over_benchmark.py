@@ -0,0 +1,151 @@
+"""Benchmark take_over as the number of tips on the site grows.
+
+This is installed as `take_over_benchmark`. Given an empty database, it bulk
+loads tips between fake participants in steps, and after each step times a few
+account merges that each move a handful of tips::
+
+    take_over_benchmark --tips 10000 100000 1000000 --json benchmarks.jsonl
+
+A merge only touches the tips to and from the two accounts being merged, so
+its latency should stay flat however many tips there are. We exit with an
+error if the median merge at the largest step is more than --tolerance slower
+than at the smallest.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import sys
+import time
+
+from gratipay import wireup
+from gratipay.utils.benchmarking import append_report, is_slower, median, require_empty_db
+from gratipay.version import get_version
+
+
+def add_tips(db, ntips, nparticipants):
+    """Add ntips tips between nparticipants background participants.
+    """
+    with db.get_cursor() as cursor:
+        start = cursor.one("SELECT count(*) FROM participants WHERE username LIKE 'bench%'")
+        cursor.run("""
+            INSERT INTO participants (username, username_lower, claimed_time)
+                 SELECT 'bench' || i, 'bench' || i, now()
+                   FROM generate_series(%s, %s) i
+        """, (start + 1, nparticipants))
+        cursor.run("""
+            INSERT INTO tips (ctime, tipper, tippee, amount)
+                 SELECT now()
+                      , 'bench' || (1 + (i %% %(n)s))
+                      , 'bench' || (1 + ((i + 1 + floor(random() * (%(n)s - 1))::int) %% %(n)s))
+                      , round((1 + random() * 24)::numeric, 2)
+                   FROM generate_series(1, %(ntips)s) i
+        """, dict(n=nparticipants, ntips=ntips))
+    db.run("ANALYZE tips")
+
+
+def make_pair(db, k, ntips):
+    """Make a live and a dead account, with ntips tips each to and from others.
+    """
+    live, dead = 'live%i' % k, 'dead%i' % k
+    with db.get_cursor() as cursor:
+        for username, platform in ((live, 'twitter'), (dead, 'github')):
+            cursor.run("""
+                INSERT INTO participants (username, username_lower, claimed_time)
+                     VALUES (%(username)s, %(username)s, now());
+                INSERT INTO elsewhere (platform, user_id, user_name, participant)
+                     VALUES (%(platform)s, %(username)s, %(username)s, %(username)s);
+                INSERT INTO tips (ctime, tipper, tippee, amount)
+                     SELECT now(), %(username)s, 'bench' || i, 1
+                       FROM generate_series(1, %(ntips)s) i
+                  UNION ALL
+                     SELECT now(), 'bench' || i, %(username)s, 1
+                       FROM generate_series(1, %(ntips)s) i;
+            """, dict(username=username, platform=platform, ntips=ntips))
+    return live, dead
+
+
+def time_merges(db, nmerges, ntips, first=0):
+    """Return how many seconds each of nmerges take_overs took.
+    """
+    from gratipay.models.participant import Participant
+
+    seconds = []
+    for k in range(first, first + nmerges):
+        live, dead = make_pair(db, k, ntips)
+        live = Participant.from_username(live)
+        start = time.time()
+        live.take_over(('github', dead), have_confirmation=True)
+        seconds.append(time.time() - start)
+    return seconds
+
+
+def run(db, steps, nmerges=5, nparticipants=1000, ntips_per_account=10):
+    """Grow the tips table to each number of tips in steps, time merges after
+    each, and return a report as a dict.
+    """
+    require_empty_db(db, 'take_over')
+
+    results = []
+    for ntips in sorted(steps):
+        add_tips(db, max(ntips - db.one("SELECT count(*) FROM tips"), 0), nparticipants)
+        seconds = time_merges(db, nmerges, ntips_per_account, first=len(results) * nmerges)
+        results.append(dict(tips=ntips, seconds=seconds, median=median(seconds)))
+
+    return { 'version': get_version()
+           , 'participants': nparticipants
+           , 'tips_per_account': ntips_per_account
+           , 'merges': nmerges
+           , 'steps': results
+            }
+
+
+def print_report(report):
+    print("take_over benchmark for %(version)s: %(merges)i merges per step, "
+          "%(tips_per_account)i tips to and from each account." % report)
+    print()
+    for step in report['steps']:
+        print("%12i tips %10.1fms median %10.1fms max" % ( step['tips']
+                                                         , step['median'] * 1000
+                                                         , max(step['seconds']) * 1000
+                                                          ))
+
+
+def grew(report, tolerance):
+    """Return whether the median merge got more than tolerance slower from the
+    smallest step to the largest.
+    """
+    steps = report['steps']
+    return is_slower(steps[-1]['median'], steps[0]['median'], tolerance)
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Benchmark take_over on fake data.")
+    parser.add_argument('--tips', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="the numbers of tips to time merges at")
+    parser.add_argument('--merges', type=int, default=5,
+                        help="number of merges to time at each step")
+    parser.add_argument('--participants', type=int, default=1000,
+                        help="number of participants to spread the tips across")
+    parser.add_argument('--json', help="append the report to this file as a JSON line")
+    parser.add_argument('--tolerance', type=float, default=1.0,
+                        help="how much slower the largest step may be (default: 1.0)")
+    args = parser.parse_args(argv)
+
+    env = wireup.env()
+    db = wireup.db(env)
+
+    report = run(db, args.tips, args.merges, args.participants)
+    print_report(report)
+
+    if args.json:
+        append_report(args.json, report)
+
+    if grew(report, args.tolerance):
+        print()
+        print("Merges got slower as tips grew.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
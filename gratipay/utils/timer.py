@@ -1,10 +1,36 @@
 import time
 
+from gratipay.models import identity_map
+from gratipay.utils import sql_profiling
+
+
+def _bytes(s):
+    return s.encode('utf8') if isinstance(s, unicode) else s
+
+
 def start():
+    sql_profiling.start_recording()
     return {'start_time': time.time()}
 
-def end(start_time, website):
+def end(start_time, website, request=None, response=None):
+    recorder = sql_profiling.stop_recording() or sql_profiling.QueryRecorder()
+    identity = identity_map.stop()
+    response_time = time.time() - start_time
     if website.log_metrics:
         print("count#requests=1")
-        response_time = time.time() - start_time
         print("measure#response_time={}ms".format(response_time * 1000))
+        print("measure#db_time={}ms".format(recorder.total_time * 1000))
+        print("measure#db_queries={}".format(recorder.nqueries))
+        repeated = recorder.repeated_queries()
+        if repeated:
+            # Most likely an N+1 pattern, say where.
+            path = _bytes(request.line.uri.path.raw) if request else ''
+            print("count#db_repeated_queries={} path={}".format(sum(n for n, _ in repeated), path))
+        if identity and identity.hits:
+            print("count#identity_map_hits={}".format(identity.hits))
+        for duration, sql in recorder.slowest_queries()[:1]:
+            print("measure#db_slowest_query={}ms sql=\"{}\"".format(duration * 1000, _bytes(sql[:200])))
+    if website.server_timing and response is not None:
+        response.headers['Server-Timing'] = b'db;dur=%.1f;desc="%i queries", app;dur=%.1f' % (
+            recorder.total_time * 1000, recorder.nqueries, response_time * 1000
+        )
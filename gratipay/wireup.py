@@ -35,12 +35,17 @@ from gratipay.models.exchange_route import ExchangeRoute
 from gratipay.models.participant import Participant
 from gratipay.models.team import Team
 from gratipay.models import GratipayDB
-from gratipay.utils.emails import compile_email_spt
+from gratipay.utils import aggregates
+from gratipay.utils.emails import compile_email_spt, MandrillTransport
 from gratipay.utils.http_caching import asset_etag
 from gratipay.utils.i18n import (
     ALIASES, ALIASES_R, COUNTRIES, LANGUAGES_2, LOCALES,
     get_function_from_rule, make_sorted_dict
 )
+from gratipay.security.session_cache import SessionCache
+from gratipay.utils.cache_invalidation import Invalidator
+from gratipay.utils.query_cache import QueryCache
+from gratipay.utils.shared_cache import SharedCache
 
 def base_url(website, env):
     gratipay.base_url = website.base_url = env.base_url
@@ -52,6 +57,7 @@ def db(env):
     dburl = env.database_url
     maxconn = env.database_maxconn
     db = GratipayDB(dburl, maxconn=maxconn)
+    db.slow_queries.threshold = env.slow_query_threshold / 1000
 
     for model in (AccountElsewhere, Community, ExchangeRoute, Participant, Team):
         db.register_model(model)
@@ -61,6 +67,9 @@ def db(env):
 
 def mail(env, project_root='.'):
     Participant._mailer = mandrill.Mandrill(env.mandrill_key)
+    Participant._email_transport = MandrillTransport(Participant._mailer, env.dequeue_emails_rate)
+    Participant.email_batch_size = env.dequeue_emails_batch_size
+    Participant.email_render_threads = env.dequeue_emails_threads
     emails = {}
     emails_dir = project_root+'/emails/'
     i = len(emails_dir)
@@ -81,9 +90,36 @@ def billing(env):
         braintree_env,
         env.braintree_merchant_id,
         env.braintree_public_key,
-        env.braintree_private_key
+        env.braintree_private_key,
+        timeout=env.braintree_timeout
     )
 
+    Payday = gratipay.billing.payday.Payday
+    Payday.gateway_threads = env.payday_gateway_threads
+    Payday.gateway_rate = env.payday_gateway_rate
+    Payday.gateway_retries = env.payday_gateway_retries
+
+
+def shared_cache(website, env):
+    website.shared_cache = SharedCache(env.shared_cache_dir)
+    aggregates.register(website.shared_cache, website.db)
+
+def cache_invalidation(website, env):
+    website.invalidator = Invalidator(website.db)
+    website.invalidator.subscribe(website.shared_cache.invalidate)
+    if env.listen_for_cache_invalidation:
+        website.invalidator.start()
+
+def query_cache(website, env):
+    website.query_cache = QueryCache( website.db
+                                    , threshold=env.query_cache_ttl
+                                    , max_entries=env.query_cache_size
+                                    , max_bytes=env.query_cache_max_bytes
+                                    , stale_while_revalidate=env.query_cache_stale_ttl
+                                     )
+
+def session_cache(env):
+    Participant.session_cache = SessionCache(env.session_cache_ttl, env.session_cache_size)
 
 def team_review(env):
     Team.review_repo = env.team_review_repo
@@ -358,6 +394,7 @@ def other_stuff(website, env):
     website.include_piwik = env.include_piwik
 
     website.log_metrics = env.log_metrics
+    website.server_timing = env.server_timing
 
 
 def env():
@@ -373,6 +410,10 @@ def env():
         BRAINTREE_MERCHANT_ID           = unicode,
         BRAINTREE_PUBLIC_KEY            = unicode,
         BRAINTREE_PRIVATE_KEY           = unicode,
+        BRAINTREE_TIMEOUT               = int,
+        PAYDAY_GATEWAY_THREADS          = int,
+        PAYDAY_GATEWAY_RATE             = float,
+        PAYDAY_GATEWAY_RETRIES          = int,
         GITHUB_CLIENT_ID                = unicode,
         GITHUB_CLIENT_SECRET            = unicode,
         GITHUB_CALLBACK                 = unicode,
@@ -402,16 +443,35 @@ def env():
         OPENSTREETMAP_AUTH_URL          = unicode,
         UPDATE_CTA_EVERY                = int,
         CHECK_DB_EVERY                  = int,
+        AUDIT_DB_EVERY                  = int,
+        RECONCILE_COUNTERS_EVERY        = int,
+        SNAPSHOT_BALANCES_EVERY         = int,
+        SNAPSHOT_MONTHLY_BALANCES       = is_yesish,
         DEQUEUE_EMAILS_EVERY            = int,
+        REFRESH_SHARED_CACHE_EVERY      = int,
+        SHARED_CACHE_DIR                = unicode,
+        LISTEN_FOR_CACHE_INVALIDATION   = is_yesish,
+        DEQUEUE_EMAILS_RATE             = float,
+        DEQUEUE_EMAILS_BATCH_SIZE       = int,
+        DEQUEUE_EMAILS_THREADS          = int,
         OPTIMIZELY_ID                   = unicode,
         SENTRY_DSN                      = unicode,
         LOG_METRICS                     = is_yesish,
+        SERVER_TIMING                   = is_yesish,
+        SLOW_QUERY_THRESHOLD            = int,
+        FLUSH_SLOW_QUERIES_EVERY        = int,
         INCLUDE_PIWIK                   = is_yesish,
         MANDRILL_KEY                    = unicode,
         TEAM_REVIEW_REPO                = unicode,
         TEAM_REVIEW_USERNAME            = unicode,
         TEAM_REVIEW_TOKEN               = unicode,
         RAISE_SIGNIN_NOTIFICATIONS      = is_yesish,
+        SESSION_CACHE_TTL               = int,
+        SESSION_CACHE_SIZE              = int,
+        QUERY_CACHE_TTL                 = int,
+        QUERY_CACHE_STALE_TTL           = int,
+        QUERY_CACHE_SIZE                = int,
+        QUERY_CACHE_MAX_BYTES           = int,
 
         # This is used in our Procfile. (PORT is also used but is provided by
         # Heroku; we don't set it ourselves in our app config.)
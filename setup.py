@@ -9,6 +9,8 @@ setup( name='gratipay'
      , entry_points = { 'console_scripts'
                       : [ 'payday=gratipay.cli:payday'
                         , 'fake_data=gratipay.utils.fake_data:main'
+                        , 'payday_benchmark=gratipay.utils.payday_benchmark:main'
+                        , 'take_over_benchmark=gratipay.utils.take_over_benchmark:main'
                          ]
                        }
       )
@@ -0,0 +1,689 @@
+-- Let a restarted payday pick up where it left off with Braintree
+BEGIN;
+
+    ALTER TABLE paydays ADD COLUMN checkpoints text[] NOT NULL DEFAULT '{}';
+
+    -- failed and skipped rows record attempts that didn't leave us a hold, so
+    -- that a restart knows it doesn't have to look for one in Braintree.
+    CREATE TYPE card_hold_status AS ENUM
+        ('authorized', 'captured', 'voided', 'failed', 'skipped');
+
+    CREATE TABLE card_holds
+    ( id            text                DEFAULT NULL -- Braintree's transaction id
+    , payday        int                 NOT NULL REFERENCES paydays
+                                            ON UPDATE RESTRICT ON DELETE RESTRICT
+    , participant   bigint              NOT NULL REFERENCES participants(id)
+    , amount        numeric(35,2)       NOT NULL
+    , token         text                DEFAULT NULL -- the credit card's token
+    , status        card_hold_status    NOT NULL DEFAULT 'authorized'
+    , UNIQUE (payday, id)
+    , CHECK ((id IS NULL) = (status IN ('failed', 'skipped')))
+     );
+
+END;
+
+
+-- Record how long each step of payday takes
+BEGIN;
+
+    CREATE TABLE payday_metrics
+    ( id            serial                      PRIMARY KEY
+    , payday        int                         NOT NULL REFERENCES paydays
+                                                    ON UPDATE RESTRICT ON DELETE RESTRICT
+    , stage         text                        NOT NULL
+    , ts_start      timestamp with time zone    NOT NULL
+    , ts_end        timestamp with time zone    NOT NULL
+    , nrows         bigint                      DEFAULT NULL
+    , ncalls        bigint                      NOT NULL DEFAULT 0
+    , UNIQUE (payday, stage)
+     );
+
+END;
+
+
+-- Let several workers share the email queue
+BEGIN;
+    ALTER TABLE email_queue ADD COLUMN claimed_until timestamptz DEFAULT NULL;
+END;
+
+
+-- Publish cache invalidation tags when things change
+BEGIN;
+
+    CREATE FUNCTION notify_cache_invalidation() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('cache_invalidation', TG_ARGV[0]);
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE FUNCTION notify_cache_invalidation_of_event() RETURNS trigger AS $$
+        DECLARE
+            slug text;
+        BEGIN
+            IF NEW.type = 'participant' THEN
+                PERFORM pg_notify('cache_invalidation', 'participant:' || (NEW.payload->>'id'));
+            ELSE
+                slug := (SELECT t.slug FROM teams t WHERE t.id = (NEW.payload->>'id')::bigint);
+                IF slug IS NOT NULL THEN
+                    PERFORM pg_notify('cache_invalidation', 'team:' || slug);
+                END IF;
+            END IF;
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER invalidate_event AFTER INSERT ON events
+        FOR EACH ROW WHEN (NEW.type IN ('participant', 'team') AND NEW.payload->>'id' IS NOT NULL)
+        EXECUTE PROCEDURE notify_cache_invalidation_of_event();
+
+    CREATE FUNCTION notify_cache_invalidation_of_payment_instruction() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('cache_invalidation', 'payment_instructions');
+            PERFORM pg_notify('cache_invalidation', 'team:' || NEW.team);
+            PERFORM pg_notify( 'cache_invalidation'
+                             , 'participant:' || (SELECT p.id FROM participants p
+                                                   WHERE p.username = NEW.participant)
+                              );
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    -- Payday updates payment instructions in bulk, so we only notify once per
+    -- statement for updates. Postgres checks each NOTIFY against the ones
+    -- already pending in the transaction, which gets slow with many of them.
+    CREATE TRIGGER invalidate_payment_instruction AFTER INSERT ON payment_instructions
+        FOR EACH ROW EXECUTE PROCEDURE notify_cache_invalidation_of_payment_instruction();
+    CREATE TRIGGER invalidate_payment_instructions AFTER UPDATE ON payment_instructions
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_cache_invalidation('payment_instructions');
+
+    CREATE TRIGGER invalidate_paydays AFTER INSERT OR UPDATE ON paydays
+        FOR EACH STATEMENT EXECUTE PROCEDURE notify_cache_invalidation('paydays');
+
+END;
+
+
+-- Rank the heaviest queries across processes
+BEGIN;
+
+    CREATE TABLE slow_queries
+    ( fingerprint   text                        PRIMARY KEY
+    , query         text                        NOT NULL
+    , calls         bigint                      NOT NULL DEFAULT 0
+    , total_time    float8                      NOT NULL DEFAULT 0 -- milliseconds
+    , max_time      float8                      NOT NULL DEFAULT 0 -- milliseconds
+    , first_seen    timestamp with time zone    NOT NULL DEFAULT now()
+    , last_seen     timestamp with time zone    NOT NULL DEFAULT now()
+    , plan          text                        DEFAULT NULL
+    , plan_ts       timestamp with time zone    DEFAULT NULL
+     );
+
+END;
+
+
+-- Check balances against new ledger rows only
+BEGIN;
+
+    CREATE TABLE ledger_checkpoints
+    ( id            serial                      PRIMARY KEY
+    , ts            timestamp with time zone    NOT NULL DEFAULT now()
+    , exchanges     bigint                      NOT NULL
+    , transfers     bigint                      NOT NULL
+    , payments      bigint                      NOT NULL
+     );
+
+    CREATE TABLE balance_checkpoints
+    ( participant   bigint          PRIMARY KEY REFERENCES participants(id)
+                                        ON UPDATE CASCADE ON DELETE CASCADE
+    , balance       numeric(35,2)   NOT NULL
+     );
+
+END;
+
+
+-- Keep the current rows of tips, takes, payment instructions and exchange
+-- routes in tables maintained by triggers, instead of sorting history
+BEGIN;
+
+    CREATE TABLE current_tip_ids
+    ( tipper    text    NOT NULL REFERENCES participants ON UPDATE CASCADE ON DELETE CASCADE
+    , tippee    text    NOT NULL REFERENCES participants ON UPDATE CASCADE ON DELETE CASCADE
+    , id        int     NOT NULL UNIQUE
+    , PRIMARY KEY (tipper, tippee)
+     );
+    CREATE INDEX current_tip_ids_tippee_idx ON current_tip_ids (tippee);
+
+    CREATE TABLE current_take_ids
+    ( member    text    NOT NULL REFERENCES participants ON UPDATE CASCADE ON DELETE CASCADE
+    , team      text    NOT NULL REFERENCES participants ON UPDATE CASCADE ON DELETE CASCADE
+    , id        int     NOT NULL UNIQUE
+    , PRIMARY KEY (member, team)
+     );
+    CREATE INDEX current_take_ids_team_idx ON current_take_ids (team);
+
+    CREATE TABLE current_payment_instruction_ids
+    ( participant   text    NOT NULL REFERENCES participants ON UPDATE CASCADE ON DELETE CASCADE
+    , team          text    NOT NULL REFERENCES teams ON UPDATE CASCADE ON DELETE CASCADE
+    , id            int     NOT NULL UNIQUE
+    , PRIMARY KEY (participant, team)
+     );
+    CREATE INDEX current_payment_instruction_ids_team_idx
+        ON current_payment_instruction_ids (team);
+
+    CREATE TABLE current_exchange_route_ids
+    ( participant   bigint          NOT NULL REFERENCES participants(id) ON DELETE CASCADE
+    , network       payment_net     NOT NULL
+    , id            int             NOT NULL UNIQUE
+    , PRIMARY KEY (participant, network)
+     );
+
+    INSERT INTO current_tip_ids
+         SELECT DISTINCT ON (tipper, tippee) tipper, tippee, id
+           FROM tips
+       ORDER BY tipper, tippee, mtime DESC, id DESC;
+    INSERT INTO current_take_ids
+         SELECT DISTINCT ON (member, team) member, team, id
+           FROM takes
+       ORDER BY member, team, mtime DESC, id DESC;
+    INSERT INTO current_payment_instruction_ids
+         SELECT DISTINCT ON (participant, team) participant, team, id
+           FROM payment_instructions
+       ORDER BY participant, team, mtime DESC, id DESC;
+    INSERT INTO current_exchange_route_ids
+         SELECT DISTINCT ON (participant, network) participant, network, id
+           FROM exchange_routes
+       ORDER BY participant, network, id DESC;
+
+    -- The triggers are generic: TG_ARGV gives the table of current ids, the
+    -- two columns that identify a pair, and how to order rows (latest first).
+
+    CREATE FUNCTION set_current_id() RETURNS trigger AS $$
+        DECLARE
+            cur text := TG_ARGV[0];
+            a text := TG_ARGV[1];
+            b text := TG_ARGV[2];
+            ordering text := TG_ARGV[3];
+        BEGIN
+            LOOP
+                -- Point the pair at the new row, if it sorts before the current one.
+                EXECUTE format('
+                    UPDATE %1$I c
+                       SET id = ($1).id
+                     WHERE c.%2$I = ($1).%2$I AND c.%3$I = ($1).%3$I
+                       AND ( SELECT h.id FROM %4$I h
+                              WHERE h.id IN (c.id, ($1).id)
+                           ORDER BY %5$s
+                              LIMIT 1 ) = ($1).id
+                    ', cur, a, b, TG_TABLE_NAME, ordering)
+                USING NEW;
+                IF FOUND THEN
+                    RETURN NULL;
+                END IF;
+                BEGIN
+                    EXECUTE format('
+                        INSERT INTO %1$I (%2$I, %3$I, id)
+                             SELECT ($1).%2$I, ($1).%3$I, ($1).id
+                              WHERE NOT EXISTS ( SELECT 1 FROM %1$I c
+                                                  WHERE c.%2$I = ($1).%2$I AND c.%3$I = ($1).%3$I )
+                        ', cur, a, b)
+                    USING NEW;
+                    RETURN NULL;
+                EXCEPTION WHEN unique_violation THEN
+                    -- Another transaction added the pair first, try again.
+                END;
+            END LOOP;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE FUNCTION reset_current_id() RETURNS trigger AS $$
+        DECLARE
+            cur text := TG_ARGV[0];
+            a text := TG_ARGV[1];
+            b text := TG_ARGV[2];
+            ordering text := TG_ARGV[3];
+        BEGIN
+            EXECUTE format('DELETE FROM %I WHERE id = $1', cur) USING OLD.id;
+            IF FOUND THEN
+                EXECUTE format('
+                    INSERT INTO %1$I (%2$I, %3$I, id)
+                         SELECT h.%2$I, h.%3$I, h.id
+                           FROM %4$I h
+                          WHERE h.%2$I = ($1).%2$I AND h.%3$I = ($1).%3$I
+                       ORDER BY %5$s
+                          LIMIT 1
+                    ', cur, a, b, TG_TABLE_NAME, ordering)
+                USING OLD;
+            END IF;
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER set_current_tip AFTER INSERT ON tips
+        FOR EACH ROW EXECUTE PROCEDURE
+        set_current_id('current_tip_ids', 'tipper', 'tippee', 'h.mtime DESC, h.id DESC');
+    CREATE TRIGGER reset_current_tip AFTER DELETE ON tips
+        FOR EACH ROW EXECUTE PROCEDURE
+        reset_current_id('current_tip_ids', 'tipper', 'tippee', 'h.mtime DESC, h.id DESC');
+
+    CREATE TRIGGER set_current_take AFTER INSERT ON takes
+        FOR EACH ROW EXECUTE PROCEDURE
+        set_current_id('current_take_ids', 'member', 'team', 'h.mtime DESC, h.id DESC');
+    CREATE TRIGGER reset_current_take AFTER DELETE ON takes
+        FOR EACH ROW EXECUTE PROCEDURE
+        reset_current_id('current_take_ids', 'member', 'team', 'h.mtime DESC, h.id DESC');
+
+    CREATE TRIGGER set_current_payment_instruction AFTER INSERT ON payment_instructions
+        FOR EACH ROW EXECUTE PROCEDURE
+        set_current_id('current_payment_instruction_ids', 'participant', 'team', 'h.mtime DESC, h.id DESC');
+    CREATE TRIGGER reset_current_payment_instruction AFTER DELETE ON payment_instructions
+        FOR EACH ROW EXECUTE PROCEDURE
+        reset_current_id('current_payment_instruction_ids', 'participant', 'team', 'h.mtime DESC, h.id DESC');
+
+    CREATE TRIGGER set_current_exchange_route AFTER INSERT ON exchange_routes
+        FOR EACH ROW EXECUTE PROCEDURE
+        set_current_id('current_exchange_route_ids', 'participant', 'network', 'h.id DESC');
+    CREATE TRIGGER reset_current_exchange_route AFTER DELETE ON exchange_routes
+        FOR EACH ROW EXECUTE PROCEDURE
+        reset_current_id('current_exchange_route_ids', 'participant', 'network', 'h.id DESC');
+
+    -- Point the views at the new tables. They keep their columns, and the
+    -- convenience triggers for updating through them.
+
+    DROP VIEW current_tips;
+    CREATE VIEW current_tips AS
+        SELECT t.*
+          FROM current_tip_ids c
+          JOIN tips t ON t.id = c.id;
+    CREATE TRIGGER update_current_tip INSTEAD OF UPDATE ON current_tips
+        FOR EACH ROW EXECUTE PROCEDURE update_tip();
+
+    DROP VIEW current_takes;
+    CREATE VIEW current_takes AS
+        SELECT t.*
+          FROM current_take_ids c
+          JOIN takes t ON t.id = c.id
+          JOIN participants p1 ON p1.username = t.member
+          JOIN participants p2 ON p2.username = t.team
+         WHERE p1.is_suspicious IS NOT TRUE
+           AND p2.is_suspicious IS NOT TRUE
+           AND t.amount > 0;
+
+    DROP VIEW current_payment_instructions;
+    CREATE VIEW current_payment_instructions AS
+        SELECT pi.*
+          FROM current_payment_instruction_ids c
+          JOIN payment_instructions pi ON pi.id = c.id;
+    CREATE TRIGGER update_current_payment_instruction
+        INSTEAD OF UPDATE ON current_payment_instructions
+        FOR EACH ROW EXECUTE PROCEDURE update_payment_instruction();
+
+    DROP CAST (current_exchange_routes AS exchange_routes);
+    DROP VIEW current_exchange_routes;
+    CREATE VIEW current_exchange_routes AS
+        SELECT r.*
+          FROM current_exchange_route_ids c
+          JOIN exchange_routes r ON r.id = c.id;
+    CREATE CAST (current_exchange_routes AS exchange_routes) WITH INOUT;
+
+END;
+
+
+-- Set payment instructions and update everything that depends on them in one
+-- round trip. This does what Participant.set_payment_instruction used to do
+-- with update_giving, update_due and update_is_free_rider, for many
+-- instructions at once.
+BEGIN;
+
+    CREATE FUNCTION set_payment_instructions
+        ( p_participants text[]
+        , p_teams text[]
+        , p_amounts numeric[]
+        , p_update_givers boolean
+         )
+    RETURNS SETOF payment_instructions AS $$
+        DECLARE
+            new_ids int[];
+        BEGIN
+            WITH inserted AS (
+                INSERT INTO payment_instructions
+                            (ctime, participant, team, amount)
+                     SELECT COALESCE (( SELECT y.ctime
+                                          FROM payment_instructions y
+                                         WHERE y.participant = p_participants[i]
+                                           AND y.team = p_teams[i]
+                                         LIMIT 1
+                                        ), CURRENT_TIMESTAMP)
+                          , p_participants[i], p_teams[i], p_amounts[i]
+                       FROM generate_subscripts(p_participants, 1) i
+                   ORDER BY i
+                  RETURNING id
+            )
+            SELECT array_agg(id) INTO new_ids FROM inserted;
+
+            -- When the same pair comes up more than once the last one wins,
+            -- so from here on we only look at the current instructions.
+
+            IF p_update_givers THEN
+                -- update_giving
+                UPDATE current_payment_instructions cpi
+                   SET is_funded = true
+                 WHERE cpi.participant IN (SELECT unnest(p_participants))
+                   AND cpi.is_funded IS NOT true
+                   AND ( SELECT r.error
+                           FROM current_exchange_routes r
+                           JOIN participants p ON p.id = r.participant
+                          WHERE p.username = cpi.participant
+                            AND r.network = 'braintree-cc'
+                        ) = '';
+                UPDATE participants p
+                   SET giving = COALESCE(g.giving, 0)
+                     , ngiving_to = COALESCE(g.ngiving_to, 0)
+                  FROM ( SELECT u.username, sum(cpi.amount) AS giving, count(cpi.amount) AS ngiving_to
+                           FROM (SELECT DISTINCT unnest(p_participants) AS username) u
+                      LEFT JOIN ( current_payment_instructions cpi
+                                  JOIN teams t ON t.slug = cpi.team AND t.is_approved
+                                 ) ON cpi.participant = u.username
+                                  AND cpi.amount > 0
+                                  AND cpi.is_funded
+                       GROUP BY u.username
+                        ) g
+                 WHERE p.username = g.username;
+
+                -- update_due
+                UPDATE payment_instructions pi
+                   SET due = COALESCE(( SELECT y.due
+                                          FROM payment_instructions y
+                                         WHERE y.participant = pi.participant
+                                           AND y.team = pi.team
+                                           AND y.due > 0
+                                         LIMIT 1
+                                      ), 0)
+                  FROM current_payment_instruction_ids c
+                 WHERE c.id = ANY(new_ids)
+                   AND pi.id = c.id;
+                UPDATE payment_instructions y
+                   SET due = 0
+                  FROM current_payment_instruction_ids c
+                 WHERE c.id = ANY(new_ids)
+                   AND y.participant = c.participant
+                   AND y.team = c.team
+                   AND y.due > 0
+                   AND y.id <> c.id;
+            END IF;
+
+            -- Teams' receiving and their owners' taking are kept up to date by
+            -- triggers.
+
+            -- update_is_free_rider
+            WITH riders AS (
+                UPDATE participants p
+                   SET is_free_rider = CASE WHEN cpi.amount = 0 THEN NULL ELSE false END
+                  FROM current_payment_instructions cpi
+                 WHERE cpi.id = ANY(new_ids)
+                   AND cpi.team = 'Gratipay'
+                   AND p.username = cpi.participant
+             RETURNING p.id, p.is_free_rider
+            )
+            INSERT INTO events (type, payload)
+                 SELECT 'participant'
+                      , ( '{"id": ' || id || ', "action": "set", '
+                          '"values": {"is_free_rider": '
+                          || COALESCE(is_free_rider::text, 'null') || '}}'
+                         )::json
+                   FROM riders;
+
+            RETURN QUERY SELECT * FROM payment_instructions WHERE id = ANY(new_ids) ORDER BY id;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE FUNCTION set_payment_instruction
+        ( p_participant text
+        , p_team text
+        , p_amount numeric
+        , p_update_self boolean
+         )
+    RETURNS TABLE ( id int, ctime timestamptz, mtime timestamptz, participant text, team text
+                  , amount numeric, is_funded boolean, due numeric
+                  , giving numeric, ngiving_to int, is_free_rider boolean
+                  , receiving numeric, nreceiving_from int, distributing numeric
+                  , ndistributing_to int, owner text, taking numeric, ntaking_from int
+                   ) AS $$
+        #variable_conflict use_column
+        DECLARE
+            pi payment_instructions;
+            p participants;
+            t teams;
+            o participants;
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM teams WHERE slug = p_team) THEN
+                RETURN;
+            END IF;
+
+            SELECT * INTO pi
+              FROM set_payment_instructions( ARRAY[p_participant], ARRAY[p_team], ARRAY[p_amount]
+                                           , p_update_self
+                                            );
+            SELECT * INTO p FROM participants WHERE username = p_participant;
+            SELECT * INTO t FROM teams WHERE slug = p_team;
+            SELECT * INTO o FROM participants WHERE username = t.owner;
+
+            RETURN QUERY SELECT pi.id, pi.ctime, pi.mtime, pi.participant, pi.team
+                              , pi.amount, pi.is_funded, pi.due
+                              , p.giving, p.ngiving_to, p.is_free_rider
+                              , t.receiving, t.nreceiving_from, t.distributing
+                              , t.ndistributing_to, t.owner, o.taking, o.ntaking_from;
+        END;
+    $$ LANGUAGE plpgsql;
+
+END;
+
+
+-- Keep teams.receiving and participants.taking up to date by applying deltas
+-- as payment instructions change, instead of aggregating everything a team
+-- receives (and everything its owner owns) on every change. Deleting payment
+-- instructions isn't accounted for, since we keep them as history; the
+-- reconcile_counters cron job fixes whatever drift that or anything else
+-- causes.
+BEGIN;
+
+    -- Start from the right numbers.
+    UPDATE teams t
+       SET receiving = COALESCE(r.receiving, 0)
+         , nreceiving_from = COALESCE(r.nreceiving_from, 0)
+         , distributing = COALESCE(r.receiving, 0)
+         , ndistributing_to = 1
+      FROM ( SELECT t.slug, sum(cpi.amount) AS receiving, count(cpi.amount) AS nreceiving_from
+               FROM teams t
+          LEFT JOIN ( current_payment_instructions cpi
+                      JOIN participants p ON p.username = cpi.participant
+                                         AND p.is_suspicious IS NOT true
+                     ) ON cpi.team = t.slug
+                      AND cpi.amount > 0
+                      AND cpi.is_funded
+           GROUP BY t.slug
+            ) r
+     WHERE t.slug = r.slug;
+    UPDATE participants p
+       SET taking = COALESCE(o.taking, 0)
+         , ntaking_from = COALESCE(o.ntaking_from, 0)
+      FROM ( SELECT owner, sum(receiving) AS taking, count(*) AS ntaking_from
+               FROM teams
+           GROUP BY owner
+            ) o
+     WHERE p.username = o.owner;
+
+    -- What a payment instruction adds to its team's receiving.
+    CREATE FUNCTION receiving_contribution(payment_instructions) RETURNS numeric AS $$
+        SELECT CASE WHEN ($1).amount > 0
+                     AND ($1).is_funded
+                     AND (SELECT is_suspicious FROM participants WHERE username = ($1).participant)
+                         IS NOT true
+                    THEN ($1).amount
+                    ELSE 0
+                END;
+    $$ LANGUAGE sql STABLE;
+
+    CREATE FUNCTION add_to_receiving(p_team text, p_old numeric, p_new numeric) RETURNS void AS $$
+        BEGIN
+            IF p_old = p_new THEN
+                RETURN;
+            END IF;
+            UPDATE teams
+               SET receiving = receiving + (p_new - p_old)
+                 , nreceiving_from = nreceiving_from + sign(p_new)::int - sign(p_old)::int
+                 , distributing = receiving + (p_new - p_old)
+                 , ndistributing_to = 1
+             WHERE slug = p_team;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    -- A pair pointed at a new payment instruction.
+    CREATE FUNCTION update_receiving_for_current_payment_instruction() RETURNS trigger AS $$
+        DECLARE
+            old_amount numeric := 0;
+            new_amount numeric := 0;
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.id = NEW.id THEN
+                RETURN NULL;  -- renamed by ON UPDATE CASCADE
+            END IF;
+            IF TG_OP <> 'INSERT' THEN
+                SELECT receiving_contribution(pi) INTO old_amount
+                  FROM payment_instructions pi WHERE pi.id = OLD.id;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                SELECT receiving_contribution(pi) INTO new_amount
+                  FROM payment_instructions pi WHERE pi.id = NEW.id;
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+                PERFORM add_to_receiving(OLD.team, COALESCE(old_amount, 0), 0);
+            ELSE
+                PERFORM add_to_receiving(NEW.team, COALESCE(old_amount, 0), COALESCE(new_amount, 0));
+            END IF;
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER update_receiving AFTER INSERT OR UPDATE OR DELETE
+        ON current_payment_instruction_ids
+        FOR EACH ROW EXECUTE PROCEDURE update_receiving_for_current_payment_instruction();
+
+    -- The current payment instruction for a pair was funded or unfunded.
+    CREATE FUNCTION update_receiving_for_payment_instruction() RETURNS trigger AS $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM current_payment_instruction_ids WHERE id = NEW.id) THEN
+                PERFORM add_to_receiving( NEW.team
+                                        , receiving_contribution(OLD)
+                                        , receiving_contribution(NEW)
+                                         );
+            END IF;
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER update_receiving AFTER UPDATE OF amount, is_funded ON payment_instructions
+        FOR EACH ROW
+        WHEN (OLD.amount <> NEW.amount OR OLD.is_funded <> NEW.is_funded)
+        EXECUTE PROCEDURE update_receiving_for_payment_instruction();
+
+    -- We don't count what suspicious participants give.
+    CREATE FUNCTION update_receiving_for_participant() RETURNS trigger AS $$
+        DECLARE
+            direction int := CASE WHEN NEW.is_suspicious IS true THEN -1 ELSE 1 END;
+        BEGIN
+            UPDATE teams t
+               SET receiving = t.receiving + direction * g.amount
+                 , nreceiving_from = t.nreceiving_from + direction * g.n
+                 , distributing = t.receiving + direction * g.amount
+                 , ndistributing_to = 1
+              FROM ( SELECT team, sum(amount) AS amount, count(*) AS n
+                       FROM current_payment_instructions
+                      WHERE participant = NEW.username
+                        AND amount > 0
+                        AND is_funded
+                   GROUP BY team
+                    ) g
+             WHERE t.slug = g.team;
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER update_receiving AFTER UPDATE OF is_suspicious ON participants
+        FOR EACH ROW
+        WHEN ((OLD.is_suspicious IS true) <> (NEW.is_suspicious IS true))
+        EXECUTE PROCEDURE update_receiving_for_participant();
+
+    -- A team's receiving is its owner's taking.
+    CREATE FUNCTION update_taking_for_team() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.owner = NEW.owner THEN
+                UPDATE participants
+                   SET taking = taking + (NEW.receiving - OLD.receiving)
+                 WHERE username = NEW.owner;
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE participants
+                   SET taking = taking - OLD.receiving
+                     , ntaking_from = ntaking_from - 1
+                 WHERE username = OLD.owner;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE participants
+                   SET taking = taking + NEW.receiving
+                     , ntaking_from = ntaking_from + 1
+                 WHERE username = NEW.owner;
+            END IF;
+            RETURN NULL;
+        END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER update_taking AFTER INSERT OR DELETE ON teams
+        FOR EACH ROW EXECUTE PROCEDURE update_taking_for_team();
+    CREATE TRIGGER update_taking_on_change AFTER UPDATE OF owner, receiving ON teams
+        FOR EACH ROW
+        WHEN (OLD.owner <> NEW.owner OR OLD.receiving <> NEW.receiving)
+        EXECUTE PROCEDURE update_taking_for_team();
+
+END;
+
+
+-- Index tips by tippee, so that renaming a participant (as take_over does when
+-- it archives the dead account) doesn't cascade through a scan of every tip
+BEGIN;
+    CREATE INDEX tips_tippee_idx ON tips (tippee);
+END;
+
+
+-- Index exchanges and payments by participant and time, for the history page
+BEGIN;
+    CREATE INDEX exchanges_participant_timestamp_idx ON exchanges (participant, timestamp);
+    CREATE INDEX payments_participant_timestamp_idx ON payments (participant, timestamp);
+END;
+
+
+-- balances_at used to be filled in by the history page, without counting
+-- payments. It's now filled in by snapshot_balances, which will start over.
+BEGIN;
+    DELETE FROM balances_at;
+END;
+
+
+-- What each team received at each payday, for charts
+BEGIN;
+    CREATE TABLE payday_receipts
+    ( payday        int             NOT NULL REFERENCES paydays
+                                        ON UPDATE RESTRICT ON DELETE RESTRICT
+    , team          text            NOT NULL REFERENCES teams
+                                        ON UPDATE CASCADE ON DELETE RESTRICT
+    , npatrons      int             NOT NULL
+    , receipts      numeric(35,2)   NOT NULL
+    , UNIQUE (team, payday)
+     );
+
+    INSERT INTO payday_receipts (payday, team, npatrons, receipts)
+         SELECT payday, team, count(DISTINCT participant), sum(amount)
+           FROM payments
+          WHERE direction = 'to-team'
+            AND payday IS NOT NULL
+       GROUP BY payday, team;
+END;
@@ -55,7 +55,7 @@ CREATE TABLE payday_payments_done AS
 
 DROP TABLE IF EXISTS payday_payment_instructions;
 CREATE TABLE payday_payment_instructions AS
-    SELECT s.id, participant, team, amount, due
+    SELECT s.id, participant, team, amount, due, s.ctime
       FROM ( SELECT DISTINCT ON (participant, team) *
                FROM payment_instructions
               WHERE mtime < (SELECT ts_start FROM current_payday())
@@ -0,0 +1,32 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import tempfile
+
+from gratipay.testing import Harness
+from gratipay.utils import benchmarking
+
+
+class TestBenchmarking(Harness):
+
+    def test_require_empty_db_refuses_a_database_with_participants(self):
+        benchmarking.require_empty_db(self.db, 'payday')
+        self.make_participant('alice')
+        with self.assertRaises(Exception):
+            benchmarking.require_empty_db(self.db, 'payday')
+
+    def test_reports_are_appended_as_json_lines(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        benchmarking.append_report(path, {'version': 'a'})
+        benchmarking.append_report(path, {'version': 'b'})
+        assert benchmarking.load_last_report(path) == {'version': 'b'}
+
+    def test_median(self):
+        assert benchmarking.median([3, 1, 2]) == 2
+        assert benchmarking.median([4, 1, 3, 2]) == 2.5
+
+    def test_is_slower(self):
+        assert benchmarking.is_slower(1.3, 1.0, 0.25)
+        assert not benchmarking.is_slower(1.2, 1.0, 0.25)
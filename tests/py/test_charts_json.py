@@ -172,3 +172,44 @@ class TestChartsJson(Harness):
         actual = json.loads(self.client.GET('/about/charts.json').body)[0]
 
         assert actual == expected
+
+
+class TestTeamChartsJson(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.team = self.make_team(is_approved=True)
+        self.alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        self.make_exchange('braintree-cc', 50, 0, self.alice)
+
+    def run_payday(self):
+        with patch.object(Payday, 'fetch_card_holds') as fch:
+            fch.return_value = {}
+            Payday.start().run()
+
+    def test_never_received_gives_empty_array(self):
+        self.run_payday()
+        self.run_payday()
+        assert json.loads(self.client.GET('/TheEnterprise/charts.json').body) == []
+
+    def test_receipts_come_from_payday_receipts(self):
+        self.run_payday()   # zeroth, ignored
+        self.alice.set_payment_instruction(self.team, '10.00')
+        self.run_payday()
+        assert self.db.one("SELECT receipts FROM payday_receipts") == 10
+
+        expected = [{"date": today(), "npatrons": 1, "receipts": 10.00}]
+        actual = json.loads(self.client.GET('/TheEnterprise/charts.json').body)
+        assert actual == expected
+
+    def test_etag_changes_at_payday(self):
+        self.run_payday()
+        etag = self.client.GET('/TheEnterprise/charts.json').headers['ETag']
+        response = self.client.GET('/TheEnterprise/charts.json', HTTP_IF_NONE_MATCH=etag,
+                                   raise_immediately=False)
+        assert response.code == 304
+
+        self.run_payday()
+        response = self.client.GET('/TheEnterprise/charts.json', HTTP_IF_NONE_MATCH=etag)
+        assert response.code == 200
+        assert response.headers['ETag'] != etag
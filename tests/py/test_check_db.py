@@ -0,0 +1,155 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.testing import Harness
+
+
+class TestCheckBalances(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.alice = self.make_participant('alice', claimed_time='now')
+        self.make_exchange('braintree-cc', 50, 0, self.alice)
+
+    def test_self_check_checkpoints_balances(self):
+        self.db.self_check()
+        assert self.db.one("SELECT balance FROM balance_checkpoints") == 50
+        assert self.db.one("SELECT exchanges FROM ledger_checkpoints") > 0
+
+    def test_self_check_only_sums_new_ledger_rows(self):
+        self.db.self_check()
+        # Tamper with old history, only a full audit notices.
+        self.db.run("UPDATE exchanges SET amount = 40")
+        self.db.self_check()
+        self.assertRaises(AssertionError, self.db.self_check, full=True)
+
+    def test_self_check_catches_bad_balances_after_a_checkpoint(self):
+        self.db.self_check()
+        self.make_exchange('braintree-cc', 10, 0, self.alice)
+        self.db.run("UPDATE participants SET balance = 100")
+        self.assertRaises(AssertionError, self.db.self_check)
+
+    def test_self_check_rechecks_balances_that_changed_without_new_rows(self):
+        e_id = self.make_exchange('braintree-cc', 10, 0, self.alice, status='pending')
+        self.db.self_check()
+        self.db.run("UPDATE participants SET balance = balance + 10")
+        self.db.run("UPDATE exchanges SET status = 'succeeded' WHERE id = %s", (e_id,))
+        self.db.self_check()
+        assert self.db.one("SELECT balance FROM balance_checkpoints") == 60
+
+    def test_self_check_catches_balances_that_changed_without_new_rows(self):
+        self.db.self_check()
+        self.db.run("UPDATE participants SET balance = 100")
+        self.assertRaises(AssertionError, self.db.self_check)
+
+
+class TestCurrentIds(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.alice = self.make_participant('alice', claimed_time='now')
+        self.bob = self.make_participant('bob', claimed_time='now')
+
+    def test_current_tips_follow_new_tips(self):
+        self.make_tip(self.alice, self.bob, '1.00')
+        self.make_tip(self.alice, self.bob, '2.00')
+        assert self.db.all("SELECT amount FROM current_tips") == [2]
+        assert self.db.one("SELECT count(*) FROM current_tip_ids") == 1
+        self.db.self_check(full=True)
+
+    def test_older_rows_dont_become_current(self):
+        self.make_tip(self.alice, self.bob, '2.00')
+        self.db.run("""
+            INSERT INTO tips (ctime, mtime, tipper, tippee, amount)
+                 VALUES (now(), now() - interval '1 day', 'alice', 'bob', 1)
+        """)
+        assert self.db.all("SELECT amount FROM current_tips") == [2]
+        self.db.self_check(full=True)
+
+    def test_deleting_the_current_route_falls_back_to_the_previous_one(self):
+        first = self.db.one("""
+            INSERT INTO exchange_routes (participant, network, address, error)
+                 VALUES (%s, 'paypal', 'alice@example.com', '') RETURNING id
+        """, (self.alice.id,))
+        second = self.db.one("""
+            INSERT INTO exchange_routes (participant, network, address, error)
+                 VALUES (%s, 'paypal', 'alice@example.net', '') RETURNING id
+        """, (self.alice.id,))
+        assert self.db.one("SELECT id FROM current_exchange_routes") == second
+        self.db.run("DELETE FROM exchange_routes WHERE id = %s", (second,))
+        assert self.db.one("SELECT id FROM current_exchange_routes") == first
+        self.db.self_check(full=True)
+
+    def test_current_ids_follow_renames(self):
+        self.make_tip(self.alice, self.bob, '1.00')
+        self.alice.change_username('carl')
+        assert self.db.one("SELECT tipper FROM current_tips") == 'carl'
+        self.db.self_check(full=True)
+
+    def test_full_audit_catches_out_of_sync_current_ids(self):
+        self.make_tip(self.alice, self.bob, '1.00')
+        self.make_tip(self.alice, self.bob, '2.00')
+        self.db.run("UPDATE current_tip_ids SET id = (SELECT min(id) FROM tips)")
+        self.assertRaises(AssertionError, self.db.self_check, full=True)
+
+
+class TestCounters(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        self.team = self.make_team(is_approved=True)
+
+    def receiving(self):
+        return self.db.one( "SELECT receiving, nreceiving_from FROM teams WHERE slug = %s"
+                          , (self.team.slug,), back_as=tuple
+                           )
+
+    def taking(self):
+        return self.db.one( "SELECT taking, ntaking_from FROM participants WHERE username = %s"
+                          , (self.team.owner,), back_as=tuple
+                           )
+
+    def test_receiving_and_taking_follow_payment_instructions(self):
+        self.alice.set_payment_instruction(self.team, '3.00')
+        assert self.receiving() == (3, 1)
+        assert self.taking() == (3, 1)
+        self.alice.set_payment_instruction(self.team, '5.00')
+        assert self.receiving() == (5, 1)
+        assert self.taking() == (5, 1)
+        self.alice.set_payment_instruction(self.team, '0.00')
+        assert self.receiving() == (0, 0)
+        assert self.taking() == (0, 1)
+
+    def test_receiving_follows_funding(self):
+        self.alice.set_payment_instruction(self.team, '3.00')
+        self.db.run("UPDATE current_payment_instructions SET is_funded = false")
+        assert self.receiving() == (0, 0)
+        self.db.run("UPDATE current_payment_instructions SET is_funded = true")
+        assert self.receiving() == (3, 1)
+
+    def test_receiving_follows_suspiciousness(self):
+        self.alice.set_payment_instruction(self.team, '3.00')
+        self.db.run("UPDATE participants SET is_suspicious = true WHERE username = 'alice'")
+        assert self.receiving() == (0, 0)
+        assert self.taking() == (0, 1)
+        self.db.run("UPDATE participants SET is_suspicious = false WHERE username = 'alice'")
+        assert self.receiving() == (3, 1)
+
+    def test_taking_follows_the_owner(self):
+        self.alice.set_payment_instruction(self.team, '3.00')
+        self.db.run("UPDATE teams SET owner = 'alice'")
+        assert self.taking() == (0, 0)
+        assert self.db.one("SELECT taking FROM participants WHERE username = 'alice'") == 3
+
+    def test_reconcile_counters_fixes_drift(self):
+        self.alice.set_payment_instruction(self.team, '3.00')
+        self.db.run("UPDATE teams SET receiving = 7, nreceiving_from = 2")
+        self.db.run("UPDATE participants SET taking = 9 WHERE username = %s", (self.team.owner,))
+        teams, participants = self.db.reconcile_counters()
+        assert [r.slug for r in teams] == [self.team.slug]
+        assert self.receiving() == (3, 1)
+        assert self.taking() == (3, 1)
+
+    def test_reconcile_counters_leaves_right_counters_alone(self):
+        self.alice.set_payment_instruction(self.team, '3.00')
+        assert self.db.reconcile_counters() == ([], [])
@@ -1,10 +1,14 @@
 import json
 
+import mock
+
 from gratipay.exceptions import CannotRemovePrimaryEmail, EmailAlreadyTaken, EmailNotVerified
 from gratipay.exceptions import TooManyEmailAddresses
 from gratipay.models.participant import Participant
+from gratipay.testing import Foobar
 from gratipay.testing.emails import EmailHarness
 from gratipay.utils import emails
+from gratipay.utils.sql_profiling import recording
 
 
 class TestEmail(EmailHarness):
@@ -215,6 +219,71 @@ class TestEmail(EmailHarness):
         assert expected in last_email['text']
         assert self.db.one("SELECT spt_name FROM email_queue") is None
 
+    def test_can_queue_emails_in_bulk(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        moe = self.make_participant('moe', email_address='moe@example.com')
+        nqueued = Participant.queue_emails([ (larry.id, "verification", {})
+                                           , (moe.id, "verification", {})
+                                            ])
+        assert nqueued == 2
+        queued = self.db.all("SELECT participant FROM email_queue ORDER BY id")
+        assert queued == [larry.id, moe.id]
+        Participant.dequeue_emails()
+        assert self.mailer.call_count == 2
+
+    def test_queueing_no_emails_in_bulk_is_a_noop(self):
+        assert Participant.queue_emails([]) == 0
+        assert self.db.one("SELECT count(*) FROM email_queue") == 0
+
+    def test_claimed_emails_are_skipped_by_other_workers(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        for i in range(3):
+            larry.queue_email("verification")
+        first = Participant.claim_emails(2)
+        second = Participant.claim_emails(2)
+        assert len(first) == 2
+        assert len(second) == 1
+        assert not set(m.id for m in first) & set(m.id for m in second)
+        assert Participant.claim_emails(2) == []
+
+    def test_emails_are_claimed_again_after_their_lease(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        larry.queue_email("verification")
+        assert len(Participant.claim_emails(10, lease=-1)) == 1
+        assert len(Participant.claim_emails(10)) == 1
+
+    def test_dequeueing_sends_in_batches(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        for i in range(5):
+            larry.queue_email("verification")
+        with mock.patch.object(Participant, 'email_batch_size', 2):
+            Participant.dequeue_emails()
+        assert self.mailer.call_count == 5
+        assert self.db.one("SELECT count(*) FROM email_queue") == 0
+
+    def test_emails_that_fail_to_send_stay_queued(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        moe = self.make_participant('moe', email_address='moe@example.com')
+        larry.queue_email("verification")
+        moe.queue_email("verification")
+        def send(message):
+            if message['to'][0]['email'] == 'moe@example.com':
+                raise Foobar
+        self.mailer.side_effect = send
+        with mock.patch.object(Participant, '_tell_sentry') as tell_sentry:
+            Participant.dequeue_emails()
+        assert tell_sentry.call_count == 1
+        queued = self.db.all("SELECT participant FROM email_queue")
+        assert queued == [moe.id]
+
+    def test_mandrill_transport_reports_errors_per_message(self):
+        mandrill = mock.Mock()
+        mandrill.messages.send.side_effect = [None, Foobar(), None]
+        errors = emails.MandrillTransport(mandrill).send([{}, {}, {}])
+        assert errors[0] is None
+        assert isinstance(errors[1], Foobar)
+        assert errors[2] is None
+
     def test_dequeueing_an_email_without_address_just_skips_it(self):
         larry = self.make_participant('larry')
         larry.queue_email("verification")
@@ -223,3 +292,22 @@ class TestEmail(EmailHarness):
         Participant.dequeue_emails()
         assert self.mailer.call_count == 0
         assert self.db.one("SELECT spt_name FROM email_queue") is None
+
+    def test_dequeueing_drops_emails_for_participants_who_are_gone(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        larry.queue_email("verification")
+        claim_emails = Participant.claim_emails
+        def claim_orphans(n):
+            return [msg._replace(participant=-1) for msg in claim_emails(n)]
+        with mock.patch.object(Participant, 'claim_emails', side_effect=claim_orphans), \
+             mock.patch.object(Participant, '_tell_sentry') as tell_sentry:
+            Participant.dequeue_emails()
+        assert self.mailer.call_count == 0
+        assert tell_sentry.call_count == 0
+        assert self.db.one("SELECT count(*) FROM email_queue") == 0
+
+    def test_claiming_emails_checks_the_server_version_once(self):
+        with mock.patch.object(Participant, '_skip_locked', None), recording() as recorder:
+            Participant.claim_emails(10)
+            Participant.claim_emails(10)
+        assert recorder.counts['SHOW server_version_num'] == 1
@@ -28,3 +28,19 @@ class TestFakeData(Harness):
             assert len(payment_instructions) == num_tips
         else:
             assert len(payment_instructions) == (num_participants - num_teams)
+
+    def test_bulk_populate_db(self):
+        fake_data.bulk_populate_db(self.db, 20, 2, 30)
+        assert self.db.one("SELECT count(*) FROM participants") == 20
+        assert self.db.one("SELECT count(*) FROM teams WHERE is_approved") == 2
+        assert self.db.one("SELECT count(*) FROM payment_instructions") == 30
+        assert self.db.one("SELECT count(*) FROM exchange_routes WHERE network = 'paypal'") == 2
+
+    def test_bulk_populate_db_is_repeatable(self):
+        fake_data.bulk_populate_db(self.db, 10, 1, 10)
+        first = self.db.all("SELECT participant, team, amount FROM payment_instructions ORDER BY id")
+        self.db.run("DELETE FROM payment_instructions; DELETE FROM exchange_routes; "
+                    "DELETE FROM teams; DELETE FROM participants;")
+        fake_data.bulk_populate_db(self.db, 10, 1, 10)
+        second = self.db.all("SELECT participant, team, amount FROM payment_instructions ORDER BY id")
+        assert first == second
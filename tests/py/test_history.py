@@ -10,7 +10,7 @@ from gratipay.billing.payday import Payday
 from gratipay.models.participant import Participant
 from gratipay.testing import Harness
 from gratipay.testing.billing import BillingHarness
-from gratipay.utils.history import get_end_of_year_balance, iter_payday_events
+from gratipay.utils.history import get_end_of_year_balance, iter_payday_events, snapshot_balances
 
 
 def make_history(harness):
@@ -99,11 +99,48 @@ class TestHistory(BillingHarness):
         assert events[4]['kind'] == 'day-close'
         assert events[4]['balance'] == 0
 
+    def test_iter_payday_events_only_includes_the_year_asked_for(self):
+        alice = self.make_participant('alice', claimed_time=datetime(2001, 1, 1))
+        self.make_exchange('braintree-cc', 50, 0, alice)
+        self.make_exchange('braintree-cc', 20, 0, alice)
+        self.db.run("""
+            UPDATE exchanges
+               SET timestamp = date_trunc('year', now()) - interval '1 second'
+             WHERE amount = 20
+        """)
+        events = list(iter_payday_events(self.db, alice))
+        assert [e['kind'] for e in events] == ['day-open', 'charge', 'day-close']
+        assert events[1]['amount'] == 50
+
+    def test_iter_payday_events_yields_nothing_for_an_empty_year(self):
+        alice = self.make_participant('alice', claimed_time='now')
+        assert list(iter_payday_events(self.db, alice)) == []
+
     def test_get_end_of_year_balance(self):
         make_history(self)
         balance = get_end_of_year_balance(self.db, self.alice, self.past_year, datetime.now().year)
         assert balance == 10
 
+    def test_snapshot_balances(self):
+        make_history(self)
+        assert snapshot_balances(self.db) == {'year': (1, 0)}
+        assert self.db.one("SELECT balance FROM balances_at") == 10
+        assert snapshot_balances(self.db) == {'year': (0, 0)}
+
+    def test_snapshot_balances_fixes_wrong_snapshots(self):
+        make_history(self)
+        snapshot_balances(self.db)
+        self.db.run("UPDATE balances_at SET balance = 42")
+        assert snapshot_balances(self.db, monthly=True)['year'] == (0, 1)
+        assert self.db.one("SELECT balance FROM balances_at ORDER BY at DESC LIMIT 1") == 10
+
+    def test_get_end_of_year_balance_reads_snapshots(self):
+        make_history(self)
+        snapshot_balances(self.db)
+        self.db.run("UPDATE balances_at SET balance = 42")
+        balance = get_end_of_year_balance(self.db, self.alice, self.past_year, datetime.now().year)
+        assert balance == 42
+
 
 class TestHistoryPage(Harness):
 
@@ -114,6 +151,15 @@ class TestHistoryPage(Harness):
     def test_participant_can_view_history(self):
         assert self.client.GET('/~alice/history/', auth_as='alice').code == 200
 
+    def test_history_is_streamed(self):
+        state = self.client.GET('/~alice/history/', auth_as='alice', want='state')
+        assert not isinstance(state['response'].body, basestring)
+
+    def test_history_year_out_of_range_is_400(self):
+        for year in ('0', '-1', '9999', '99999999999999999999', str(datetime.utcnow().year + 2)):
+            r = self.client.GxT('/~alice/history/?year='+year, auth_as='alice')
+            assert r.code == 400, year
+
     def test_admin_can_view_closed_participant_history(self):
         self.make_exchange('braintree-cc', -30, 0, self.alice)
         self.alice.close()
@@ -143,3 +189,31 @@ class TestExport(Harness):
     def test_export_csv(self):
         r = self.client.GET('/~alice/history/export.csv?key=exchanges', auth_as='alice')
         assert r.body.count('\n') == 5
+
+    def test_export_csv_is_streamed(self):
+        state = self.client.GET('/~alice/history/export.csv?key=exchanges', auth_as='alice',
+                                want='state')
+        assert not isinstance(state['response'].body, basestring)
+
+    def test_export_csv_several_years(self):
+        years = '%s-%s' % (self.past_year, self.past_year + 1)
+        r = self.client.GET('/~alice/history/export.csv?key=exchanges&year='+years, auth_as='alice')
+        assert r.body.count('\n') == 9
+
+    def test_export_csv_bad_year(self):
+        r = self.client.GxT('/~alice/history/export.csv?key=exchanges&year=2015-2014',
+                            auth_as='alice')
+        assert r.code == 400
+
+    def test_export_csv_year_out_of_range(self):
+        for year in ('0', '9999', '2015-9999', str(datetime.utcnow().year + 2)):
+            r = self.client.GxT('/~alice/history/export.csv?key=exchanges&year='+year,
+                                auth_as='alice')
+            assert r.code == 400, year
+
+    def test_export_ndjson(self):
+        r = self.client.GET('/~alice/history/export.ndjson?year=%s' % self.past_year,
+                            auth_as='alice')
+        rows = [json.loads(line) for line in r.body.splitlines()]
+        assert len(rows) == 4
+        assert set(row['key'] for row in rows) == {'exchanges'}
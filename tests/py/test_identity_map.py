@@ -0,0 +1,58 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.models import identity_map
+from gratipay.models.exchange_route import ExchangeRoute
+from gratipay.models.participant import Participant
+from gratipay.models.team import Team
+from gratipay.testing import Harness
+from gratipay.utils.sql_profiling import recording
+
+
+class TestIdentityMap(Harness):
+
+    def test_without_a_map_every_load_hits_the_db(self):
+        self.make_participant('alice')
+        assert Participant.from_username('alice') is not Participant.from_username('alice')
+
+    def test_a_participant_is_loaded_once(self):
+        self.make_participant('alice')
+        with identity_map.mapping() as identity, recording() as recorder:
+            alice = Participant.from_username('alice')
+            assert Participant.from_username('Alice') is alice
+            assert Participant.from_id(alice.id) is alice
+        assert recorder.nqueries == 1
+        assert identity.hits == 2
+
+    def test_loading_a_participant_another_way_gives_the_same_object(self):
+        self.make_participant('alice', session_token='deadbeef', session_expires='2100-01-01')
+        with identity_map.mapping():
+            alice = Participant.from_session_token('deadbeef')
+            assert Participant.from_username('alice') is alice
+
+    def test_a_team_is_loaded_once(self):
+        team = self.make_team()
+        with identity_map.mapping() as identity:
+            assert Team.from_slug(team.slug) is Team.from_id(team.id)
+            assert Team.from_slug(team.slug.upper()) is Team.from_id(team.id)
+        assert identity.hits == 3
+
+    def test_missing_routes_are_remembered_until_one_is_added(self):
+        alice = self.make_participant('alice')
+        with identity_map.mapping() as identity:
+            assert ExchangeRoute.from_network(alice, 'paypal') is None
+            assert ExchangeRoute.from_network(alice, 'paypal') is None
+            assert identity.hits == 1
+            route = ExchangeRoute.insert(alice, 'paypal', 'alice@example.com')
+            assert ExchangeRoute.from_network(alice, 'paypal').id == route.id
+
+    def test_get_requests_are_mapped_and_the_map_is_cleared_at_the_end(self):
+        self.make_participant('alice', claimed_time='now')
+        self.client.GET('/~alice/', auth_as='alice')
+        assert identity_map.stop() is None
+
+    def test_post_requests_are_not_mapped(self):
+        class Request(object):
+            method = 'POST'
+        identity_map.start()
+        identity_map.begin(Request())
+        assert identity_map.stop() is None
@@ -16,6 +16,7 @@ from gratipay.exceptions import (
     UsernameContainsInvalidCharacters,
     UsernameIsRestricted,
     NoTeam,
+    UnapprovedTeam,
     BadAmount,
 )
 from gratipay.models.account_elsewhere import AccountElsewhere
@@ -23,6 +24,7 @@ from gratipay.models.participant import (
     LastElsewhere, NeedConfirmation, NonexistingElsewhere, Participant, TeamCantBeOnlyAuth
 )
 from gratipay.testing import Harness
+from gratipay.utils.sql_profiling import recording
 
 
 # TODO: Test that accounts elsewhere are not considered claimed by default
@@ -458,6 +460,32 @@ class Tests(Harness):
         alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
         self.assertRaises(NoTeam, alice.set_payment_instruction, 'The Stargazer', '1.00')
 
+    def test_spi_takes_one_round_trip(self):
+        alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        team = self.make_team(is_approved=True)
+        with recording() as recorder:
+            alice.set_payment_instruction(team, '1.00')
+        assert recorder.nqueries == 1
+
+    def test_spi_updates_giving_receiving_and_taking(self):
+        alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        team = self.make_team(is_approved=True)
+        alice.set_payment_instruction(team, '3.00')
+        assert alice.giving == 3
+        assert alice.ngiving_to == 1
+        assert team.receiving == 3
+        assert team.nreceiving_from == 1
+        assert Participant.from_username(team.owner).taking == 3
+
+    def test_spi_carries_over_due(self):
+        alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        team = self.make_team(is_approved=True)
+        alice.set_payment_instruction(team, '3.00')
+        self.db.run("UPDATE payment_instructions SET due = 3")
+        actual = alice.set_payment_instruction(team, '4.00')
+        assert actual['due'] == 3
+        assert self.db.all("SELECT due FROM payment_instructions ORDER BY id") == [0, 3]
+
     def test_spi_is_free_rider_defaults_to_none(self):
         alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
         assert alice.is_free_rider is None
@@ -477,6 +505,90 @@ class Tests(Harness):
         assert Participant.from_username('alice').is_free_rider is None
 
 
+    # set_payment_instructions - spis
+
+    def test_spis_sets_many_payment_instructions(self):
+        self.make_participant('alice', claimed_time='now', last_bill_result='')
+        self.make_participant('bob', claimed_time='now', last_bill_result='')
+        self.make_team('A', is_approved=True)
+        self.make_team('B', is_approved=True)
+        actual = Participant.set_payment_instructions([ ('alice', 'A', '1.00')
+                                                      , ('alice', 'B', '2.00')
+                                                      , ('bob', 'A', '4.00')
+                                                       ])
+        assert [(pi['participant'], pi['team'], pi['amount']) for pi in actual] == \
+               [('alice', 'A', 1), ('alice', 'B', 2), ('bob', 'A', 4)]
+        assert self.db.all("SELECT team, amount FROM current_payment_instructions "
+                           "WHERE participant = 'alice' ORDER BY team") == \
+               [('A', 1), ('B', 2)]
+
+    def test_spis_updates_giving_receiving_and_taking(self):
+        self.make_participant('alice', claimed_time='now', last_bill_result='')
+        self.make_participant('bob', claimed_time='now', last_bill_result='')
+        team = self.make_team(is_approved=True)
+        Participant.set_payment_instructions([ ('alice', team, '1.00')
+                                             , ('bob', team, '4.00')
+                                              ])
+        assert Participant.from_username('alice').giving == 1
+        assert Participant.from_username('bob').giving == 4
+        assert self.db.one("SELECT receiving FROM teams WHERE slug = %s", (team.slug,)) == 5
+        assert self.db.one("SELECT nreceiving_from FROM teams WHERE slug = %s", (team.slug,)) == 2
+        assert Participant.from_username(team.owner).taking == 5
+
+    def test_spis_takes_one_round_trip_for_the_instructions(self):
+        for username in ('alice', 'bob', 'carl'):
+            self.make_participant(username, claimed_time='now', last_bill_result='')
+        team = self.make_team(is_approved=True)
+        instructions = [(username, team.slug, '1.00') for username in ('alice', 'bob', 'carl')]
+        with recording() as recorder:
+            Participant.set_payment_instructions(instructions)
+        assert len(recorder.counts) == recorder.nqueries  # nothing is run per instruction
+
+    def test_spis_last_instruction_for_a_team_wins(self):
+        self.make_participant('alice', claimed_time='now', last_bill_result='')
+        team = self.make_team(is_approved=True)
+        Participant.set_payment_instructions([ ('alice', team, '1.00')
+                                             , ('alice', team, '3.00')
+                                              ])
+        assert Participant.from_username('alice').giving == 3
+        assert Participant.from_username('alice').ngiving_to == 1
+
+    def test_spis_raises_bad_amount_and_sets_nothing(self):
+        self.make_participant('alice', claimed_time='now', last_bill_result='')
+        team = self.make_team(is_approved=True)
+        with self.assertRaises(BadAmount):
+            Participant.set_payment_instructions([ ('alice', team, '1.00')
+                                                 , ('alice', team, '1010.00')
+                                                  ])
+        assert self.db.all("SELECT * FROM payment_instructions") == []
+
+    def test_spis_raises_no_team_and_sets_nothing(self):
+        self.make_participant('alice', claimed_time='now', last_bill_result='')
+        team = self.make_team(is_approved=True)
+        with self.assertRaises(NoTeam):
+            Participant.set_payment_instructions([ ('alice', team, '1.00')
+                                                 , ('alice', 'nonexistent', '1.00')
+                                                  ])
+        assert self.db.all("SELECT * FROM payment_instructions") == []
+
+    def test_spis_raises_unapproved_team_and_sets_nothing(self):
+        self.make_participant('alice', claimed_time='now', last_bill_result='')
+        team = self.make_team(is_approved=True)
+        self.make_team('Rejected', is_approved=False)
+        self.make_team('Unreviewed', is_approved=None)
+        self.make_team('Closed', is_approved=True)
+        self.db.run("UPDATE teams SET is_closed=true WHERE slug='Closed'")
+        for slug in ('Rejected', 'Unreviewed', 'Closed'):
+            with self.assertRaises(UnapprovedTeam):
+                Participant.set_payment_instructions([ ('alice', team, '1.00')
+                                                     , ('alice', slug, '1.00')
+                                                      ])
+        assert self.db.all("SELECT * FROM payment_instructions") == []
+
+    def test_spis_with_no_instructions_is_a_noop(self):
+        assert Participant.set_payment_instructions([]) == []
+
+
     # get_teams - gt
 
     def test_get_teams_gets_teams(self):
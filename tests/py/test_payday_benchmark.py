@@ -0,0 +1,21 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.testing import Harness
+from gratipay.utils import payday_benchmark
+
+
+class TestPaydayBenchmark(Harness):
+
+    def test_run_reports_stages_and_db_stats(self):
+        report = payday_benchmark.run(self.db, 50, 2, 100)
+        stages = [s['stage'] for s in report['stages']]
+        assert 'create_card_holds' in stages
+        assert 'process_payment_instructions' in stages
+        assert report['gateway_calls'] > 0
+        assert report['db']['tup_inserted'] > 0
+        assert self.db.one("SELECT count(*) FROM paydays WHERE ts_end > ts_start") == 1
+
+    def test_find_regressions_flags_slower_stages(self):
+        baseline = {'stages': [{'stage': 'a', 'seconds': 1.0}, {'stage': 'b', 'seconds': 1.0}]}
+        report = {'stages': [{'stage': 'a', 'seconds': 1.1}, {'stage': 'b', 'seconds': 2.0}]}
+        assert payday_benchmark.find_regressions(report, baseline, 0.25) == ['b']
@@ -15,3 +15,16 @@ class Tests(Harness):
         response = self.client.GET("/about/paydays.json")
         paydays = json.loads(response.body)
         assert paydays[0]['nusers'] == 0
+
+    def test_payday_metrics_json_gives_payday_metrics(self):
+        payday = Payday.start()
+        with payday.measure('prepare') as m:
+            m.nrows = 42
+
+        response = self.client.GET("/about/payday-metrics.json")
+        metrics = json.loads(response.body)
+        assert len(metrics) == 1
+        assert metrics[0]['payday'] == payday.id
+        assert metrics[0]['stage'] == 'prepare'
+        assert metrics[0]['nrows'] == 42
+        assert metrics[0]['ncalls'] == 0
@@ -0,0 +1,45 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+
+from gratipay.testing import Harness
+from gratipay.utils.aggregates import payment_distribution
+
+
+class Tests(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        team = self.make_team(is_approved=True)
+        alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        carl = self.make_participant('carl', claimed_time='now', last_bill_result='')
+        alice.set_payment_instruction(team, '200.00')
+        carl.set_payment_instruction(team, '300.00')
+
+    def test_payment_distribution_bins_funded_payment_instructions(self):
+        assert payment_distribution(self.db) == [
+            {'lo': '500.01', 'hi': '1000.00', 'sum': '0', 'n': '0', 'xText': '1000.00'},
+
+            {'lo': '200.01', 'hi': '500.00', 'sum': '300.00', 'n': '1', 'xText': '500.00'},
+            {'lo': '100.01', 'hi': '200.00', 'sum': '200.00', 'n': '1', 'xText': '200.00'},
+            {'lo': '50.01', 'hi': '100.00', 'sum': '0', 'n': '0', 'xText': '100.00'},
+
+            {'lo': '20.01', 'hi': '50.00', 'sum': '0', 'n': '0', 'xText': '50.00'},
+            {'lo': '10.01', 'hi': '20.00', 'sum': '0', 'n': '0', 'xText': '20.00'},
+            {'lo': '5.01', 'hi': '10.00', 'sum': '0', 'n': '0', 'xText': '10.00'},
+
+            {'lo': '2.01', 'hi': '5.00', 'sum': '0', 'n': '0', 'xText': '5.00'},
+            {'lo': '1.01', 'hi': '2.00', 'sum': '0', 'n': '0', 'xText': '2.00'},
+            {'lo': '0.51', 'hi': '1.00', 'sum': '0', 'n': '0', 'xText': '1.00'},
+
+            {'lo': '0.21', 'hi': '0.50', 'sum': '0', 'n': '0', 'xText': '0.50'},
+            {'lo': '0.11', 'hi': '0.20', 'sum': '0', 'n': '0', 'xText': '0.20'},
+            {'lo': '0.00', 'hi': '0.10', 'sum': '0', 'n': '0', 'xText': '0.10'},
+        ]
+
+    def test_payment_distribution_json_serves_the_cached_distribution(self):
+        self.client.website.shared_cache.refresh('payment_distribution')
+        response = self.client.GET('/about/payment-distribution.json')
+        distribution = json.loads(response.body)
+        assert len(distribution) == 13
+        assert distribution[1]['sum'] == '300.00'
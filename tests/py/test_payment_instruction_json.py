@@ -68,3 +68,85 @@ class TestTipJson(Harness):
                                     )
         assert "unapproved team" in response.body
         assert response.code == 400
+
+
+class TestPaymentInstructionsJson(Harness):
+
+    def test_post_sets_many_payment_instructions(self):
+        self.make_team("A", is_approved=True)
+        self.make_team("B", is_approved=True)
+        self.make_participant("alice", claimed_time='now', last_bill_result='')
+        body = json.dumps([{'team': 'A', 'amount': '1.50'}, {'team': 'B', 'amount': '3.00'}])
+        response = self.client.POST( "/~alice/payment-instructions.json"
+                                   , body=body
+                                   , content_type=b'application/json'
+                                   , auth_as='alice'
+                                    )
+        data = json.loads(response.body)
+        assert [(pi['team'], pi['amount']) for pi in data] == [('A', '1.50'), ('B', '3.00')]
+        data = json.loads(self.client.GET("/~alice/payment-instructions.json", auth_as='alice').body)
+        assert [(pi['team'], pi['amount']) for pi in data] == [('A', '1.50'), ('B', '3.00')]
+
+    def test_post_with_an_unknown_team_is_400(self):
+        self.make_participant("alice", claimed_time='now', last_bill_result='')
+        body = json.dumps([{'team': 'nonexistent', 'amount': '1.50'}])
+        response = self.client.PxST( "/~alice/payment-instructions.json"
+                                   , body=body
+                                   , content_type=b'application/json'
+                                   , auth_as='alice'
+                                    )
+        assert response.code == 400
+        assert "unknown team" in response.body
+
+    def test_post_with_an_unapproved_team_is_400(self):
+        self.make_team("A", is_approved=True)
+        self.make_team("B", is_approved=False)
+        self.make_participant("alice", claimed_time='now', last_bill_result='')
+        body = json.dumps([{'team': 'A', 'amount': '1.50'}, {'team': 'B', 'amount': '3.00'}])
+        response = self.client.PxST( "/~alice/payment-instructions.json"
+                                   , body=body
+                                   , content_type=b'application/json'
+                                   , auth_as='alice'
+                                    )
+        assert response.code == 400
+        assert "unapproved team: B" in response.body
+        assert self.db.all("SELECT * FROM payment_instructions") == []
+
+    def test_post_with_a_bad_amount_type_is_400(self):
+        self.make_team("A", is_approved=True)
+        self.make_participant("alice", claimed_time='now', last_bill_result='')
+        for amount in (None, {}, [], True):
+            body = json.dumps([{'team': 'A', 'amount': amount}])
+            response = self.client.PxST( "/~alice/payment-instructions.json"
+                                       , body=body
+                                       , content_type=b'application/json'
+                                       , auth_as='alice'
+                                        )
+            assert response.code == 400, amount
+            assert "bad amount" in response.body
+        assert self.db.all("SELECT * FROM payment_instructions") == []
+
+    def test_post_with_a_bad_team_type_is_400(self):
+        self.make_participant("alice", claimed_time='now', last_bill_result='')
+        for team in (None, {}, ['A'], 42):
+            body = json.dumps([{'team': team, 'amount': '1.50'}])
+            response = self.client.PxST( "/~alice/payment-instructions.json"
+                                       , body=body
+                                       , content_type=b'application/json'
+                                       , auth_as='alice'
+                                        )
+            assert response.code == 400, team
+            assert "bad team" in response.body
+
+    def test_others_cant_set_your_payment_instructions(self):
+        self.make_team("A", is_approved=True)
+        self.make_participant("alice", claimed_time='now', last_bill_result='')
+        self.make_participant("bob", claimed_time='now')
+        body = json.dumps([{'team': 'A', 'amount': '1.50'}])
+        response = self.client.PxST( "/~alice/payment-instructions.json"
+                                   , body=body
+                                   , content_type=b'application/json'
+                                   , auth_as='bob'
+                                    )
+        assert response.code == 403
+        assert self.db.all("SELECT * FROM payment_instructions") == []
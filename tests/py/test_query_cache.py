@@ -0,0 +1,56 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+from gratipay.testing import Harness
+from gratipay.utils.query_cache import QueryCache
+
+
+class TestQueryCache(Harness):
+
+    def count_participants(self, cache):
+        return cache.one("SELECT count(*) FROM participants", ())
+
+    def test_query_cache_caches(self):
+        cache = QueryCache(self.db)
+        assert self.count_participants(cache) == 0
+        self.make_participant('alice')
+        assert self.count_participants(cache) == 0
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_query_cache_evicts_least_recently_used_entries(self):
+        cache = QueryCache(self.db, max_entries=2)
+        cache.one("SELECT 1", ())
+        cache.one("SELECT 2", ())
+        cache.one("SELECT 1", ())
+        cache.one("SELECT 3", ())
+        assert list(cache.cache) == [("SELECT 1", ()), ("SELECT 3", ())]
+        assert cache.evictions == 1
+
+    def test_query_cache_evicts_to_stay_under_max_bytes(self):
+        cache = QueryCache(self.db, max_bytes=1000)
+        for i in range(20):
+            cache.all("SELECT generate_series(1, %s)", (i,))
+        assert cache.nbytes <= 1000
+        assert cache.evictions > 0
+        assert cache.stats()['entries'] == len(cache.cache)
+
+    def test_query_cache_serves_stale_entries_while_revalidating(self):
+        cache = QueryCache(self.db, threshold=0.1, stale_while_revalidate=60)
+        assert self.count_participants(cache) == 0
+        self.make_participant('alice')
+        time.sleep(0.2)
+        assert self.count_participants(cache) == 0
+        assert cache.stale_hits == 1
+        for i in range(50):
+            if cache.refreshes:
+                break
+            time.sleep(0.1)
+        assert self.count_participants(cache) == 1
+
+    def test_search_goes_through_the_query_cache(self):
+        self.make_participant('alice', claimed_time='now')
+        cache = self.client.website.query_cache
+        misses = cache.misses
+        assert 'alice' in self.client.GET('/search?q=alice').body
+        assert cache.misses == misses + 2  # usernames and statements
@@ -0,0 +1,95 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import shutil
+import tempfile
+import time
+
+from gratipay.testing import Harness
+from gratipay.utils.cache_invalidation import Invalidator
+from gratipay.utils.shared_cache import SharedCache
+
+
+class TestSharedCache(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.ncalls = 0
+
+    def make_cache(self):
+        cache = SharedCache(self.directory)
+        def compute():
+            self.ncalls += 1
+            return {'ncalls': self.ncalls, 'padding': 'x' * 10000 * self.ncalls}
+        cache.register('foo', compute)
+        return cache
+
+    def test_values_are_computed_once_and_shared(self):
+        a, b = self.make_cache(), self.make_cache()
+        assert a.get('foo')['ncalls'] == 1
+        assert b.get('foo')['ncalls'] == 1
+        assert self.ncalls == 1
+        assert a.version('foo') == b.version('foo') == 1
+
+    def test_refresh_publishes_a_new_version(self):
+        a, b = self.make_cache(), self.make_cache()
+        b.get('foo')
+        a.refresh('foo')
+        a.refresh('foo')
+        assert b.version('foo') == 3
+        assert b.get('foo')['ncalls'] == 3
+        assert len(b.get('foo')['padding']) == 30000
+
+    def test_refresh_all_runs_once_per_period_on_a_host(self):
+        a, b = self.make_cache(), self.make_cache()
+        assert a.refresh_all(every=60)
+        assert not b.refresh_all(every=60)
+        assert self.ncalls == 1
+        assert b.refresh_all()
+        assert self.ncalls == 2
+
+    def test_clear_forgets_values_everywhere(self):
+        a, b = self.make_cache(), self.make_cache()
+        a.get('foo')
+        b.clear()
+        assert a.version('foo') is None
+        assert a.get('foo')['ncalls'] == 2
+
+    def test_invalidate_forgets_tagged_values_everywhere(self):
+        a, b = self.make_cache(), self.make_cache()
+        a.register('bar', lambda: 'bar', tags=['bar'])
+        b.register('bar', lambda: 'bar', tags=['bar'])
+        a.get('foo')
+        a.get('bar')
+        b.invalidate('bar')
+        assert a.version('foo') == 1
+        assert a.version('bar') is None
+        b.invalidate('*')
+        assert a.version('foo') is None
+
+    def test_new_payment_instructions_invalidate_payment_distribution(self):
+        cache = self.client.website.shared_cache
+        invalidator = Invalidator(self.db)
+        invalidator.subscribe(cache.invalidate)
+        invalidator.start()
+        self.addCleanup(invalidator.stop)
+        assert invalidator.listening.wait(10)
+        cache.get('payment_distribution')
+
+        alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        team = self.make_team(is_approved=True)
+        alice.set_payment_instruction(team, '1.00')
+
+        for i in range(50):
+            if cache.version('payment_distribution') is None:
+                break
+            time.sleep(0.1)
+        assert cache.version('payment_distribution') is None
+
+    def test_stats_page_uses_shared_cache(self):
+        self.client.website.shared_cache.get('stats')
+        self.make_participant('alice', balance=100)
+        assert '$100.00' not in self.client.GET('/about/stats').body
+        self.client.website.shared_cache.refresh('stats')
+        assert '$100.00' in self.client.GET('/about/stats').body
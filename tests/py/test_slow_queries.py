@@ -0,0 +1,59 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.testing import Harness
+from gratipay.utils.slow_queries import is_read_only, normalize
+
+
+class TestSlowQueries(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.slow_queries = self.db.slow_queries
+        self.slow_queries.threshold = 0.000001
+        self.addCleanup(self.slow_queries._pending.clear)
+        self.addCleanup(setattr, self.slow_queries, 'threshold', 0)
+
+    def test_normalize_strips_literals(self):
+        actual = normalize("SELECT * FROM foo -- bar\n WHERE a = 'it''s' AND b IN (1, 2) AND c = %s")
+        assert actual == "SELECT * FROM foo WHERE a = ? AND b IN (?) AND c = ?"
+
+    def test_is_read_only(self):
+        assert is_read_only("SELECT 1")
+        assert not is_read_only("WITH foo AS (DELETE FROM bar RETURNING *) SELECT * FROM foo")
+
+    def test_slow_queries_are_aggregated_by_fingerprint(self):
+        self.db.one("SELECT count(*) FROM participants WHERE id > %s", (1,))
+        self.db.one("SELECT count(*)   FROM participants WHERE id > 2")
+        self.slow_queries.threshold = 0
+        self.slow_queries.flush()
+        self.slow_queries.flush()
+        slow = self.db.one("SELECT * FROM slow_queries WHERE calls = 2")
+        assert slow.query == "SELECT count(*) FROM participants WHERE id > ?"
+        assert slow.total_time >= slow.max_time > 0
+        assert slow.plan.startswith('Aggregate')
+
+    def test_plans_dont_keep_string_parameters(self):
+        self.db.one("SELECT count(*) FROM participants WHERE session_token = %s", ('s3cr3t',))
+        self.slow_queries.threshold = 0
+        self.slow_queries.flush()
+        slow = self.db.one("SELECT * FROM slow_queries WHERE query LIKE '%%session_token%%'")
+        assert slow.plan
+        assert 's3cr3t' not in slow.plan
+
+    def test_writes_arent_explained(self):
+        self.db.run("UPDATE participants SET balance = 0 WHERE id = -1")
+        self.slow_queries.threshold = 0
+        self.slow_queries.flush()
+        slow = self.db.one("SELECT * FROM slow_queries WHERE query LIKE 'UPDATE%%'")
+        assert slow.calls == 1
+        assert slow.plan is None
+
+    def test_admins_can_see_slow_queries(self):
+        self.make_participant('admin', claimed_time='now', is_admin=True)
+        self.db.run("INSERT INTO slow_queries (fingerprint, query, calls) VALUES ('f', 'SELECT ?', 1)")
+        assert 'SELECT ?' in self.client.GET('/dashboard/slow-queries', auth_as='admin').body
+
+    def test_others_cant(self):
+        self.make_participant('alice', claimed_time='now')
+        response = self.client.GxT('/dashboard/slow-queries', auth_as='alice')
+        assert response.code == 403
@@ -0,0 +1,42 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.testing import Harness
+from gratipay.utils.sql_profiling import QueryRecorder, recording
+
+
+class TestSQLProfiling(Harness):
+
+    def test_recording_counts_queries_of_every_cursor_type(self):
+        with recording() as recorder:
+            self.db.one("SELECT 1")
+            self.db.one("SELECT 1", back_as=dict)
+            self.db.all("SELECT 2", back_as=tuple)
+            with self.db.get_cursor() as cursor:
+                cursor.run("SELECT 3")
+        assert recorder.nqueries == 4
+        assert recorder.total_time > 0
+        assert recorder.repeated_queries() == [(2, "SELECT 1")]
+
+    def test_queries_arent_recorded_after_recording_stops(self):
+        with recording() as recorder:
+            self.db.one("SELECT 1")
+        self.db.one("SELECT 1")
+        assert recorder.nqueries == 1
+
+    def test_recorder_keeps_the_slowest_queries(self):
+        recorder = QueryRecorder(nslowest=2)
+        for i in range(5):
+            recorder.record("SELECT  %i" % i, i)
+        assert recorder.slowest_queries() == [(4, "SELECT 4"), (3, "SELECT 3")]
+
+    def test_server_timing_header(self):
+        self.client.website.server_timing = True
+        try:
+            response = self.client.GET('/about/stats')
+        finally:
+            self.client.website.server_timing = False
+        assert response.headers['Server-Timing'].startswith('db;dur=')
+        assert 'queries' in response.headers['Server-Timing']
+
+    def test_no_server_timing_header_by_default(self):
+        assert 'Server-Timing' not in self.client.GET('/about/stats').headers
@@ -0,0 +1,25 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.testing import Harness
+from gratipay.utils import take_over_benchmark
+
+
+class TestTakeOverBenchmark(Harness):
+
+    def test_run_times_merges_at_each_step(self):
+        report = take_over_benchmark.run(self.db, [200, 100], nmerges=2, nparticipants=20,
+                                         ntips_per_account=3)
+        assert [s['tips'] for s in report['steps']] == [100, 200]
+        assert all(len(s['seconds']) == 2 for s in report['steps'])
+        assert self.db.one("SELECT count(*) FROM absorptions") == 4
+
+    def test_merges_consolidate_tips(self):
+        take_over_benchmark.run(self.db, [50], nmerges=1, nparticipants=10, ntips_per_account=3)
+        assert self.db.all("""
+            SELECT tippee, amount FROM current_tips WHERE tipper = 'live0' ORDER BY tippee
+        """) == [('bench1', 2), ('bench2', 2), ('bench3', 2)]
+
+    def test_grew_flags_slower_merges(self):
+        report = {'steps': [{'median': 0.010}, {'median': 0.015}, {'median': 0.025}]}
+        assert take_over_benchmark.grew(report, 1.0)
+        assert not take_over_benchmark.grew(report, 2.0)
@@ -4,8 +4,11 @@ from Cookie import SimpleCookie
 
 from aspen.utils import utcnow
 import gratipay
+from gratipay.models.participant import Participant
+from gratipay.security.session_cache import SessionCache
 from gratipay.security.user import User, SESSION, SESSION_REFRESH
 from gratipay.testing import Harness
+from gratipay.utils.sql_profiling import recording
 
 
 class TestUser(Harness):
@@ -143,3 +146,61 @@ class TestUser(Harness):
         assert not alice.ANON
         alice.sign_out(SimpleCookie())
         assert alice.ANON
+
+
+    # session cache
+
+    def sign_in_with_cache(self, username, **kw):
+        cache = Participant.session_cache
+        Participant.session_cache = SessionCache(**kw)
+        self.addCleanup(setattr, Participant, 'session_cache', cache)
+        self.make_participant(username)
+        user = User.from_username(username)
+        user.sign_in(SimpleCookie())
+        return user.participant.session_token
+
+    def test_sessions_are_cached(self):
+        token = self.sign_in_with_cache('alice', ttl=60)
+        User.from_session_token(token)
+        with recording() as recorder:
+            user = User.from_session_token(token)
+        assert user.participant.username == 'alice'
+        assert recorder.nqueries == 0
+
+    def test_each_lookup_gets_its_own_copy(self):
+        token = self.sign_in_with_cache('alice', ttl=60)
+        User.from_session_token(token).participant.set_attributes(giving=10)
+        assert User.from_session_token(token).participant.giving == 0
+
+    def test_signing_out_forgets_the_session(self):
+        token = self.sign_in_with_cache('alice', ttl=60)
+        user = User.from_session_token(token)
+        user.sign_out(SimpleCookie())
+        assert User.from_session_token(token).ANON
+
+    def test_extending_a_session_updates_the_cache(self):
+        token = self.sign_in_with_cache('alice', ttl=60)
+        user = User.from_session_token(token)
+        expires = user.participant.session_expires
+        user.participant.set_session_expires(expires - SESSION_REFRESH)
+        cookies = SimpleCookie()
+        user = User.from_session_token(token)
+        user.keep_signed_in(cookies)
+        assert SESSION in cookies
+        with recording() as recorder:
+            User.from_session_token(token).keep_signed_in(SimpleCookie())
+        assert recorder.nqueries == 0
+
+    def test_session_cache_is_bounded(self):
+        cache = SessionCache(ttl=60, size=2)
+        alice = self.make_participant('alice')
+        for token in ('a', 'b', 'c'):
+            cache.add(token, alice)
+        assert cache.get('a') is None
+        assert cache.get('c').username == 'alice'
+
+    def test_session_cache_entries_expire(self):
+        cache = SessionCache(ttl=60)
+        cache.add('a', self.make_participant('alice'))
+        cache.ttl = -1
+        assert cache.get('a') is None